@@ -6,14 +6,16 @@ from modules.openai_patch import patch_openai
 import gradio as gr
 import json
 import time
+import threading
 import zipfile
 import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
 
 # 確保可以導入專案模組
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 
-from modules.text_preprocessing import preprocess_text, PreprocessingError
+from modules.text_preprocessing import preprocess_text, preprocess_text_stream, iter_new_segments, PreprocessingError
 from modules.homophone_replacement import HomophoneReplacer
 from modules.tts_generator import TTSGenerator, TTSGenerationError
 from modules.subtitle_corrector import SubtitleCorrector
@@ -21,10 +23,18 @@ from modules.srt_generator import SRTGenerator
 from modules.audio_merge import AudioMerger, AudioMergeError
 from modules import TTS_VOICES, TTS_EMOTIONS
 from modules.file_manager import FileManager
+from modules.pipeline import StreamingPipeline, save_outputs
+from modules.job_queue import JobManager, JobError
+from utils.job_store import JobStore, DONE
+from utils.response_cache import get_default_cache
+from utils.api_handler import concurrency_report, get_hedge_policy, hedge_report, key_pool_report
 
 # 初始化檔案管理器
 file_manager = FileManager()
 
+# 批次處理時同時進行的檔案數量上限（實際 API 並行數仍由各服務共用的並行控制器決定）
+BATCH_MAX_PARALLEL_FILES = 8
+
 # 檔案路徑設置
 current_dir = Path(__file__).parent
 data_dir = current_dir / "data"
@@ -50,21 +60,26 @@ if not dictionary_path.exists():
     except Exception as e:
         print(f"Error creating dictionary file: {e}")
 
-def process_text(input_text, language, google_api_key):
+# 背景工作管理器（工作狀態保存在 SQLite，程式重新啟動後中斷的工作會暫停等待繼續）
+job_manager = JobManager(JobStore(), file_manager, str(dictionary_path))
+
+def process_text(input_text, language, google_api_key, use_rule_segmentation=True, use_cache=False):
     """處理文本的回調函數"""
     try:
         # 驗證輸入
         if not input_text.strip():
             return "請輸入文本", None, None
         
-        if not google_api_key.strip():
+        # 中文使用規則分段時，只有規則無法處理的段落才需要 API 金鑰
+        use_rules = use_rule_segmentation and language == "zh"
+        if not use_rules and not (google_api_key or "").strip():
             return "請提供 Google AI API 金鑰", None, None
         
         # 創建新的處理識別碼
         identifier = file_manager.create_identifier()
         
         # 調用預處理函數
-        processed_text = preprocess_text(input_text, language, google_api_key)
+        processed_text = preprocess_text(input_text, language, google_api_key, use_rules=use_rules, use_cache=use_cache)
         
         # 保存處理後的文本
         output_path = file_manager.get_file_path(identifier, "step1", "preprocessed.txt")
@@ -78,29 +93,93 @@ def process_text(input_text, language, google_api_key):
     except Exception as e:
         return f"未知錯誤: {str(e)}", None, None
 
-def replace_homophones(processed_text, google_api_key, identifier):
+def cache_summary():
+    """AI 回應快取的命中統計"""
+    stats = get_default_cache().stats()
+    return f"（AI 回應快取：命中 {stats['hits']} 次，未命中 {stats['misses']} 次，共 {stats['entries']} 筆）"
+
+def hedge_summary(name):
+    """備援請求的累計統計"""
+    stats = get_hedge_policy(name).stats()
+    return f"（備援請求 {stats['hedged']}/{stats['requests']} 次，備援先完成 {stats['hedge_wins']} 次）"
+
+def process_text_stream(input_text, language, google_api_key, use_rule_segmentation=True, use_cache=False):
+    """以串流方式處理文本的回調函數，預覽會隨模型輸出逐步更新"""
+    # 驗證輸入
+    if not input_text.strip():
+        yield "請輸入文本", None, None
+        return
+    
+    use_rules = use_rule_segmentation and language == "zh"
+    if not use_rules and not (google_api_key or "").strip():
+        yield "請提供 Google AI API 金鑰", None, None
+        return
+    
+    try:
+        # 創建新的處理識別碼
+        identifier = file_manager.create_identifier()
+        
+        processed_text = ""
+        for processed_text in preprocess_text_stream(input_text, language, google_api_key, use_rules=use_rules, use_cache=use_cache):
+            yield "處理中...", processed_text, identifier
+        
+        # 保存處理後的文本
+        output_path = file_manager.get_file_path(identifier, "step1", "preprocessed.txt")
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(processed_text)
+        
+        yield "處理成功!" + (cache_summary() if use_cache else ""), processed_text, identifier
+    
+    except PreprocessingError as e:
+        yield f"錯誤: {str(e)}", None, None
+    except Exception as e:
+        yield f"未知錯誤: {str(e)}", None, None
+
+def replace_homophones(processed_text, google_api_key, identifier, use_gemini_segmentation=False):
     """多音字替換的回調函數"""
     try:
         if not processed_text or not processed_text.strip():
             return "請先完成文本預處理", None, None
         
-        if not google_api_key.strip():
-            return "請提供 Google AI API 金鑰", None, None
+        if use_gemini_segmentation and not (google_api_key or "").strip():
+            return "使用 Gemini 斷詞時請提供 Google AI API 金鑰", None, None
             
         if not identifier:
             return "無效的處理識別碼", None, None
         
-        # 初始化多音字替換器
-        homophone_replacer = HomophoneReplacer(dictionary_path)
-        
-        # 將文本分成批次（每10個段落一批）
-        text_batches = homophone_replacer.segment_text(processed_text, batch_size=10)
+        # 取得共用的已編譯多音字替換器（字典檔未變更時不重新載入）
+        homophone_replacer = HomophoneReplacer.load_shared(dictionary_path)
+        
+        # 讀取同一識別碼上次的區塊結果；字典或斷詞方式改變時不沿用
+        mode = "gemini" if use_gemini_segmentation else "local"
+        cache_path = file_manager.get_file_path(identifier, "step2", "blocks.json")
+        previous_blocks = {}
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    cache = json.load(f)
+                if cache.get("mode") == mode and cache.get("dictionary_hash") == homophone_replacer.dictionary_hash:
+                    previous_blocks = cache.get("blocks", {})
+            except (OSError, ValueError) as e:
+                print(f"讀取步驟2區塊快取失敗，重新處理全部區塊: {e}")
+        
+        if use_gemini_segmentation:
+            # 使用Google AI處理改變過的區塊
+            segment_blocks = lambda blocks: homophone_replacer.segment_blocks_with_google_ai(blocks, google_api_key)
+        else:
+            # 使用本地斷詞器，不需要呼叫 API
+            segment_blocks = lambda blocks: [homophone_replacer.process_locally(block) for block in blocks]
         
-        # 使用Google AI處理每個批次
-        token_text = homophone_replacer.process_with_google_ai(text_batches, google_api_key)
+        # 進行多音字替換，只重新處理內容改變的區塊
+        modified_text, report, blocks = homophone_replacer.replace_blocks(processed_text, segment_blocks, previous_blocks)
+        reused = sum(1 for block in blocks if block in previous_blocks)
         
-        # 進行多音字替換
-        modified_text, report = homophone_replacer.replace_homophones(token_text)
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "mode": mode,
+                "dictionary_hash": homophone_replacer.dictionary_hash,
+                "blocks": blocks
+            }, f, ensure_ascii=False)
         
         # 生成報告
         human_readable_report = homophone_replacer.get_replacement_report(report)
@@ -115,12 +194,16 @@ def replace_homophones(processed_text, google_api_key, identifier):
         with open(report_path, "w", encoding="utf-8") as f:
             f.write(human_readable_report)
         
-        return "多音字替換成功!", modified_text, human_readable_report
+        status = "多音字替換成功!"
+        if reused:
+            status += f" (沿用 {reused} 個未修改的區塊，重新處理 {len(blocks) - reused} 個區塊)"
+        return status, modified_text, human_readable_report
     
     except Exception as e:
         return f"多音字替換錯誤: {str(e)}", None, None
 
-def generate_tts(text, api_key, voice_name, emotion, speed, custom_pronunciation, identifier):
+def generate_tts(text, api_key, voice_name, emotion, speed, custom_pronunciation, identifier,
+                 use_pronunciation_dict=False, use_hedging=False):
     """TTS語音生成的回調函數"""
     try:
         if not text or not text.strip():
@@ -139,6 +222,11 @@ def generate_tts(text, api_key, voice_name, emotion, speed, custom_pronunciation
         # 初始化TTS生成器
         tts_generator = TTSGenerator(api_key, output_dir=audio_output_dir)
         
+        # 使用發音字典時，多音字字典的使用詞彙也編入發音字典
+        homophone_dictionary = None
+        if use_pronunciation_dict:
+            homophone_dictionary = HomophoneReplacer.load_shared(dictionary_path).dictionary
+        
         # 生成語音
         mp3_files, _ = tts_generator.generate_speech(
             text,
@@ -146,7 +234,10 @@ def generate_tts(text, api_key, voice_name, emotion, speed, custom_pronunciation
             emotion=emotion,
             speed=float(speed),
             custom_pronunciation=custom_pronunciation,
-            identifier=identifier
+            identifier=identifier,
+            use_pronunciation_dict=use_pronunciation_dict,
+            homophone_dictionary=homophone_dictionary,
+            hedge=use_hedging
         )
         
         # 生成語音文件列表
@@ -165,7 +256,8 @@ def generate_tts(text, api_key, voice_name, emotion, speed, custom_pronunciation
         with open(transcript_file, "w", encoding="utf-8") as f:
             f.write(text)
         
-        return "語音生成成功!", file_list, zip_path, transcript_file, mp3_files
+        status = "語音生成成功!" + (hedge_summary("hailuo_tts") if use_hedging else "")
+        return status, file_list, zip_path, transcript_file, mp3_files
     
     except TTSGenerationError as e:
         return f"語音生成錯誤: {str(e)}", None, None, None, None
@@ -173,7 +265,8 @@ def generate_tts(text, api_key, voice_name, emotion, speed, custom_pronunciation
         return f"未知錯誤: {str(e)}", None, None, None, None
 
 # 新增函數：僅生成字幕，不進行校正
-def generate_subtitle_only(audio_zip, whisper_api_key, language, identifier):
+def generate_subtitle_only(audio_zip, whisper_api_key, language, identifier,
+                           word_timestamps=False, max_chars=18, min_duration=1.0, use_hedging=False):
     """只從音频生成字幕的回調函數，不進行校正"""
     try:
         if not audio_zip:
@@ -218,14 +311,39 @@ def generate_subtitle_only(audio_zip, whisper_api_key, language, identifier):
         # 生成字幕
         initial_srt_file = file_manager.get_file_path(identifier, "step4", "initial_subtitle.srt")
         
+        if word_timestamps:
+            # 取得字詞時間戳，在本地斷句
+            words_list = []
+            for audio_file in audio_files:
+                words_data = subtitle_generator.transcribe_words(audio_file, whisper_api_key, language, hedge=use_hedging)
+                if not words_data:
+                    # 轉錄失敗時以空白的音頻長度佔位，讓後續檔案的時間偏移保持正確
+                    duration = subtitle_generator.get_audio_duration(audio_file)
+                    if not duration:
+                        return f"字詞轉錄失敗且無法取得音頻長度: {os.path.basename(audio_file)}", None, None
+                    print(f"字詞轉錄失敗，以 {duration:.1f} 秒空白佔位: {os.path.basename(audio_file)}")
+                    words_data = {"duration": duration, "words": [], "segments": []}
+                words_list.append(words_data)
+            
+            # 保存字詞時間戳，之後可調整版面重新斷句而不需再次呼叫 API
+            words_path = file_manager.get_file_path(identifier, "step4", "words.json")
+            with open(words_path, "w", encoding="utf-8") as f:
+                json.dump(words_list, f, ensure_ascii=False)
+            
+            layout = {"max_chars": int(max_chars), "min_duration": float(min_duration)}
+            all_srt_entries = subtitle_generator.words_to_entries(words_list, layout)
+            audio_files_to_transcribe = []
+        else:
+            all_srt_entries = []
+            audio_files_to_transcribe = audio_files
+        
         # 為每個音頻文件生成字幕
-        all_srt_entries = []
         current_index = 1
         time_offset = 0  # 時間偏移量（毫秒）
         
-        for audio_file in audio_files:
+        for audio_file in audio_files_to_transcribe:
             # 使用Whisper API轉錄音頻
-            srt_content = subtitle_generator.transcribe(audio_file, whisper_api_key, language)
+            srt_content = subtitle_generator.transcribe(audio_file, whisper_api_key, language, hedge=use_hedging)
             if not srt_content:
                 continue
                 
@@ -252,11 +370,7 @@ def generate_subtitle_only(audio_zip, whisper_api_key, language, identifier):
             time_offset = subtitle_generator.time_to_ms(last_entry['end_time'])
         
         # 生成合併後的SRT內容
-        combined_srt = ""
-        for entry in all_srt_entries:
-            combined_srt += f"{entry['index']}\n"
-            combined_srt += f"{entry['start_time']} --> {entry['end_time']}\n"
-            combined_srt += f"{entry['text']}\n\n"
+        combined_srt = subtitle_generator.format_srt(all_srt_entries)
         
         # 保存合併後的字幕文件
         with open(initial_srt_file, "w", encoding="utf-8") as f:
@@ -270,14 +384,59 @@ def generate_subtitle_only(audio_zip, whisper_api_key, language, identifier):
         if not combined_srt:
             return "字幕生成失敗：未能從音頻中提取文字", None, None
         
-        return "字幕生成成功!", combined_srt, initial_srt_file
+        status = "字幕生成成功!"
+        if use_hedging:
+            status += hedge_summary("whisper_transcribe_words" if word_timestamps else "whisper_transcribe")
+        return status, combined_srt, initial_srt_file
     
     except Exception as e:
         return f"字幕生成過程中出錯: {str(e)}", None, None
 
+def resegment_subtitle(identifier, max_chars, min_duration):
+    """以保存的字詞時間戳重新斷句的回調函數，不重新呼叫 API"""
+    try:
+        if not identifier:
+            return "無效的處理識別碼", None, None
+        
+        words_path = file_manager.get_file_path(identifier, "step4", "words.json")
+        if not os.path.exists(words_path):
+            return "找不到字詞時間戳，請先勾選「使用字詞時間戳斷句」並生成字幕", None, None
+        
+        with open(words_path, "r", encoding="utf-8") as f:
+            words_list = json.load(f)
+        
+        subtitle_generator = SRTGenerator()
+        layout = {"max_chars": int(max_chars), "min_duration": float(min_duration)}
+        entries = subtitle_generator.words_to_entries(words_list, layout)
+        combined_srt = subtitle_generator.format_srt(entries)
+        
+        if not combined_srt:
+            return "重新斷句失敗：沒有可用的字詞時間戳", None, None
+        
+        initial_srt_file = file_manager.get_file_path(identifier, "step4", "initial_subtitle.srt")
+        with open(initial_srt_file, "w", encoding="utf-8") as f:
+            f.write(combined_srt)
+        
+        return f"重新斷句成功! 共 {len(entries)} 條字幕", combined_srt, initial_srt_file
+    
+    except Exception as e:
+        return f"重新斷句過程中出錯: {str(e)}", None, None
+
 def auto_process_all(transcript_file_path, google_api_key, tts_api_key, whisper_api_key, gemini_api_key, 
-                    language, voice_name, emotion, speed, custom_pronunciation, batch_size):
-    """一鍵處理所有步驟的整合函數"""
+                    language, voice_name, emotion, speed, custom_pronunciation, batch_size, progress=None):
+    """一鍵處理所有步驟的整合函數
+    
+    各步驟以串流管線重疊執行：預處理每完成一段就立即進行多音字替換與語音生成，
+    每個音檔寫入後立即轉錄，字幕累積到一組即開始校正（見 StreamingPipeline）。
+    
+    Args:
+        progress: 進度回呼，參數為 (0~1 的進度, 描述)，None 表示不回報
+        
+    Returns:
+        (狀態訊息, 處理日誌, 音頻ZIP路徑, 字幕檔路徑)
+    """
+    if progress is None:
+        progress = lambda value, desc="": None
     try:
         # 檢查必要參數
         if not transcript_file_path or not os.path.exists(transcript_file_path):
@@ -286,8 +445,7 @@ def auto_process_all(transcript_file_path, google_api_key, tts_api_key, whisper_
         if not all([google_api_key, tts_api_key, whisper_api_key, gemini_api_key]):
             return "請填寫所有必要的 API 金鑰", "處理中斷", None, None
         
-        progress(0.05, "正在準備處理...")
-        timestamp = int(time.time())
+        progress(0.02, "正在準備處理...")
         log_messages = []
         
         # 獲取原始檔案名稱（不含路徑和副檔名）
@@ -302,75 +460,51 @@ def auto_process_all(transcript_file_path, google_api_key, tts_api_key, whisper_
         if not input_text.strip():
             return "逐字稿文件為空", "處理中斷", None, None
         
-        # 步驟1: 文本預處理
-        progress(0.1, "步驟1: 文本預處理...")
-        log_messages.append("=== 步驟1: 文本預處理 ===")
-        status_msg, processed_text = process_text(input_text, language, google_api_key)
-        
-        if not processed_text:
-            return f"文本預處理失敗: {status_msg}", "\n".join(log_messages), None, None
-        
-        log_messages.append(f"預處理狀態: {status_msg}")
-        log_messages.append(f"處理後文本長度: {len(processed_text)} 字符")
-        
-        # 步驟2: 多音字替換
-        progress(0.3, "步驟2: 多音字替換...")
-        log_messages.append("\n=== 步驟2: 多音字替換 ===")
-        status_msg, modified_text, report = replace_homophones(processed_text, google_api_key)
-        
-        if not modified_text:
-            return f"多音字替換失敗: {status_msg}", "\n".join(log_messages), None, None
-        
-        log_messages.append(f"替換狀態: {status_msg}")
-        
-        # 步驟3: TTS語音生成
-        progress(0.5, "步驟3: TTS語音生成...")
-        log_messages.append("\n=== 步驟3: TTS語音生成 ===")
-        status_msg, file_list, zip_path, transcript_file, mp3_files = generate_tts(
-            modified_text, tts_api_key, voice_name, emotion, speed, custom_pronunciation
-        )
-        
-        if not zip_path or not os.path.exists(zip_path):
-            return f"語音生成失敗: {status_msg}", "\n".join(log_messages), None, None
+        identifier = file_manager.create_identifier()
         
-        # 重命名ZIP檔案，使用原始檔案名稱
-        new_zip_path = os.path.join(os.path.dirname(zip_path), f"{base_filename}.zip")
+        # 準備語音生成器並確認連線（音檔寫入 step3 的音頻目錄）
+        audio_output_dir = file_manager.get_file_path(identifier, "step3", "audio")
+        os.makedirs(audio_output_dir, exist_ok=True)
+        tts_generator = TTSGenerator(tts_api_key, output_dir=audio_output_dir)
         try:
-            # 如果同名檔案已存在，先刪除
-            if os.path.exists(new_zip_path):
-                os.remove(new_zip_path)
-            os.rename(zip_path, new_zip_path)
-            zip_path = new_zip_path
-            log_messages.append(f"重命名音頻ZIP檔案為: {os.path.basename(new_zip_path)}")
-        except Exception as e:
-            log_messages.append(f"警告: 無法重命名ZIP檔案: {str(e)}")
-        
-        log_messages.append(f"語音生成狀態: {status_msg}")
-        log_messages.append(f"生成了 {len(mp3_files)} 個音頻文件")
-        
-        # 步驟4: 字幕生成與校正
-        progress(0.8, "步驟4: 字幕生成與校正...")
-        log_messages.append("\n=== 步驟4: 字幕生成與校正 ===")
-        status_msg, subtitle_file, report_file, initial_srt_file = generate_subtitle(
-            zip_path, transcript_file, whisper_api_key, gemini_api_key, language, batch_size
+            voice_settings = tts_generator.build_voice_settings(voice_name, emotion, float(speed))
+        except TTSGenerationError as e:
+            return f"語音生成失敗: {str(e)}", "\n".join(log_messages), None, None
+        if not tts_generator.test_api_connection():
+            return "語音生成失敗: 無法連接到 Hailuo API，請檢查網絡和 API 密鑰", "\n".join(log_messages), None, None
+        
+        # 有自定義發音詞條時編譯發音字典，每個段落只送出實際出現的詞條
+        pronunciation_matcher = None
+        if custom_pronunciation and custom_pronunciation.strip():
+            pronunciation_matcher = tts_generator.compile_pronunciation_dict(custom_pronunciation)
+        
+        # 預處理以串流方式進行，每完成一個分段就交給管線
+        segments = iter_new_segments(
+            preprocess_text_stream(input_text, language, google_api_key, use_rules=(language == "zh"))
         )
         
-        if not subtitle_file or not os.path.exists(subtitle_file):
-            return f"字幕生成與校正失敗: {status_msg}", "\n".join(log_messages), zip_path, None
-        
-        # 重命名SRT檔案，使用原始檔案名稱
-        new_srt_path = os.path.join(os.path.dirname(subtitle_file), f"{base_filename}.srt")
-        try:
-            # 如果同名檔案已存在，先刪除
-            if os.path.exists(new_srt_path):
-                os.remove(new_srt_path)
-            os.rename(subtitle_file, new_srt_path)
-            subtitle_file = new_srt_path
-            log_messages.append(f"重命名字幕檔案為: {os.path.basename(new_srt_path)}")
-        except Exception as e:
-            log_messages.append(f"警告: 無法重命名SRT檔案: {str(e)}")
+        pipeline = StreamingPipeline(
+            tts_generator,
+            voice_settings,
+            whisper_api_key,
+            SubtitleCorrector(gemini_api_key),
+            replacer=HomophoneReplacer.load_shared(dictionary_path),
+            language=language,
+            pronunciation_matcher=pronunciation_matcher,
+            batch_size=None if batch_size == "自動" else int(batch_size),
+            progress=progress
+        )
+        log_messages.append("=== 步驟1-4: 預處理、多音字替換、語音生成、字幕生成與校正（串流管線） ===")
+        error, result = pipeline.run(segments)
+        if error:
+            return f"處理失敗: {error}", "\n".join(log_messages), None, None
         
-        log_messages.append(f"字幕生成狀態: {status_msg}")
+        progress(0.96, "保存處理結果...")
+        zip_path, subtitle_file, output_log = save_outputs(
+            file_manager, identifier, base_filename, result, HomophoneReplacer.load_shared(dictionary_path)
+        )
+        log_messages.extend(output_log)
+        log_messages.append(f"管線總耗時: {result['elapsed']:.1f} 秒")
         
         # 處理完成
         progress(1.0, "全部處理完成!")
@@ -387,8 +521,10 @@ def auto_process_all(transcript_file_path, google_api_key, tts_api_key, whisper_
     except Exception as e:
         return f"字幕校正過程中出錯: {str(e)}", None, None, None
 
-def generate_subtitle(audio_zip, transcript_file, whisper_api_key, gemini_api_key, language, batch_size):
+def generate_subtitle(audio_zip, transcript_file, whisper_api_key, gemini_api_key, language, batch_size, progress=None):
     """從音頻和逐字稿生成和校正字幕的回調函數"""
+    if progress is None:
+        progress = lambda value, desc="": None
     try:
         if not audio_zip or not os.path.exists(audio_zip):
             return "請先生成音頻文件", None, None, None
@@ -456,7 +592,7 @@ def generate_subtitle(audio_zip, transcript_file, whisper_api_key, gemini_api_ke
         error, corrected_srt, reports = subtitle_corrector.correct_subtitles(
             transcript_file,
             initial_srt_path,
-            int(batch_size)
+            None if batch_size == "自動" else int(batch_size)
         )
         
         if error:
@@ -586,39 +722,78 @@ def create_video_preview(mp3_files, subtitle_file, identifier):
         return f"未知錯誤: {str(e)}", None
 
 def batch_process_all_files(transcript_files, google_api_key, tts_api_key, whisper_api_key, gemini_api_key, 
-                          language, voice_name, emotion, speed, custom_pronunciation, batch_size):
-    """批次處理多個逐字稿檔案，每個檔案獨立處理並打包"""
+                          language, voice_name, emotion, speed, custom_pronunciation, batch_size,
+                          progress=gr.Progress()):
+    """批次處理多個逐字稿檔案，每個檔案獨立處理並打包
+    
+    多個檔案同時處理；各檔案的 API 請求經由共用的金鑰池、並行控制器與校正速率限制器，
+    由所有檔案分享同一份配額。單一檔案失敗不影響其他檔案，處理期間持續顯示每個檔案的進度。
+    """
     if not transcript_files:
-        return "請上傳至少一個逐字稿檔案", "未處理任何檔案", None
+        yield "請上傳至少一個逐字稿檔案", "未處理任何檔案", None
+        return
     
     if not all([google_api_key, tts_api_key, whisper_api_key, gemini_api_key]):
-        return "請填寫所有必要的 API 金鑰", "處理中斷", None
+        yield "請填寫所有必要的 API 金鑰", "處理中斷", None
+        return
+    
+    temp_dir = Path(file_manager.temp_dir)
+    file_count = len(transcript_files)
+    file_states = [{"name": os.path.basename(file_path), "progress": 0.0, "desc": "等待中"}
+                   for file_path in transcript_files]
+    state_lock = threading.Lock()
+    
+    def progress_table():
+        """每個檔案一行的目前進度"""
+        with state_lock:
+            return "\n".join(
+                f"[{idx+1}/{file_count}] {state['name']}: {int(state['progress'] * 100)}% {state['desc']}"
+                for idx, state in enumerate(file_states)
+            )
+    
+    def process_file(idx, file_path):
+        """處理單一檔案，任何例外都只影響這個檔案"""
+        def file_progress(value, desc=""):
+            with state_lock:
+                file_states[idx].update(progress=value, desc=desc)
+        
+        try:
+            return auto_process_all(
+                file_path, google_api_key, tts_api_key, whisper_api_key, gemini_api_key,
+                language, voice_name, emotion, speed, custom_pronunciation, batch_size,
+                progress=file_progress
+            )
+        except Exception as e:
+            return f"處理過程中發生錯誤: {str(e)}", "處理出錯", None, None
+    
+    # 同時處理多個檔案，定期更新所有檔案的進度
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(file_count, BATCH_MAX_PARALLEL_FILES)) as executor:
+        futures = {executor.submit(process_file, idx, file_path): idx
+                   for idx, file_path in enumerate(transcript_files)}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=1.0)
+            for future in done:
+                idx = futures[future]
+                results[idx] = future.result()
+                succeeded = bool(results[idx][3])
+                with state_lock:
+                    file_states[idx].update(progress=1.0, desc="完成" if succeeded else f"失敗：{results[idx][0]}")
+            
+            with state_lock:
+                overall = sum(state["progress"] for state in file_states) / file_count
+            progress(overall, f"{len(results)}/{file_count} 個檔案完成")
+            yield f"處理中: {len(results)}/{file_count} 個檔案完成", progress_table(), None
     
     # 準備存放處理結果的容器
     status_messages = []
-    log_messages = []
+    log_messages = [progress_table()]
     all_package_files = []
     
-    # 計算總進度基準
-    file_count = len(transcript_files)
-    
-    # 處理每個檔案
+    # 依上傳順序記錄結果並打包
     for idx, file_path in enumerate(transcript_files):
-        # 計算此檔案的進度範圍
-        progress_start = idx / file_count
-        progress_end = (idx + 1) / file_count
-        
-        # 檔案處理的進度包裝器
-        def file_progress(value, desc=""):
-            overall_progress = progress_start + (progress_end - progress_start) * value
-            progress(overall_progress, f"[{idx+1}/{file_count}] {desc}")
-        
-        # 處理單一檔案
-        file_status, file_log, zip_file, srt_file = auto_process_all(
-            file_path, google_api_key, tts_api_key, whisper_api_key, gemini_api_key,
-            language, voice_name, emotion, speed, custom_pronunciation, batch_size,
-            progress=file_progress
-        )
+        file_status, file_log, zip_file, srt_file = results[idx]
         
         # 記錄處理結果
         file_name = os.path.basename(file_path)
@@ -630,7 +805,7 @@ def batch_process_all_files(transcript_files, google_api_key, tts_api_key, whisp
         # 為每個檔案創建獨立的整合包
         if (zip_file and os.path.exists(zip_file)) and (srt_file and os.path.exists(srt_file)):
             # 創建整合包
-            package_zip = str(temp_dir / f"整合_{base_name}.zip")
+            package_zip = os.path.join(os.path.dirname(zip_file), f"整合_{base_name}.zip")
             
             # 如果同名檔案已存在，先刪除
             if os.path.exists(package_zip):
@@ -644,9 +819,24 @@ def batch_process_all_files(transcript_files, google_api_key, tts_api_key, whisp
             
             all_package_files.append(package_zip)
             log_messages.append(f"已創建整合包: 整合_{base_name}.zip")
+        else:
+            log_messages.append(f"處理失敗: {file_status}")
+    
+    # 每把金鑰的使用統計與各服務的並行上限、延遲，方便確認負載是否平均分配
+    usage_report = key_pool_report()
+    if usage_report:
+        log_messages.append(f"\n{'='*50}\nAPI 金鑰使用統計\n{'='*50}\n{usage_report}")
+    throughput_report = concurrency_report()
+    if throughput_report:
+        log_messages.append(f"\n{'='*50}\n並行控制與延遲\n{'='*50}\n{throughput_report}")
+    hedging_report = hedge_report()
+    if hedging_report:
+        log_messages.append(f"\n{'='*50}\n備援請求統計\n{'='*50}\n{hedging_report}")
     
     # 合併所有檔案處理狀態
     final_status = f"處理完成: {len(all_package_files)}/{file_count} 個檔案成功生成整合包"
+    if len(all_package_files) < file_count:
+        final_status += "\n" + "\n".join(message for message in status_messages if "全部處理完成" not in message)
     combined_logs = "\n".join(log_messages)
     
     # 創建所有整合包的索引ZIP
@@ -654,11 +844,80 @@ def batch_process_all_files(transcript_files, google_api_key, tts_api_key, whisp
     index_zip = str(temp_dir / f"所有整合包_{timestamp}.zip")
     
     with zipfile.ZipFile(index_zip, 'w') as index_package:
+        used_names = set()
         for package_file in all_package_files:
-            index_package.write(package_file, os.path.basename(package_file))
+            # 同名的上傳檔案各自保留，加上序號區分
+            name = os.path.basename(package_file)
+            stem, ext = os.path.splitext(name)
+            number = 2
+            while name in used_names:
+                name = f"{stem} ({number}){ext}"
+                number += 1
+            used_names.add(name)
+            index_package.write(package_file, name)
              
-    return final_status, combined_logs, index_zip
+    yield final_status, combined_logs, index_zip
+
+
+
+def submit_background_jobs(transcript_files, google_api_key, tts_api_key, whisper_api_key, gemini_api_key,
+                           language, voice_name, emotion, speed, custom_pronunciation, batch_size):
+    """將上傳的每個逐字稿提交為背景工作，立即返回工作編號
+
+    工作在伺服器的工作池中執行，不佔用介面的請求，關閉瀏覽器也不影響處理。
+
+    Returns:
+        (狀態訊息, 工作編號)
+    """
+    if not transcript_files:
+        return "請上傳至少一個逐字稿檔案", ""
+
+    api_keys = {"google": google_api_key, "tts": tts_api_key, "whisper": whisper_api_key, "gemini": gemini_api_key}
+    settings = {"language": language, "voice_name": voice_name, "emotion": emotion,
+                "speed": speed, "custom_pronunciation": custom_pronunciation, "batch_size": batch_size}
+    job_ids, errors = [], []
+    for file_path in transcript_files:
+        try:
+            job_ids.append(job_manager.submit(file_path, settings, api_keys))
+        except (JobError, OSError) as e:
+            errors.append(f"{os.path.basename(file_path)}: {e}")
+
+    status = f"已提交 {len(job_ids)} 個背景工作"
+    if errors:
+        status += "\n" + "\n".join(errors)
+    return status, ", ".join(job_ids)
+
+def resume_background_jobs(job_ids, google_api_key, tts_api_key, whisper_api_key, gemini_api_key):
+    """以目前的 API 金鑰繼續暫停或失敗的工作，未指定工作編號時繼續所有暫停的工作"""
+    api_keys = {"google": google_api_key, "tts": tts_api_key, "whisper": whisper_api_key, "gemini": gemini_api_key}
+    try:
+        job_ids = [job_id.strip() for job_id in (job_ids or "").split(",") if job_id.strip()]
+        if not job_ids:
+            resumed = job_manager.resume_all(api_keys)
+            return f"已繼續 {len(resumed)} 個暫停的工作" if resumed else "沒有暫停的工作"
+        return "\n".join(job_manager.resume(job_id, api_keys) for job_id in job_ids)
+    except JobError as e:
+        return str(e)
 
+def background_job_status(job_ids):
+    """查詢背景工作狀態：指定工作編號時列出這些工作，否則列出最近的工作
+
+    Returns:
+        (工作狀態, 已完成工作的結果檔案)
+    """
+    job_ids = [job_id.strip() for job_id in (job_ids or "").split(",") if job_id.strip()]
+    if job_ids:
+        jobs = [job for job in (job_manager.store.get_job(job_id) for job_id in job_ids) if job]
+    else:
+        jobs = job_manager.store.list_jobs(limit=20)
+    if not jobs:
+        return "目前沒有背景工作", None
+
+    files = []
+    for job in jobs:
+        if job["status"] == DONE and job["result"]:
+            files.extend(path for path in (job["result"]["zip"], job["result"]["srt"]) if os.path.exists(path))
+    return "\n".join(job_manager.describe(job) for job in jobs), (files or None)
 
 
 # 定義Gradio界面
@@ -701,10 +960,20 @@ with gr.Blocks(
                         )
                         google_api_key = gr.Textbox(
                             label="Google AI API 金鑰",
-                            placeholder="請輸入您的 API 金鑰",
+                            placeholder="請輸入您的 API 金鑰（多把金鑰以逗號分隔）",
                             type="password"
                         )
                     
+                    use_rule_segmentation = gr.Checkbox(
+                        label="以規則分段（僅中文，規則無法處理的段落才使用 AI）",
+                        value=True
+                    )
+                    
+                    use_response_cache = gr.Checkbox(
+                        label="使用 AI 回應快取（相同文本重新處理時不再呼叫 API）",
+                        value=False
+                    )
+                    
                     process_btn = gr.Button("預處理文本")
                     
                     status_msg = gr.Textbox(label="狀態", interactive=False)
@@ -729,9 +998,14 @@ with gr.Blocks(
                         lines=10
                     )
                     
+                    step2_use_gemini = gr.Checkbox(
+                        label="使用 Gemini 斷詞（預設使用本地斷詞，不需要 API 金鑰）",
+                        value=False
+                    )
+                    
                     step2_google_api_key = gr.Textbox(
                         label="Google AI API 金鑰",
-                        placeholder="請輸入您的 API 金鑰",
+                        placeholder="使用 Gemini 斷詞時才需要",
                         type="password"
                     )
                     
@@ -753,6 +1027,7 @@ with gr.Blocks(
                     )
                     
                     next_step_btn2 = gr.Button("進入語音生成", interactive=True)  # 設置為始終可用
+                    skip_replace_btn = gr.Button("略過替換，改用發音字典")
         
         # 第三步：TTS語音生成部分
         with gr.TabItem("步驟3: 語音生成") as tab3:
@@ -767,7 +1042,7 @@ with gr.Blocks(
                     
                     step3_api_key = gr.Textbox(
                         label="語音生成 API 金鑰",
-                        placeholder="請輸入您的 語音生成 API 金鑰",
+                        placeholder="請輸入您的 語音生成 API 金鑰（多把金鑰以逗號分隔）",
                         type="password"
                     )
                     
@@ -798,6 +1073,16 @@ with gr.Blocks(
                         lines=3
                     )
                     
+                    step3_use_pronunciation_dict = gr.Checkbox(
+                        label="以發音字典處理多音字（文本不需經過步驟2替換）",
+                        value=False
+                    )
+                    
+                    step3_use_hedging = gr.Checkbox(
+                        label="延遲過長的段落送出備援請求（最多增加一成請求數）",
+                        value=False
+                    )
+                    
                     generate_btn = gr.Button("生成語音")
                     
                     step3_status_msg = gr.Textbox(label="狀態", interactive=False)
@@ -830,13 +1115,13 @@ with gr.Blocks(
                     with gr.Row(equal_height=True):
                         step4_whisper_api_key = gr.Textbox(
                             label="Whisper API 金鑰",
-                            placeholder="請輸入您的 OpenAI API 金鑰",
+                            placeholder="請輸入您的 OpenAI API 金鑰（多把金鑰以逗號分隔）",
                             type="password",
                             scale=1
                         )
                         step4_gemini_api_key = gr.Textbox(
                             label="Google Gemini API 金鑰",
-                            placeholder="請輸入您的 Google Gemini API 金鑰",
+                            placeholder="請輸入您的 Google Gemini API 金鑰（多把金鑰以逗號分隔）",
                             type="password",
                             scale=1
                         )
@@ -851,8 +1136,8 @@ with gr.Blocks(
                         )
                         batch_size = gr.Dropdown(
                             label="字幕批次大小",
-                            choices=[5, 10, 15, 20, 25, 30],
-                            value=20,
+                            choices=["自動", 5, 10, 15, 20, 25, 30],
+                            value="自動",
                             scale=1
                         )
                         step4_status_msg = gr.Textbox(
@@ -861,6 +1146,36 @@ with gr.Blocks(
                             interactive=False,
                             scale=2
                         )
+                    
+                    # 字詞時間戳斷句設定
+                    with gr.Row(equal_height=True):
+                        step4_word_timestamps = gr.Checkbox(
+                            label="使用字詞時間戳斷句",
+                            value=False,
+                            scale=1
+                        )
+                        step4_max_chars = gr.Slider(
+                            minimum=8,
+                            maximum=40,
+                            step=1,
+                            value=18,
+                            label="每段字幕最大字數",
+                            scale=1
+                        )
+                        step4_min_duration = gr.Slider(
+                            minimum=0.5,
+                            maximum=3.0,
+                            step=0.1,
+                            value=1.0,
+                            label="每段字幕最短秒數",
+                            scale=1
+                        )
+                        resegment_btn = gr.Button("重新斷句", scale=1)
+                    
+                    step4_use_hedging = gr.Checkbox(
+                        label="延遲過長的轉錄送出備援請求（最多增加一成請求數）",
+                        value=False
+                    )
                 
                 # 右欄 - 語音檔案上傳
                 with gr.Column(scale=1):
@@ -985,22 +1300,22 @@ with gr.Blocks(
                         gr.Markdown("#### API 金鑰設定")
                         auto_google_api_key = gr.Textbox(
                             label="Google AI API 金鑰",
-                            placeholder="請輸入您的 Google AI API 金鑰",
+                            placeholder="請輸入您的 Google AI API 金鑰（多把金鑰以逗號分隔）",
                             type="password"
                         )
                         auto_tts_api_key = gr.Textbox(
                             label="語音生成 API 金鑰",
-                            placeholder="請輸入您的 語音生成 API 金鑰",
+                            placeholder="請輸入您的 語音生成 API 金鑰（多把金鑰以逗號分隔）",
                             type="password"
                         )
                         auto_whisper_api_key = gr.Textbox(
                             label="Whisper API 金鑰",
-                            placeholder="請輸入您的 OpenAI API 金鑰",
+                            placeholder="請輸入您的 OpenAI API 金鑰（多把金鑰以逗號分隔）",
                             type="password"
                         )
                         auto_gemini_api_key = gr.Textbox(
                             label="Google Gemini API 金鑰",
-                            placeholder="請輸入您的 Google Gemini API 金鑰",
+                            placeholder="請輸入您的 Google Gemini API 金鑰（多把金鑰以逗號分隔）",
                             type="password"
                         )
                     
@@ -1015,8 +1330,8 @@ with gr.Blocks(
                             )
                             auto_batch_size = gr.Dropdown(
                                 label="字幕批次大小",
-                                choices=[5, 10, 15, 20, 25, 30],
-                                value=20
+                                choices=["自動", 5, 10, 15, 20, 25, 30],
+                                value="自動"
                             )
                         
                         # 語音設定區塊
@@ -1048,6 +1363,16 @@ with gr.Blocks(
                     
                     # 啟動按鈕
                     auto_process_btn = gr.Button("開始一鍵處理", variant="primary", size="lg")
+                    
+                    # 背景工作區塊
+                    with gr.Group():
+                        gr.Markdown("#### 背景工作")
+                        auto_submit_job_btn = gr.Button("提交為背景工作", variant="secondary")
+                        auto_job_ids = gr.Textbox(
+                            label="工作編號 (多個以逗號分隔，留空顯示最近的工作)",
+                            placeholder="提交後自動填入"
+                        )
+                        auto_resume_job_btn = gr.Button("繼續暫停的工作")
                 
                 with gr.Column(scale=1):
                     gr.Markdown("### 處理進度與結果")
@@ -1073,19 +1398,32 @@ with gr.Blocks(
                         label="整合包檔案 (包含音頻和字幕)",
                         interactive=False
                     )
+                    
+                    auto_job_status = gr.Textbox(
+                        label="背景工作狀態 (每 5 秒更新)",
+                        lines=6,
+                        interactive=False
+                    )
+                    auto_job_files = gr.File(
+                        label="背景工作結果 (音頻ZIP與字幕)",
+                        file_count="multiple",
+                        interactive=False
+                    )
     
     
     
     
     # 設置回調
     # 步驟1的回調
-    def process_and_save(input_text, language, google_api_key):
-        status, result, identifier = process_text(input_text, language, google_api_key)
-        return status, result, result, identifier  # 更新狀態變量和識別碼
+    def process_and_save(input_text, language, google_api_key, use_rule_segmentation, use_response_cache):
+        # 以串流方式更新預覽，模型輸出一到達就顯示
+        for status, result, identifier in process_text_stream(input_text, language, google_api_key,
+                                                              use_rule_segmentation, use_response_cache):
+            yield status, result, result, identifier  # 更新狀態變量和識別碼
     
     process_btn.click(
         fn=process_and_save,
-        inputs=[input_text, language, google_api_key],
+        inputs=[input_text, language, google_api_key, use_rule_segmentation, use_response_cache],
         outputs=[status_msg, processed_text, preprocessed_text_state, identifier_state],
         api_name="process_text"
     )
@@ -1098,13 +1436,13 @@ with gr.Blocks(
     )
     
     # 步驟2的多音字替換回調
-    def replace_homophones_and_save(processed_text, google_api_key, identifier):
-        status, result, report = replace_homophones(processed_text, google_api_key, identifier)
+    def replace_homophones_and_save(processed_text, google_api_key, use_gemini, identifier):
+        status, result, report = replace_homophones(processed_text, google_api_key, identifier, use_gemini)
         return status, result, report, identifier
 
     replace_btn.click(
         fn=replace_homophones_and_save,
-        inputs=[step2_processed_text, step2_google_api_key, identifier_state],
+        inputs=[step2_processed_text, step2_google_api_key, step2_use_gemini, identifier_state],
         outputs=[step2_status_msg, replaced_text, replacement_report, identifier_state],
         api_name="replace_homophones"
     )
@@ -1116,9 +1454,20 @@ with gr.Blocks(
         outputs=[step3_replaced_text, identifier_state, step2_status_msg]
     )
     
+    # 略過步驟2的文字替換，將預處理文本直接傳到步驟3並啟用發音字典
+    skip_replace_btn.click(
+        fn=lambda t, identifier: (t, True, identifier, "資料已送出：原始文本已傳遞到語音生成步驟，將以發音字典處理多音字"),
+        inputs=[step2_processed_text, identifier_state],
+        outputs=[step3_replaced_text, step3_use_pronunciation_dict, identifier_state, step2_status_msg]
+    )
+    
     # 步驟3的TTS生成回調
-    def generate_tts_and_save(text, api_key, voice_name, emotion, speed, custom_pronunciation, identifier):
-        status, file_list, zip_path, transcript_file, mp3_files = generate_tts(text, api_key, voice_name, emotion, speed, custom_pronunciation, identifier)
+    def generate_tts_and_save(text, api_key, voice_name, emotion, speed, custom_pronunciation, use_pronunciation_dict,
+                              use_hedging, identifier):
+        status, file_list, zip_path, transcript_file, mp3_files = generate_tts(
+            text, api_key, voice_name, emotion, speed, custom_pronunciation, identifier, use_pronunciation_dict,
+            use_hedging
+        )
         return status, file_list, zip_path, transcript_file, mp3_files
 
     generate_btn.click(
@@ -1130,6 +1479,8 @@ with gr.Blocks(
             emotion,
             speed,
             custom_pronunciation,
+            step3_use_pronunciation_dict,
+            step3_use_hedging,
             identifier_state  # 增加識別碼參數
         ],
         outputs=[
@@ -1149,8 +1500,10 @@ with gr.Blocks(
     )
     
     # 生成字幕按鈕回調 - 修改為只生成不校正
-    def generate_subtitle_and_save(audio_zip, whisper_api_key, language, identifier):
-        return generate_subtitle_only(audio_zip, whisper_api_key, language, identifier)
+    def generate_subtitle_and_save(audio_zip, whisper_api_key, language, identifier,
+                                   word_timestamps, max_chars, min_duration, use_hedging):
+        return generate_subtitle_only(audio_zip, whisper_api_key, language, identifier,
+                                      word_timestamps, max_chars, min_duration, use_hedging)
 
     generate_subtitle_btn.click(
         fn=generate_subtitle_and_save,
@@ -1158,7 +1511,26 @@ with gr.Blocks(
             step4_audio_zip,
             step4_whisper_api_key,
             step4_language,
-            identifier_state
+            identifier_state,
+            step4_word_timestamps,
+            step4_max_chars,
+            step4_min_duration,
+            step4_use_hedging
+        ],
+        outputs=[
+            step4_status_msg,
+            original_srt_preview,
+            initial_srt_file
+        ]
+    )
+    
+    # 重新斷句按鈕回調 - 使用保存的字詞時間戳，不重新呼叫 API
+    resegment_btn.click(
+        fn=resegment_subtitle,
+        inputs=[
+            identifier_state,
+            step4_max_chars,
+            step4_min_duration
         ],
         outputs=[
             step4_status_msg,
@@ -1177,7 +1549,7 @@ with gr.Blocks(
             error, corrected_srt, reports = subtitle_corrector.correct_subtitles(
                 transcript_file,
                 initial_srt_file,
-                int(batch_size)
+                None if batch_size == "自動" else int(batch_size)
             )
             
             if error:
@@ -1303,6 +1675,38 @@ with gr.Blocks(
         ],
         api_name="batch_process_all"
     )
+    
+    # 背景工作：提交後立即返回，狀態以輪詢方式更新
+    auto_submit_job_btn.click(
+        fn=submit_background_jobs,
+        inputs=[
+            auto_transcript_files,
+            auto_google_api_key,
+            auto_tts_api_key,
+            auto_whisper_api_key,
+            auto_gemini_api_key,
+            auto_language,
+            auto_voice_name,
+            auto_emotion,
+            auto_speed,
+            auto_custom_pronunciation,
+            auto_batch_size
+        ],
+        outputs=[auto_status_msg, auto_job_ids],
+        api_name="submit_jobs"
+    )
+    auto_resume_job_btn.click(
+        fn=resume_background_jobs,
+        inputs=[auto_job_ids, auto_google_api_key, auto_tts_api_key, auto_whisper_api_key, auto_gemini_api_key],
+        outputs=[auto_status_msg]
+    )
+    app.load(
+        fn=background_job_status,
+        inputs=[auto_job_ids],
+        outputs=[auto_job_status, auto_job_files],
+        every=5
+    )
 
 if __name__ == "__main__":
-    app.launch(server_name="0.0.0.0", server_port=7863)
\ No newline at end of file
+    # 串流回調需要啟用佇列
+    app.queue().launch(server_name="0.0.0.0", server_port=7863)
\ No newline at end of file
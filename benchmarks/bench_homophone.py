@@ -0,0 +1,91 @@
+# benchmarks/bench_homophone.py
+"""
+多音字替換效能比較：逐詞 str.count / str.replace 與 Aho-Corasick 單次掃描
+
+使用方式：
+    python -m benchmarks.bench_homophone [詞彙數] [文本字數]
+"""
+
+import random
+import sys
+import time
+from typing import Any, Dict, List, Tuple
+
+from modules.homophone_replacement import HomophoneReplacer
+
+# 常用字範圍，用於產生測試詞彙與文本
+CHARSET = [chr(code) for code in range(0x4E00, 0x4E00 + 3000)]
+
+
+def build_dictionary(word_count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """產生含 word_count 個使用詞彙的測試字典"""
+    rng = random.Random(seed)
+    dictionary = []
+    words = set()
+    while len(words) < word_count:
+        original = rng.choice(CHARSET)
+        modified = rng.choice(CHARSET)
+        usecase = []
+        for _ in range(rng.randint(5, 30)):
+            word = list(rng.choice(CHARSET) for _ in range(rng.randint(1, 3)))
+            word.insert(rng.randint(0, len(word)), original)
+            word = "".join(word)
+            if word not in words:
+                words.add(word)
+                usecase.append(word)
+        dictionary.append({"no": len(dictionary) + 1, "original": original, "modified": modified, "usecase": usecase})
+    return dictionary
+
+
+def build_text(dictionary: List[Dict[str, Any]], length: int, seed: int = 1) -> str:
+    """產生約 length 字的測試文本，約一成內容來自字典詞彙，並夾雜斷詞符號"""
+    rng = random.Random(seed)
+    words = [word for item in dictionary for word in item["usecase"]]
+    pieces = []
+    total = 0
+    while total < length:
+        piece = rng.choice(words) if rng.random() < 0.1 else "".join(rng.choice(CHARSET) for _ in range(rng.randint(1, 4)))
+        pieces.append(piece)
+        total += len(piece) + 1
+    return "^".join(pieces)
+
+
+def legacy_replace(dictionary: List[Dict[str, Any]], text: str) -> Tuple[str, int]:
+    """舊版做法：每個詞彙各自 count 與 replace 整份文本"""
+    modified_text = text
+    replacements = 0
+    for item in dictionary:
+        for usecase_word in item["usecase"]:
+            count_before = modified_text.count(usecase_word)
+            if count_before > 0:
+                modified_text = modified_text.replace(usecase_word, usecase_word.replace(item["original"], item["modified"]))
+                replacements += count_before
+    return modified_text.replace("^", ""), replacements
+
+
+def main(word_count: int = 10000, text_length: int = 100000) -> None:
+    dictionary = build_dictionary(word_count)
+    text = build_text(dictionary, text_length)
+    print(f"字典：{len(dictionary)} 個條目，{sum(len(item['usecase']) for item in dictionary)} 個詞彙；文本：{len(text)} 字")
+
+    start = time.perf_counter()
+    _, legacy_count = legacy_replace(dictionary, text)
+    legacy_time = time.perf_counter() - start
+    print(f"逐詞替換：{legacy_time:.3f} 秒，替換 {legacy_count} 處")
+
+    replacer = HomophoneReplacer()
+    replacer.dictionary = dictionary
+    start = time.perf_counter()
+    replacer.build_matcher()
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, report = replacer.replace_homophones(text)
+    scan_time = time.perf_counter() - start
+    print(f"自動機編譯：{build_time:.3f} 秒")
+    print(f"單次掃描：{scan_time:.3f} 秒，替換 {sum(item['instances'] for item in report)} 處")
+    print(f"加速：{legacy_time / scan_time:.1f} 倍（含編譯 {legacy_time / (build_time + scan_time):.1f} 倍）")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,205 @@
+# modules/cue_builder.py
+"""
+字幕斷句模組 - 依據 Whisper 回傳的字詞時間戳，在本地重新組合字幕段落
+"""
+
+from typing import List, Dict, Optional
+
+# 句末標點：遇到時優先斷句
+SENTENCE_END_PUNCTUATION = set("。！？!?；;…")
+# 子句標點：字數超過上限時的次要斷點
+CLAUSE_PUNCTUATION = set("，、,：:")
+# 其他附著於前一個字詞的標點符號
+TRAILING_PUNCTUATION = SENTENCE_END_PUNCTUATION | CLAUSE_PUNCTUATION | set(".」』）)》\"'”’")
+
+
+def _is_cjk(char: str) -> bool:
+    """判斷字元是否為中日韓文字或全形符號"""
+    return '⺀' <= char <= '鿿' or '豈' <= char <= '﫿' or '＀' <= char <= '￯' or '　' <= char <= '〿'
+
+
+class CueBuilder:
+    """
+    字幕斷句器，將字詞級時間戳組合成字幕段落
+
+    斷句規則：
+    1. 每段字幕不超過 max_chars 個字元，超過時回退到最近的標點處斷開
+    2. 遇到句末標點且已達 min_chars 時直接斷句
+    3. 字詞之間的靜音超過 max_gap 秒時斷句
+    4. 每段字幕至少顯示 min_duration 秒（不與下一段重疊）
+    """
+
+    DEFAULT_LAYOUT = {
+        "max_chars": 18,
+        "min_chars": 4,
+        "min_duration": 1.0,
+        "max_duration": 6.0,
+        "max_gap": 1.0,
+    }
+
+    def __init__(self, max_chars: int = 18, min_chars: int = 4, min_duration: float = 1.0,
+                 max_duration: float = 6.0, max_gap: float = 1.0):
+        """初始化字幕斷句器
+
+        Args:
+            max_chars: 每段字幕的最大字元數
+            min_chars: 句末標點斷句所需的最小字元數
+            min_duration: 每段字幕的最短顯示時間（秒）
+            max_duration: 每段字幕的最長顯示時間（秒），0 表示不限制
+            max_gap: 字詞間超過此靜音長度（秒）即斷句
+        """
+        self.max_chars = max(1, int(max_chars))
+        self.min_chars = max(0, int(min_chars))
+        self.min_duration = max(0.0, float(min_duration))
+        self.max_duration = max(0.0, float(max_duration))
+        self.max_gap = max(0.0, float(max_gap))
+
+    @classmethod
+    def from_layout(cls, layout: Optional[Dict] = None) -> "CueBuilder":
+        """由版面參數字典建立斷句器，未提供的參數使用預設值"""
+        params = cls.DEFAULT_LAYOUT.copy()
+        if layout:
+            params.update({k: v for k, v in layout.items() if k in params and v is not None})
+        return cls(**params)
+
+    @staticmethod
+    def attach_punctuation(words: List[Dict], segments: Optional[List[Dict]] = None) -> List[Dict]:
+        """將段落文字中的標點符號附加回字詞
+
+        Whisper 的字詞時間戳不含標點，標點只存在於段落文字中。
+        此函數以游標方式在段落文字中定位每個字詞，並把字詞之間的標點附加到前一個字詞。
+
+        Args:
+            words: 字詞列表，每個元素包含 word、start、end
+            segments: 段落列表，每個元素包含 text
+
+        Returns:
+            字詞列表，每個元素包含 text、start、end
+        """
+        tokens = []
+        full_text = "".join(seg.get("text", "") for seg in segments) if segments else ""
+        lowered = full_text.lower()
+        cursor = 0
+
+        for word in words:
+            text = str(word.get("word", "")).strip()
+            if not text:
+                continue
+
+            if lowered:
+                pos = lowered.find(text.lower(), cursor)
+                # 只在鄰近位置搜尋，避免跳到後文的重複字詞
+                if pos != -1 and pos - cursor <= 20:
+                    punctuation = "".join(ch for ch in full_text[cursor:pos] if ch in TRAILING_PUNCTUATION)
+                    if punctuation and tokens:
+                        tokens[-1]["text"] += punctuation
+                    cursor = pos + len(text)
+
+            tokens.append({
+                "text": text,
+                "start": float(word.get("start", 0.0)),
+                "end": float(word.get("end", 0.0)),
+            })
+
+        # 最後一個字詞之後的標點
+        if tokens and cursor < len(full_text):
+            punctuation = "".join(ch for ch in full_text[cursor:] if ch in TRAILING_PUNCTUATION)
+            tokens[-1]["text"] += punctuation
+
+        return tokens
+
+    @staticmethod
+    def join_tokens(tokens: List[Dict]) -> str:
+        """組合字詞文字，英文字詞之間補上空格"""
+        text = ""
+        for token in tokens:
+            piece = token["text"]
+            if text and piece and not _is_cjk(text[-1]) and not _is_cjk(piece[0]) and piece[0] not in TRAILING_PUNCTUATION:
+                text += " "
+            text += piece
+        return text
+
+    def _split_point(self, tokens: List[Dict]) -> int:
+        """找出最後一個可斷句的標點位置，回傳斷點後的索引，找不到則回傳 0"""
+        for i in range(len(tokens) - 1, 0, -1):
+            if tokens[i - 1]["text"][-1] in SENTENCE_END_PUNCTUATION | CLAUSE_PUNCTUATION:
+                if len(self.join_tokens(tokens[:i])) >= self.min_chars:
+                    return i
+        return 0
+
+    def build_cues(self, tokens: List[Dict]) -> List[Dict]:
+        """依版面規則組合字幕段落
+
+        Args:
+            tokens: 已附加標點的字詞列表（attach_punctuation 的輸出）
+
+        Returns:
+            字幕段落列表，每個元素包含 start、end（秒）與 text
+        """
+        groups = []
+        current = []
+
+        for token in tokens:
+            if current and self.max_gap and token["start"] - current[-1]["end"] > self.max_gap:
+                groups.append(current)
+                current = []
+
+            if current and len(self.join_tokens(current + [token])) > self.max_chars:
+                split = self._split_point(current)
+                if split:
+                    groups.append(current[:split])
+                    current = current[split:]
+                else:
+                    groups.append(current)
+                    current = []
+
+            current.append(token)
+
+            length = len(self.join_tokens(current))
+            if token["text"][-1] in SENTENCE_END_PUNCTUATION and length >= self.min_chars:
+                groups.append(current)
+                current = []
+            elif self.max_duration and current[-1]["end"] - current[0]["start"] >= self.max_duration:
+                split = self._split_point(current)
+                if split and split < len(current):
+                    groups.append(current[:split])
+                    current = current[split:]
+                else:
+                    groups.append(current)
+                    current = []
+
+        if current:
+            groups.append(current)
+
+        cues = [
+            {"start": group[0]["start"], "end": max(group[-1]["end"], group[0]["start"]), "text": self.join_tokens(group)}
+            for group in groups
+        ]
+
+        # 延長過短的字幕，但不與下一段重疊
+        for i, cue in enumerate(cues):
+            if cue["end"] - cue["start"] < self.min_duration:
+                limit = cues[i + 1]["start"] if i + 1 < len(cues) else float("inf")
+                cue["end"] = max(cue["end"], min(cue["start"] + self.min_duration, limit))
+
+        return cues
+
+    def build_from_words(self, words_data: Dict) -> List[Dict]:
+        """由 Whisper verbose_json 結果直接建立字幕段落
+
+        Args:
+            words_data: 包含 words 與 segments 的字典
+
+        Returns:
+            字幕段落列表
+        """
+        words = words_data.get("words") or []
+        segments = words_data.get("segments") or []
+
+        # 沒有字詞時間戳時退回以段落為單位
+        if not words:
+            words = [{"word": seg.get("text", ""), "start": seg.get("start", 0.0), "end": seg.get("end", 0.0)} for seg in segments]
+            segments = []
+
+        tokens = self.attach_punctuation(words, segments)
+        return self.build_cues(tokens)
@@ -1,4 +1,5 @@
 import os
+import threading
 import time
 
 class FileManager:
@@ -6,10 +7,23 @@ class FileManager:
         """初始化 FileManager"""
         self.temp_dir = "temp"  # 相對路徑
         os.makedirs(self.temp_dir, exist_ok=True)
+        self._last_identifier = None
+        self._duplicates = 0
+        self._lock = threading.Lock()
         
     def create_identifier(self):
-        """創建時間戳識別碼"""
-        return time.strftime("%Y%m%d_%H%M%S")
+        """創建時間戳識別碼
+        
+        同一秒內多次建立時（例如批次並行處理多個檔案）加上序號，避免檔案互相覆蓋
+        """
+        with self._lock:
+            identifier = time.strftime("%Y%m%d_%H%M%S")
+            if identifier == self._last_identifier:
+                self._duplicates += 1
+                return f"{identifier}_{self._duplicates:02d}"
+            self._last_identifier = identifier
+            self._duplicates = 0
+            return identifier
     
     def get_file_path(self, identifier, step, file_type):
         """
@@ -24,6 +38,22 @@ class FileManager:
         filename = f"{identifier}_{step}_{file_type}"
         return os.path.join(self.temp_dir, filename)
     
+    def get_output_path(self, identifier, filename):
+        """
+        獲取以原始檔名命名的輸出檔案路徑
+        
+        輸出檔案放在識別碼專屬的目錄中，保留原始檔名供下載，
+        同名的輸入檔案同時處理時也不會互相覆蓋
+        Args:
+            identifier (str): 時間戳識別碼
+            filename (str): 輸出檔名，例如 "lecture.zip"
+        Returns:
+            str: 檔案的相對路徑
+        """
+        output_dir = os.path.join(self.temp_dir, identifier)
+        os.makedirs(output_dir, exist_ok=True)
+        return os.path.join(output_dir, filename)
+    
     def get_latest_file(self, step, file_type):
         """
         獲取特定步驟和類型的最新檔案
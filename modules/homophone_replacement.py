@@ -3,15 +3,36 @@
 import json
 import re
 import os
+import pickle
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any, Tuple
-import google.generativeai as genai
+from typing import List, Dict, Any, Tuple, Optional, Callable
+from modules.pattern_matcher import PatternMatcher
+from modules.word_segmenter import WordSegmenter
+from utils.rate_limiter import TokenBucket
+from utils.api_handler import RetryPolicy, call_with_retry, generate_content
+from utils.key_pool import parse_api_keys
+
+# 區塊切割符（單獨一行的 ---）
+BLOCK_SEPARATOR_PATTERN = re.compile(r'(^[ \t]*---[ \t]*$)', re.MULTILINE)
+
+# 編譯後字典檔的格式版本，格式變更時遞增以淘汰舊檔
+COMPILED_DICTIONARY_VERSION = 1
+
+# 行程內共用的已編譯字典：字典路徑 -> ((修改時間, 檔案大小), 替換器)
+_shared_replacers: Dict[str, Tuple[Tuple[int, int], "HomophoneReplacer"]] = {}
+_shared_lock = threading.Lock()
 
 class HomophoneReplacer:
     """
     多音字替換模組，用於處理中文多音字，確保TTS語音合成的準確性
     """
     
+    # 斷詞使用的 Gemini 模型
+    MODEL_NAME = "gemini-1.5-flash"
+    
     def __init__(self, dictionary_file=None):
         """
         初始化多音字替換器
@@ -21,6 +42,7 @@ class HomophoneReplacer:
         """
         # 預設字典
         self.dictionary = []
+        self.dictionary_hash = None
         
         # 如果提供了字典檔案，則載入
         if dictionary_file and os.path.exists(dictionary_file):
@@ -28,6 +50,149 @@ class HomophoneReplacer:
         else:
             # 載入內置字典
             self.load_built_in_dictionary()
+        
+        self.build_matcher()
+        self.build_segmenter()
+    
+    def build_matcher(self) -> None:
+        """
+        將字典中所有的使用詞彙編譯成一個多模式比對器
+        
+        同一個詞彙出現在多個條目時，以字典中較前面的條目為準。
+        """
+        self.matcher = PatternMatcher()
+        # 記錄每個詞彙所屬的字典條目，用於產生報告
+        self.word_owner = {}
+        
+        for position, item in enumerate(self.dictionary):
+            if 'usecase' in item and 'original' in item and 'modified' in item:
+                original = item['original']
+                modified = item['modified']
+                for usecase_word in item['usecase']:
+                    if self.matcher.add(usecase_word, usecase_word.replace(original, modified)):
+                        self.word_owner[usecase_word] = position
+        
+        self.matcher.build()
+    
+    def build_segmenter(self) -> None:
+        """
+        建立本地斷詞器，並將字典中所有的使用詞彙加入斷詞詞典，確保這些詞的邊界被保留
+        """
+        self.segmenter = WordSegmenter()
+        for item in self.dictionary:
+            if 'usecase' in item:
+                self.segmenter.add_words(item['usecase'])
+    
+    @classmethod
+    def load_shared(cls, dictionary_file: Optional[str] = None,
+                    cache_dir: Optional[str] = "temp/cache/dictionary") -> "HomophoneReplacer":
+        """
+        取得行程內共用的多音字替換器
+        
+        字典檔的修改時間與大小未改變時直接重用已編譯的替換器；
+        改變時以內容雜湊尋找磁碟上的編譯檔，找不到才重新編譯並寫入。
+        所有工作階段共用同一個實例，替換時只讀取不修改，可安全並行使用。
+        
+        Args:
+            dictionary_file (str, optional): 字典檔案路徑，如果未提供則使用預設詞庫
+            cache_dir (str, optional): 編譯後字典檔的存放目錄，None 表示不寫入磁碟
+            
+        Returns:
+            HomophoneReplacer: 已編譯的替換器
+        """
+        if not dictionary_file or not os.path.exists(dictionary_file):
+            with _shared_lock:
+                entry = _shared_replacers.get("")
+                if entry is None:
+                    entry = ((0, 0), cls())
+                    _shared_replacers[""] = entry
+                return entry[1]
+        
+        path = os.path.abspath(dictionary_file)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        
+        with _shared_lock:
+            entry = _shared_replacers.get(path)
+            if entry and entry[0] == signature:
+                return entry[1]
+            
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            
+            # 只有修改時間改變但內容相同時，沿用原本的替換器
+            if entry and entry[1].dictionary_hash == digest:
+                replacer = entry[1]
+            else:
+                replacer = cls._load_compiled(path, data, digest, cache_dir)
+            
+            _shared_replacers[path] = (signature, replacer)
+            return replacer
+    
+    @classmethod
+    def _load_compiled(cls, path: str, data: bytes, digest: str, cache_dir: Optional[str]) -> "HomophoneReplacer":
+        """
+        讀取或建立編譯後的字典檔
+        
+        Args:
+            path (str): 字典檔案路徑
+            data (bytes): 字典檔案內容
+            digest (str): 字典檔案內容的 SHA-256
+            cache_dir (str, optional): 編譯後字典檔的存放目錄
+            
+        Returns:
+            HomophoneReplacer: 已編譯的替換器
+        """
+        artifact_path = None
+        if cache_dir:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            artifact_path = os.path.join(cache_dir, f"{stem}.{digest[:16]}.pkl")
+        
+        replacer = cls.__new__(cls)
+        replacer.dictionary_hash = digest
+        
+        if artifact_path and os.path.exists(artifact_path):
+            try:
+                with open(artifact_path, 'rb') as f:
+                    artifact = pickle.load(f)
+                if artifact.get("version") == COMPILED_DICTIONARY_VERSION and artifact.get("sha256") == digest:
+                    replacer.dictionary = artifact["dictionary"]
+                    replacer.matcher = artifact["matcher"]
+                    replacer.word_owner = artifact["word_owner"]
+                    replacer.build_segmenter()
+                    print(f"Loaded compiled dictionary from {artifact_path}")
+                    return replacer
+            except Exception as e:
+                print(f"Error loading compiled dictionary, rebuilding: {e}")
+        
+        try:
+            replacer.dictionary = json.loads(data.decode('utf-8'))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            print(f"Invalid JSON format in dictionary file: {e}")
+            raise json.JSONDecodeError(f"Invalid JSON format in dictionary file", "", 0)
+        replacer.build_matcher()
+        replacer.build_segmenter()
+        print(f"Compiled dictionary from {path} ({len(replacer.matcher)} words)")
+        
+        if artifact_path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                temp_path = f"{artifact_path}.{os.getpid()}.tmp"
+                with open(temp_path, 'wb') as f:
+                    pickle.dump({
+                        "version": COMPILED_DICTIONARY_VERSION,
+                        "source": path,
+                        "sha256": digest,
+                        "dictionary": replacer.dictionary,
+                        "matcher": replacer.matcher,
+                        "word_owner": replacer.word_owner,
+                    }, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_path, artifact_path)
+            except OSError as e:
+                print(f"Error saving compiled dictionary: {e}")
+        
+        return replacer
     
     def load_dictionary(self, dictionary_file: str) -> None:
         """
@@ -99,37 +264,128 @@ class HomophoneReplacer:
             
         return batches
     
-    def process_with_google_ai(self, text_batches: List[str], api_key: str) -> str:
+    def process_locally(self, text: str) -> str:
+        """
+        使用本地斷詞器進行斷詞，不需要呼叫 API
+        
+        Args:
+            text (str): 預處理後的文本
+            
+        Returns:
+            str: 以 "^" 分隔的斷詞結果，移除分隔符號後與原文相同
+        """
+        return self.segmenter.segment(text)
+    
+    def process_with_google_ai(self, text_batches: List[str], api_key: str, max_concurrency: int = 16,
+                               requests_per_minute: int = 60, max_retries: int = 3) -> str:
         """
         使用Google AI處理文本批次，進行斷詞
         
+        批次會並行送出，結果依原始順序合併；遇到 429 或 5xx 錯誤時只重試該批次。
+        
         Args:
             text_batches (List[str]): 文本批次列表
             api_key (str): Google AI API金鑰
+            max_concurrency (int): 每把金鑰同時送出的批次數量上限（實際並行數由服務的 AIMD 控制器調整）
+            requests_per_minute (int): 每把金鑰每分鐘請求數上限
+            max_retries (int): 每個批次的最大重試次數
             
         Returns:
             str: 合併後的處理結果
         """
-        from prompts.zh_prompt import TEXT_SEGMENTATION_PROMPT
+        all_results = self.segment_batches_with_google_ai(
+            text_batches, api_key, max_concurrency, requests_per_minute, max_retries
+        )
+        
+        # 合併所有結果
+        return "\n\n".join(all_results)
+    
+    def segment_batches_with_google_ai(self, text_batches: List[str], api_key: str, max_concurrency: int = 16,
+                                       requests_per_minute: int = 60, max_retries: int = 3) -> List[str]:
+        """
+        並行送出斷詞批次，依原始順序返回每個批次的結果
         
-        # 配置Google AI
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("gemini-1.5-flash")
+        Args:
+            text_batches (List[str]): 文本批次列表
+            api_key (str): Google AI API金鑰
+            max_concurrency (int): 每把金鑰同時送出的批次數量上限（實際並行數由服務的 AIMD 控制器調整）
+            requests_per_minute (int): 每把金鑰每分鐘請求數上限
+            max_retries (int): 每個批次的最大重試次數
+            
+        Returns:
+            List[str]: 每個批次的斷詞結果
+        """
+        if not text_batches:
+            return []
+        
+        # 並行數與每分鐘請求數以每把金鑰計算，多把金鑰時依比例放大
+        key_count = max(1, len(parse_api_keys(api_key)))
+        limiter = TokenBucket(rate=requests_per_minute * key_count / 60, capacity=max_concurrency * key_count)
         
-        all_results = []
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency * key_count)) as executor:
+            # executor.map 依輸入順序回傳結果，任一批次最終失敗時拋出例外
+            return list(executor.map(
+                lambda args: self._segment_batch(api_key, args[0], args[1], limiter, max_retries),
+                enumerate(text_batches, 1)
+            ))
+    
+    def segment_blocks_with_google_ai(self, blocks: List[str], api_key: str) -> List[str]:
+        """
+        使用Google AI對多個區塊斷詞，所有區塊的批次一起並行送出
         
-        for batch in text_batches:
-            # 準備提示詞
-            prompt = TEXT_SEGMENTATION_PROMPT.format(article=batch)
+        Args:
+            blocks (List[str]): 區塊文本列表
+            api_key (str): Google AI API金鑰
             
-            # 呼叫API
-            response = model.generate_content(prompt)
+        Returns:
+            List[str]: 每個區塊的斷詞結果
+        """
+        text_batches = []
+        owners = []
+        for position, block in enumerate(blocks):
+            for batch in self.segment_text(block, batch_size=10):
+                text_batches.append(batch)
+                owners.append(position)
+        
+        results = self.segment_batches_with_google_ai(text_batches, api_key)
+        
+        outputs = [[] for _ in blocks]
+        for owner, result in zip(owners, results):
+            outputs[owner].append(result)
+        return ["\n\n".join(parts) for parts in outputs]
+    
+    def _segment_batch(self, api_key: str, batch_number: int, batch: str, limiter: TokenBucket, max_retries: int) -> str:
+        """
+        送出單一斷詞批次，遇到 429、5xx 或網路錯誤時依統一的重試策略重試
+        
+        Args:
+            api_key (str): Google AI API金鑰（多把金鑰以逗號分隔）
+            batch_number (int): 批次序號（僅用於日誌）
+            batch (str): 批次文本
+            limiter (TokenBucket): 共用的限流器
+            max_retries (int): 最大重試次數
             
-            # 添加結果
-            all_results.append(response.text)
+        Returns:
+            str: 斷詞結果
+        """
+        from prompts.zh_prompt import TEXT_SEGMENTATION_PROMPT
         
-        # 合併所有結果
-        return "\n\n".join(all_results)
+        # 準備提示詞
+        prompt = TEXT_SEGMENTATION_PROMPT.format(article=batch)
+        
+        try:
+            # 呼叫API
+            return call_with_retry(
+                "google_ai",
+                lambda key: generate_content(prompt, key, self.MODEL_NAME).text,
+                label=f"Segmentation batch {batch_number}",
+                policy=RetryPolicy(max_retries=max_retries),
+                limiter=limiter,
+                api_keys=api_key
+            )
+        except Exception as e:
+            print(f"Segmentation batch {batch_number} failed: {e}")
+            raise
     
     def replace_homophones(self, text: str) -> Tuple[str, List[Dict[str, Any]]]:
         """
@@ -144,29 +400,21 @@ class HomophoneReplacer:
         if not text or not self.dictionary:
             return text, []
         
-        modified_text = text
-        report = []
+        # 一次掃描找出所有詞彙（最左最長），替換結果不會影響其他詞彙的比對
+        modified_text, counts = self.matcher.replace(text)
         
-        for item in self.dictionary:
+        # 依字典順序產生報告
+        report = []
+        for position, item in enumerate(self.dictionary):
             if 'usecase' in item and 'original' in item and 'modified' in item:
-                original = item['original']
-                modified = item['modified']
                 for usecase_word in item['usecase']:
-                    # 計算替換前出現次數
-                    count_before = modified_text.count(usecase_word)
-                    if count_before > 0:
-                        # 進行替換
-                        modified_text = modified_text.replace(
-                            usecase_word, 
-                            usecase_word.replace(original, modified)
-                        )
-                        
+                    if counts.get(usecase_word) and self.word_owner.get(usecase_word) == position:
                         # 將替換資訊添加到報告中
                         report.append({
-                            "original": original,
-                            "modified": modified,
+                            "original": item['original'],
+                            "modified": item['modified'],
                             "word": usecase_word,
-                            "instances": count_before
+                            "instances": counts.pop(usecase_word)
                         })
         
         # 移除斷詞符號
@@ -174,6 +422,79 @@ class HomophoneReplacer:
         
         return final_text, report
     
+    def replace_blocks(self, text: str, segment_blocks: Callable[[List[str]], List[str]],
+                       previous_blocks: Optional[Dict[str, Dict[str, Any]]] = None
+                       ) -> Tuple[str, List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        """
+        以 --- 切割區塊，逐區塊斷詞與替換；內容未改變的區塊沿用上次的結果
+        
+        Args:
+            text (str): 輸入文本
+            segment_blocks (Callable): 斷詞函式，輸入區塊列表，返回以 "^" 分隔的斷詞結果列表
+            previous_blocks (Dict, optional): 上次的區塊結果，鍵為區塊原文
+            
+        Returns:
+            tuple: (替換後的文本, 合併後的替換報告, 本次的區塊結果)
+        """
+        previous_blocks = previous_blocks or {}
+        # 奇數位置為切割符本身，原樣保留
+        pieces = BLOCK_SEPARATOR_PATTERN.split(text)
+        
+        cores = {}
+        for piece in pieces[::2]:
+            core = piece.strip()
+            if core and core not in previous_blocks:
+                cores[core] = None
+        
+        # 只對改變過的區塊斷詞
+        changed = list(cores)
+        if changed:
+            for core, segmented in zip(changed, segment_blocks(changed)):
+                replaced, report = self.replace_homophones(segmented)
+                cores[core] = {"output": replaced, "report": report}
+        unique = {piece.strip() for piece in pieces[::2] if piece.strip()}
+        print(f"Step 2 blocks: {len(changed)} processed, {len(unique) - len(changed)} reused")
+        
+        blocks = {}
+        output = []
+        reports = []
+        for position, piece in enumerate(pieces):
+            core = piece.strip()
+            if position % 2 or not core:
+                output.append(piece)
+                continue
+            
+            result = cores.get(core) or previous_blocks[core]
+            blocks[core] = result
+            
+            # 保留區塊前後的空白與換行
+            start = piece.index(core)
+            output.append(piece[:start] + result["output"] + piece[start + len(core):])
+            reports.append(result["report"])
+        
+        return "".join(output), self.merge_reports(reports), blocks
+    
+    @staticmethod
+    def merge_reports(reports: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """
+        合併多個區塊的替換報告，同一個詞的次數相加
+        
+        Args:
+            reports (List[List[Dict]]): 各區塊的替換報告
+            
+        Returns:
+            List[Dict]: 合併後的替換報告
+        """
+        merged = {}
+        for report in reports:
+            for item in report:
+                key = (item["original"], item["modified"], item["word"])
+                if key in merged:
+                    merged[key]["instances"] += item["instances"]
+                else:
+                    merged[key] = dict(item)
+        return list(merged.values())
+    
     def get_replacement_report(self, report: List[Dict[str, Any]]) -> str:
         """
         生成人類可讀的替換報告
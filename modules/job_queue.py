@@ -0,0 +1,357 @@
+# modules/job_queue.py
+"""
+背景工作佇列 - 將一鍵處理拆成可恢復的階段與逐段任務，由共用的工作池在背景執行，
+介面只需提交工作並查詢狀態
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional
+
+from modules.homophone_replacement import HomophoneReplacer
+from modules.pipeline import CueGrouper, correct_group, get_correction_limiter, save_outputs, transcribe_segment
+from modules.srt_generator import SRTGenerator
+from modules.subtitle_corrector import SubtitleCorrector
+from modules.text_preprocessing import preprocess_text, split_segments
+from modules.tts_generator import TTSGenerator, TTSGenerationError
+from utils.job_store import DONE, FAILED, PAUSED, QUEUED, RUNNING, JobStore
+
+# 工作類型
+AUTO_PROCESS = "auto_process"
+# 一鍵處理工作的階段（依執行順序）
+AUTO_PROCESS_STAGES = ("preprocess", "tts", "transcribe", "correct", "package")
+# 執行工作所需的 API 金鑰
+API_KEY_NAMES = ("google", "tts", "whisper", "gemini")
+
+
+class JobError(Exception):
+    """背景工作執行過程中的錯誤"""
+    pass
+
+
+class JobManager:
+    """
+    背景工作管理器
+
+    每個工作由一個執行緒依序推進各階段，階段內的任務交給所有工作共用的任務池並行執行，
+    每個任務開始、完成或失敗時都寫入 JobStore。語音生成與轉錄以段落為單位串接：
+    一個段落的音檔完成後立即轉錄，不等待其他段落。
+    工作中斷（程式重新啟動）或失敗後，以 resume 重新執行時只處理尚未完成的任務。
+    API 金鑰只保存在記憶體中，因此程式重新啟動後的工作會暫停，等待使用者提供金鑰。
+    """
+
+    def __init__(self, store: JobStore, file_manager, dictionary_path: Optional[str] = None,
+                 max_jobs: int = 4, max_workers: int = 32, group_cues: int = 30):
+        """初始化管理器，並將上次中斷的工作標記為暫停
+
+        Args:
+            store: 工作儲存
+            file_manager: 檔案管理器
+            dictionary_path: 多音字字典路徑
+            max_jobs: 同時執行的工作數量上限
+            max_workers: 所有工作共用的任務執行緒數（實際 API 並行數仍由各服務的並行控制器決定）
+            group_cues: 每組校正的字幕數量下限
+        """
+        self.store = store
+        self.file_manager = file_manager
+        self.dictionary_path = dictionary_path
+        self.group_cues = group_cues
+        self._job_pool = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="job")
+        self._task_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-task")
+        self._api_keys: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+
+        paused = store.recover_interrupted()
+        if paused:
+            print(f"{len(paused)} 個背景工作在上次執行時中斷，已暫停等待繼續: {', '.join(paused)}")
+
+    # ------------------------------------------------------------------
+    # 提交與查詢
+    # ------------------------------------------------------------------
+
+    def submit(self, transcript_file: str, settings: Dict[str, Any], api_keys: Dict[str, str]) -> str:
+        """提交一鍵處理工作
+
+        逐字稿內容會複製到工作參數中，之後不再依賴上傳的暫存檔。
+
+        Args:
+            transcript_file: 逐字稿檔案路徑
+            settings: 處理設定（language、voice_name、emotion、speed、custom_pronunciation、batch_size）
+            api_keys: API 金鑰，鍵為 API_KEY_NAMES
+
+        Returns:
+            工作編號
+        """
+        with open(transcript_file, "r", encoding="utf-8") as f:
+            text = f.read()
+        if not text.strip():
+            raise JobError(f"逐字稿文件為空: {os.path.basename(transcript_file)}")
+        self._check_keys(api_keys)
+
+        params = dict(settings,
+                      filename=os.path.basename(transcript_file),
+                      text=text,
+                      identifier=self.file_manager.create_identifier())
+        job_id = self.store.create_job(AUTO_PROCESS, params)
+        self._start(job_id, api_keys)
+        return job_id
+
+    def resume(self, job_id: str, api_keys: Dict[str, str]) -> str:
+        """以提供的金鑰繼續暫停或失敗的工作
+
+        Returns:
+            結果訊息
+        """
+        job = self.store.get_job(job_id)
+        if not job:
+            return f"找不到工作: {job_id}"
+        if job["status"] not in (PAUSED, FAILED):
+            return f"工作 {job_id} 目前為 {job['status']}，不需要繼續"
+        self._check_keys(api_keys)
+        self._start(job_id, api_keys)
+        return f"工作 {job_id} 已重新排入佇列"
+
+    def resume_all(self, api_keys: Dict[str, str]) -> List[str]:
+        """以提供的金鑰繼續所有暫停的工作
+
+        Returns:
+            重新排入佇列的工作編號
+        """
+        self._check_keys(api_keys)
+        job_ids = [job["id"] for job in self.store.list_jobs([PAUSED], limit=1000)]
+        for job_id in job_ids:
+            self._start(job_id, api_keys)
+        return job_ids
+
+    def describe(self, job: Dict[str, Any]) -> str:
+        """工作的一行摘要：狀態與各階段完成的任務數"""
+        counts = self.store.task_counts(job["id"])
+        progress = []
+        for stage in AUTO_PROCESS_STAGES:
+            stage_counts = counts.get(stage)
+            if stage_counts:
+                progress.append(f"{stage} {stage_counts.get(DONE, 0)}/{sum(stage_counts.values())}")
+        line = f"{job['id']} {job['params'].get('filename', '')}: {job['status']}"
+        if progress:
+            line += f"（{'，'.join(progress)}）"
+        if job["error"]:
+            line += f" - {job['error']}"
+        return line
+
+    @staticmethod
+    def _check_keys(api_keys: Dict[str, str]) -> None:
+        missing = [name for name in API_KEY_NAMES if not (api_keys.get(name) or "").strip()]
+        if missing:
+            raise JobError(f"缺少 API 金鑰: {', '.join(missing)}")
+
+    def _start(self, job_id: str, api_keys: Dict[str, str]) -> None:
+        """將工作排入執行佇列（已在執行中的工作不會重複排入）"""
+        with self._lock:
+            if job_id in self._api_keys:
+                return
+            self._api_keys[job_id] = dict(api_keys)
+        self.store.set_job_status(job_id, QUEUED)
+        self._job_pool.submit(self._run, job_id)
+
+    # ------------------------------------------------------------------
+    # 執行
+    # ------------------------------------------------------------------
+
+    def _run(self, job_id: str) -> None:
+        """執行一個工作，結束後釋放記憶體中的金鑰"""
+        try:
+            job = self.store.get_job(job_id)
+            self.store.set_job_status(job_id, RUNNING)
+            print(f"背景工作 {job_id} 開始執行: {job['params'].get('filename', '')}")
+            result = self._run_auto_process(job, self._api_keys[job_id])
+            self.store.set_job_status(job_id, DONE, result=result)
+            print(f"背景工作 {job_id} 完成")
+        except Exception as e:
+            print(f"背景工作 {job_id} 失敗: {e}")
+            self.store.set_job_status(job_id, FAILED, error=str(e))
+        finally:
+            with self._lock:
+                self._api_keys.pop(job_id, None)
+
+    def _run_task(self, job_id: str, stage: str, number: int, handler: Callable[[int, Any], Any],
+                  payload: Any) -> Any:
+        """執行單一任務並記錄狀態"""
+        self.store.update_task(job_id, stage, number, RUNNING)
+        try:
+            result = handler(number, payload)
+        except Exception as e:
+            self.store.update_task(job_id, stage, number, FAILED, error=str(e))
+            raise
+        self.store.update_task(job_id, stage, number, DONE, result=result)
+        return result
+
+    def _run_stage(self, job_id: str, stage: str, payloads: List[Any],
+                   handler: Callable[[int, Any], Any]) -> List[Any]:
+        """建立階段的任務並以任務池並行執行尚未完成的部分
+
+        Returns:
+            依編號排列的任務結果
+
+        Raises:
+            JobError: 有任務失敗（其他任務仍會完成並保存）
+        """
+        self.store.sync_tasks(job_id, stage, payloads)
+        self.store.set_stage(job_id, stage, RUNNING)
+        tasks = self.store.get_tasks(job_id, stage)
+        results = {task["number"]: task["result"] for task in tasks if task["status"] == DONE}
+
+        futures = {
+            self._task_pool.submit(self._run_task, job_id, stage, task["number"], handler, task["payload"]): task["number"]
+            for task in tasks if task["status"] != DONE
+        }
+        errors = []
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                errors.append(f"任務 {futures[future] + 1}: {e}")
+
+        if errors:
+            self.store.set_stage(job_id, stage, FAILED)
+            raise JobError(f"{stage} 階段有 {len(errors)} 個任務失敗，{errors[0]}")
+        self.store.set_stage(job_id, stage, DONE)
+        return [results[task["number"]] for task in tasks]
+
+    def _run_segments(self, job_id: str, texts: List[str], synthesize: Callable[[int, Any], Any],
+                      transcribe: Callable[[int, Any], Any]) -> List[Dict[str, Any]]:
+        """逐段執行語音生成與轉錄：每個段落的音檔完成後立即轉錄
+
+        語音任務已完成但音檔已被刪除時重新生成。
+
+        Returns:
+            每個段落的 {"mp3", "entries", "duration"}
+        """
+        self.store.sync_tasks(job_id, "tts", [{"text": text} for text in texts])
+        self.store.sync_tasks(job_id, "transcribe", [None] * len(texts))
+        self.store.set_stage(job_id, "tts", RUNNING)
+        self.store.set_stage(job_id, "transcribe", RUNNING)
+        tts_tasks = self.store.get_tasks(job_id, "tts")
+        transcribe_tasks = self.store.get_tasks(job_id, "transcribe")
+
+        def flow(number):
+            tts_task, transcribe_task = tts_tasks[number], transcribe_tasks[number]
+            audio = tts_task["result"]
+            if tts_task["status"] != DONE or not (audio and os.path.exists(audio["mp3"])):
+                audio = self._run_task(job_id, "tts", number, synthesize, tts_task["payload"])
+                transcribe_task["status"] = None
+            transcript = transcribe_task["result"]
+            if transcribe_task["status"] != DONE:
+                transcript = self._run_task(job_id, "transcribe", number, transcribe, audio)
+            return dict(audio, **transcript)
+
+        futures = {self._task_pool.submit(flow, number): number for number in range(len(texts))}
+        results, errors = {}, []
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                errors.append(f"段落 {futures[future] + 1}: {e}")
+
+        stage_status = FAILED if errors else DONE
+        self.store.set_stage(job_id, "tts", stage_status)
+        self.store.set_stage(job_id, "transcribe", stage_status)
+        if errors:
+            raise JobError(f"語音生成或轉錄有 {len(errors)} 個段落失敗，{errors[0]}")
+        return [results[number] for number in range(len(texts))]
+
+    def _run_auto_process(self, job: Dict[str, Any], api_keys: Dict[str, str]) -> Dict[str, Any]:
+        """執行一鍵處理工作的各階段
+
+        Returns:
+            工作結果：zip（音頻ZIP路徑）、srt（字幕檔路徑）、log（日誌訊息）
+        """
+        job_id, params = job["id"], job["params"]
+        identifier = params["identifier"]
+        language = params.get("language", "zh")
+        replacer = HomophoneReplacer.load_shared(self.dictionary_path)
+
+        # 階段1：預處理與多音字替換（單一任務，完成後保存所有分段）
+        def preprocess(number, payload):
+            processed_text = preprocess_text(params["text"], language, api_keys["google"],
+                                             use_rules=(language == "zh"))
+            segments = []
+            for text in split_segments(processed_text):
+                replaced, report = replacer.replace_homophones(replacer.process_locally(text))
+                segments.append({"text": text, "replaced": replaced, "report": report})
+            if not segments:
+                raise JobError("預處理後沒有任何分段")
+            return {"segments": segments}
+
+        segments = self._run_stage(job_id, "preprocess", [None], preprocess)[0]["segments"]
+
+        # 階段2、3：語音生成與轉錄
+        audio_output_dir = self.file_manager.get_file_path(identifier, "step3", "audio")
+        os.makedirs(audio_output_dir, exist_ok=True)
+        tts_generator = TTSGenerator(api_keys["tts"], output_dir=audio_output_dir)
+        voice_settings = tts_generator.build_voice_settings(params.get("voice_name", "訓練長"),
+                                                            params.get("emotion", "neutral"),
+                                                            float(params.get("speed", 1.0)))
+        if not tts_generator.test_api_connection():
+            raise TTSGenerationError("無法連接到 Hailuo API，請檢查網絡和 API 密鑰")
+        # 有自定義發音詞條時編譯發音字典，每個段落只送出實際出現的詞條
+        pronunciation_matcher = None
+        if (params.get("custom_pronunciation") or "").strip():
+            pronunciation_matcher = tts_generator.compile_pronunciation_dict(params["custom_pronunciation"])
+        srt_generator = SRTGenerator()
+
+        def synthesize(number, payload):
+            return {"mp3": str(tts_generator.synthesize_segment(number + 1, payload["text"], voice_settings,
+                                                                pronunciation_matcher))}
+
+        def transcribe(number, audio):
+            entries, duration = transcribe_segment(srt_generator, audio["mp3"], api_keys["whisper"], language)
+            return {"entries": entries, "duration": duration}
+
+        audio_results = self._run_segments(job_id, [segment["replaced"] for segment in segments],
+                                           synthesize, transcribe)
+
+        # 階段4：依段落順序組合字幕並分組校正
+        # 恢復時重新生成或轉錄過的段落可能改變分組，內容不同的校正任務會重設後重新執行
+        grouper = CueGrouper(srt_generator, self.group_cues)
+        groups = []
+        for segment, audio in zip(segments, audio_results):
+            segment["mp3"] = audio["mp3"]
+            group = grouper.add(segment["text"], audio["entries"], audio["duration"])
+            if group:
+                groups.append(group)
+        group = grouper.flush()
+        if group:
+            groups.append(group)
+        if not grouper.initial_cues:
+            raise JobError("字幕生成失敗：未能從音頻中提取文字")
+
+        corrector = SubtitleCorrector(api_keys["gemini"])
+        limiter = get_correction_limiter(api_keys["gemini"])
+        batch_size = params.get("batch_size")
+        batch_size = None if batch_size in (None, "自動") else int(batch_size)
+
+        def correct(number, payload):
+            # JSON 會將字幕編號轉為字串，執行前轉回整數
+            group = dict(payload, cues={int(key): cue for key, cue in payload["cues"].items()})
+            return correct_group(corrector, group, batch_size, limiter)
+
+        corrections = self._run_stage(job_id, "correct", groups, correct)
+
+        # 階段5：保存結果
+        corrected_cues, reports = {}, []
+        for correction in corrections:
+            corrected_cues.update({int(key): cue for key, cue in correction["cues"].items()})
+            reports.extend(correction["reports"])
+        result = {
+            "segments": segments,
+            "initial_cues": grouper.initial_cues,
+            "corrected_cues": corrected_cues,
+            "reports": reports,
+        }
+        base_filename = os.path.splitext(params.get("filename") or identifier)[0]
+        self.store.set_stage(job_id, "package", RUNNING)
+        zip_path, subtitle_file, log_messages = save_outputs(self.file_manager, identifier, base_filename,
+                                                             result, replacer)
+        self.store.set_stage(job_id, "package", DONE)
+        return {"zip": zip_path, "srt": subtitle_file, "log": log_messages}
@@ -3,15 +3,18 @@
 OpenAI 客戶端工具 - 提供統一的 OpenAI 客戶端創建方法
 """
 
+from utils.api_handler import get_openai_client as _get_pooled_client
+
 def get_openai_client(api_key):
     """
     獲取統一的 OpenAI 客戶端
     
+    同一金鑰共用同一個客戶端（及其連線池），重試由 utils.api_handler.call_with_retry 統一處理。
+    
     Args:
         api_key: OpenAI API 金鑰
         
     Returns:
         OpenAI 客戶端實例
     """
-    from openai import OpenAI
-    return OpenAI(api_key=api_key)
\ No newline at end of file
+    return _get_pooled_client(api_key)
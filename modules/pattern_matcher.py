@@ -0,0 +1,145 @@
+# modules/pattern_matcher.py
+"""
+多模式字串比對模組 - 以 Aho-Corasick 自動機一次掃描找出所有詞彙
+"""
+
+from collections import deque
+from typing import Any, Dict, List, Tuple
+
+
+class PatternMatcher:
+    """
+    Aho-Corasick 多模式比對器
+
+    將所有詞彙編譯成一個自動機，只需掃描文本一次即可找出所有出現位置；
+    重疊的候選以「最左最長」規則取捨，並在一次輸出中完成所有替換。
+    內部狀態只使用基本型別（dict / list / tuple），可直接序列化。
+    """
+
+    def __init__(self):
+        """初始化空的比對器"""
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # 每個狀態結束的詞彙長度（含失敗鏈上的詞彙），由長到短排列
+        self._outputs: List[Tuple[int, ...]] = [()]
+        self._values: Dict[str, Any] = {}
+        self._built = False
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __contains__(self, pattern: str) -> bool:
+        return pattern in self._values
+
+    def get(self, pattern: str, default: Any = None) -> Any:
+        """取得詞彙對應的值"""
+        return self._values.get(pattern, default)
+
+    def add(self, pattern: str, value: Any) -> bool:
+        """加入一個詞彙
+
+        同一個詞彙重複加入時保留第一次的值。
+
+        Args:
+            pattern: 要比對的詞彙
+            value: 比對到時回傳的值（例如替換後的文字）
+
+        Returns:
+            是否為新加入的詞彙
+        """
+        if not pattern or pattern in self._values:
+            return False
+
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append(())
+            state = next_state
+
+        self._outputs[state] = (len(pattern),)
+        self._values[pattern] = value
+        self._built = False
+        return True
+
+    def build(self) -> "PatternMatcher":
+        """以廣度優先建立失敗連結，並合併失敗鏈上的輸出"""
+        queue = deque()
+        for state in self._goto[0].values():
+            self._fail[state] = 0
+            queue.append(state)
+
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                merged = set(self._outputs[next_state]) | set(self._outputs[self._fail[next_state]])
+                self._outputs[next_state] = tuple(sorted(merged, reverse=True))
+
+        self._built = True
+        return self
+
+    def find_all(self, text: str) -> List[Tuple[int, int, str]]:
+        """找出文本中所有不重疊的詞彙（最左最長）
+
+        Args:
+            text: 要掃描的文本
+
+        Returns:
+            比對結果列表，每個元素為 (起始位置, 結束位置, 詞彙)，依位置排序
+        """
+        if not self._built:
+            self.build()
+
+        goto = self._goto
+        fail = self._fail
+        outputs = self._outputs
+
+        # 記錄每個起始位置可比對到的最長詞彙長度
+        longest = {}
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length in outputs[state]:
+                start = i - length + 1
+                if longest.get(start, 0) < length:
+                    longest[start] = length
+
+        matches = []
+        position = 0
+        for start in sorted(longest):
+            if start >= position:
+                end = start + longest[start]
+                matches.append((start, end, text[start:end]))
+                position = end
+        return matches
+
+    def replace(self, text: str) -> Tuple[str, Dict[str, int]]:
+        """一次替換文本中所有比對到的詞彙
+
+        Args:
+            text: 要處理的文本
+
+        Returns:
+            (替換後的文本, 每個詞彙的替換次數)
+        """
+        pieces = []
+        counts: Dict[str, int] = {}
+        position = 0
+        for start, end, pattern in self.find_all(text):
+            pieces.append(text[position:start])
+            pieces.append(self._values[pattern])
+            counts[pattern] = counts.get(pattern, 0) + 1
+            position = end
+        pieces.append(text[position:])
+        return "".join(pieces), counts
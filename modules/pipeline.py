@@ -0,0 +1,530 @@
+# modules/pipeline.py
+"""
+串流處理管線 - 以有界佇列串接多音字替換、語音生成、Whisper 轉錄與字幕校正，
+每個段落完成一個階段就立即交給下一個階段，不必等待全部段落
+"""
+
+import os
+import queue
+import threading
+import time
+import zipfile
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from modules.homophone_replacement import HomophoneReplacer
+from modules.srt_generator import SRTGenerator
+from modules.subtitle_corrector import SubtitleCorrector
+from modules.tts_generator import TTSGenerator
+from utils.key_pool import parse_api_keys
+from utils.rate_limiter import TokenBucket
+
+# 佇列結束標記
+_DONE = object()
+
+# 使用同一組 Gemini 金鑰的所有管線（例如批次中同時處理的多個檔案）共用校正速率限制器
+_correction_limiters: Dict[Tuple[str, ...], TokenBucket] = {}
+_limiter_lock = threading.Lock()
+
+
+def get_correction_limiter(api_key: str, requests_per_minute: int = 60, capacity: int = 16) -> TokenBucket:
+    """取得一組金鑰共用的字幕校正速率限制器（第一次使用時建立）
+
+    Args:
+        api_key: Gemini API 金鑰（多把金鑰以逗號分隔）
+        requests_per_minute: 每把金鑰每分鐘請求數上限
+        capacity: 每把金鑰允許的突發請求數
+
+    Returns:
+        令牌桶限流器
+    """
+    keys = tuple(sorted(parse_api_keys(api_key)))
+    with _limiter_lock:
+        limiter = _correction_limiters.get(keys)
+        if limiter is None:
+            count = max(1, len(keys))
+            limiter = TokenBucket(rate=requests_per_minute * count / 60, capacity=capacity * count)
+            _correction_limiters[keys] = limiter
+        return limiter
+
+
+def format_cues(cues: Dict[int, Dict]) -> str:
+    """將字幕數據字典（parse_srt 格式）依編號格式化為 SRT 文字"""
+    return "".join(f"{index}\n{cue['time']}\n{cue['text']}\n\n" for index, cue in sorted(cues.items()))
+
+
+def save_outputs(file_manager, identifier: str, base_filename: str, result: Dict[str, Any],
+                 replacer: Optional[HomophoneReplacer] = None) -> Tuple[str, str, List[str]]:
+    """保存處理結果，檔案與逐步操作時各步驟產生的檔案相同
+
+    音頻 ZIP 與校正後的字幕以原始檔案名稱命名。
+
+    Args:
+        file_manager: 檔案管理器
+        identifier: 處理識別碼
+        base_filename: 原始檔案名稱（不含副檔名）
+        result: StreamingPipeline.run 返回的結果字典
+        replacer: 用於產生替換報告的多音字替換器
+
+    Returns:
+        (音頻ZIP路徑, 字幕檔路徑, 日誌訊息列表)
+    """
+    log_messages = []
+    segments = result["segments"]
+    processed_text = "\n---\n".join(segment["text"] for segment in segments)
+    modified_text = "\n---\n".join(segment["replaced"] for segment in segments)
+    mp3_files = [segment["mp3"] for segment in segments]
+
+    with open(file_manager.get_file_path(identifier, "step1", "preprocessed.txt"), "w", encoding="utf-8") as f:
+        f.write(processed_text)
+    log_messages.append(f"處理後文本長度: {len(processed_text)} 字符，共 {len(segments)} 段")
+
+    replacement_report = "未進行任何多音字替換"
+    if replacer:
+        replacement_report = replacer.get_replacement_report(
+            replacer.merge_reports([segment["report"] for segment in segments])
+        )
+    with open(file_manager.get_file_path(identifier, "step2", "replaced.txt"), "w", encoding="utf-8") as f:
+        f.write(modified_text)
+    with open(file_manager.get_file_path(identifier, "step2", "report.txt"), "w", encoding="utf-8") as f:
+        f.write(replacement_report)
+
+    with open(file_manager.get_file_path(identifier, "step3", "transcript.txt"), "w", encoding="utf-8") as f:
+        f.write(modified_text)
+
+    # 以原始檔案名稱打包音頻（放在識別碼專屬的目錄，同名檔案並行處理時不互相覆蓋）
+    zip_path = file_manager.get_output_path(identifier, f"{base_filename}.zip")
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        for mp3_file in mp3_files:
+            zipf.write(mp3_file, os.path.basename(mp3_file))
+    log_messages.append(f"生成了 {len(mp3_files)} 個音頻文件，打包為: {os.path.basename(zip_path)}")
+
+    with open(file_manager.get_file_path(identifier, "step4", "initial_subtitle.srt"), "w", encoding="utf-8") as f:
+        f.write(format_cues(result["initial_cues"]))
+
+    # 以原始檔案名稱保存校正後的字幕
+    subtitle_file = file_manager.get_output_path(identifier, f"{base_filename}.srt")
+    with open(subtitle_file, "w", encoding="utf-8") as f:
+        f.write(format_cues(result["corrected_cues"]))
+    with open(file_manager.get_file_path(identifier, "step4", "correction_report.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(result["reports"]) if result["reports"] else "沒有進行任何修改")
+    log_messages.append(f"共 {len(result['corrected_cues'])} 條字幕，保存為: {os.path.basename(subtitle_file)}")
+    return zip_path, subtitle_file, log_messages
+
+
+class CueGrouper:
+    """
+    依段落順序組合字幕時間軸，並切成校正用的字幕組
+
+    每段的字幕依累計的音檔長度平移並重新編號，結果累積在 initial_cues；
+    每累積 group_cues 條字幕（在段落邊界切開）產生一組，並附上前一組最後 context_cues 條
+    （未校正的）字幕與最後一段原文作為上下文。相同的輸入一定切出相同的字幕組。
+    """
+
+    def __init__(self, srt_generator: SRTGenerator, group_cues: int = 30, context_cues: int = 2):
+        """初始化
+
+        Args:
+            srt_generator: 提供時間格式轉換的字幕生成器
+            group_cues: 每組字幕數量下限
+            context_cues: 每組附帶的前文字幕數
+        """
+        self.srt_generator = srt_generator
+        self.group_cues = group_cues
+        self.context_cues = context_cues
+        self.initial_cues: Dict[int, Dict] = {}
+        self._offset_ms = 0
+        self._next_index = 1
+        self._group: Dict[int, Dict] = {}
+        self._group_texts: List[str] = []
+        self._context: Dict[int, Dict] = {}
+        self._context_text = ""
+
+    def add(self, text: str, entries: List[Dict], duration: float) -> Optional[Dict]:
+        """加入下一個段落的字幕
+
+        Args:
+            text: 段落原文（作為校正用的逐字稿）
+            entries: SRTGenerator.parse_srt 格式的段落字幕（時間從段落開頭起算）
+            duration: 段落音檔長度（秒），0 表示未知
+
+        Returns:
+            累積足夠字幕時返回一組待校正的字幕，否則為 None
+        """
+        ms_to_time = self.srt_generator.ms_to_time
+        time_to_ms = self.srt_generator.time_to_ms
+        end_ms = self._offset_ms
+        for entry in entries:
+            start = time_to_ms(entry["start_time"]) + self._offset_ms
+            end = time_to_ms(entry["end_time"]) + self._offset_ms
+            cue = {"time": f"{ms_to_time(start)} --> {ms_to_time(end)}", "text": entry["text"]}
+            self.initial_cues[self._next_index] = cue
+            self._group[self._next_index] = dict(cue)
+            self._next_index += 1
+            end_ms = max(end_ms, end)
+        # 以音檔實際長度累計時間軸，無法取得長度時以最後一條字幕的結束時間代替
+        self._offset_ms = self._offset_ms + int(duration * 1000) if duration else end_ms
+        self._group_texts.append(text)
+        if len(self._group) >= self.group_cues:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[Dict]:
+        """結束目前的字幕組
+
+        Returns:
+            字幕組：cues（含上下文的字幕數據）、keys（需校正的編號）、context_keys、transcript；
+            目前沒有字幕時返回 None
+        """
+        group, texts = self._group, self._group_texts
+        if not group:
+            return None
+        cues = dict(self._context)
+        cues.update(group)
+        result = {
+            "cues": cues,
+            "keys": list(group),
+            "context_keys": list(self._context),
+            "transcript": "\n".join(([self._context_text] if self._context_text else []) + texts),
+        }
+        tail = list(group)[-self.context_cues:] if self.context_cues else []
+        self._context = {key: group[key] for key in tail}
+        self._context_text = texts[-1]
+        self._group, self._group_texts = {}, []
+        return result
+
+
+def transcribe_segment(srt_generator: SRTGenerator, mp3_file: str, api_key: str, language: str = "zh",
+                       hedge: bool = False) -> Tuple[List[Dict], float]:
+    """轉錄單一段落的音檔，並依音檔長度按比例校正時間戳
+
+    Returns:
+        (parse_srt 格式的字幕列表, 音檔長度秒數)
+    """
+    duration = srt_generator.get_audio_duration(mp3_file)
+    srt_content = srt_generator.transcribe(mp3_file, api_key, language, hedge=hedge)
+    if srt_content and duration:
+        srt_content = srt_generator.correct_timestamps_proportionally(srt_content, duration)
+    return (srt_generator.parse_srt(srt_content) if srt_content else []), duration
+
+
+def correct_group(corrector: SubtitleCorrector, group: Dict, batch_size: Optional[int] = None,
+                  limiter: Optional[TokenBucket] = None) -> Dict:
+    """校正一組字幕（CueGrouper 產生的格式），失敗時保留原始字幕
+
+    Returns:
+        cues（只含需校正的字幕）與 reports（修改報告）
+    """
+    error, corrected, reports = corrector.correct_cues(
+        group["transcript"], group["cues"], batch_size,
+        context_keys=group["context_keys"], limiter=limiter
+    )
+    keys = group["keys"]
+    if error:
+        print(f"字幕 {keys[0]}-{keys[-1]} 校正失敗，保留原始字幕: {error}")
+        corrected = group["cues"]
+        reports = [f"警告：字幕 {keys[0]}-{keys[-1]} 校正失敗，保留原始字幕：{error}"]
+    return {"cues": {key: corrected[key] for key in keys}, "reports": reports or []}
+
+
+class StreamingPipeline:
+    """
+    生產者／消費者式的一鍵處理管線
+
+    預處理產生的分段依序經過：多音字替換（本地斷詞，在來源執行緒內完成）→ 語音生成工作池
+    → Whisper 轉錄工作池 → 依段落順序組合時間軸 → 字幕校正工作池。
+    階段之間以有界佇列連接，下游較慢時上游會阻塞等待，不會無限制地堆積音檔或字幕。
+    組合階段每累積 group_cues 條字幕（在段落邊界切開）就送出一組校正，並附上前一組最後
+    context_cues 條字幕與其段落原文作為上下文；上下文字幕只用於定位，不會被重複校正。
+    任一階段發生無法恢復的錯誤時，所有階段停止並返回第一個錯誤。
+    """
+
+    def __init__(self, tts_generator: TTSGenerator, voice_settings: Dict, whisper_api_key: str,
+                 corrector: SubtitleCorrector, replacer: Optional[HomophoneReplacer] = None,
+                 language: str = "zh", srt_generator: Optional[SRTGenerator] = None,
+                 pronunciation_matcher=None, batch_size: Optional[int] = None,
+                 tts_workers: int = 4, whisper_workers: int = 4, correction_workers: int = 2,
+                 queue_size: int = 4, group_cues: int = 30, context_cues: int = 2,
+                 requests_per_minute: int = 60, hedge: bool = False,
+                 progress: Optional[Callable[[float, str], None]] = None):
+        """初始化管線
+
+        Args:
+            tts_generator: 語音生成器（音檔寫入其 output_dir）
+            voice_settings: build_voice_settings 返回的語音設定
+            whisper_api_key: OpenAI API 金鑰（多把金鑰以逗號分隔）
+            corrector: 字幕校正器
+            replacer: 多音字替換器，None 表示不替換
+            language: 轉錄語言代碼
+            srt_generator: 字幕生成器，None 表示建立新的
+            pronunciation_matcher: 發音字典比對器，None 表示不使用
+            batch_size: 校正時每批次最多字幕數，None 表示依 token 預算自動決定
+            tts_workers: 語音生成的工作執行緒數（每把金鑰）
+            whisper_workers: 轉錄的工作執行緒數（每把金鑰）
+            correction_workers: 同時校正的字幕組數
+            queue_size: 每個階段之間佇列的容量
+            group_cues: 每組校正的字幕數量下限（在段落邊界切開）
+            context_cues: 每組附帶的前文字幕數
+            requests_per_minute: 校正每把金鑰每分鐘請求數上限（同一組金鑰的所有管線共用）
+            hedge: 語音生成與轉錄是否送出備援請求
+            progress: 進度回呼，參數為 (0~1 的進度, 描述)
+        """
+        self.tts_generator = tts_generator
+        self.voice_settings = voice_settings
+        self.whisper_api_key = whisper_api_key
+        self.corrector = corrector
+        self.replacer = replacer
+        self.language = language
+        self.srt_generator = srt_generator or SRTGenerator()
+        self.pronunciation_matcher = pronunciation_matcher
+        self.batch_size = batch_size
+        self.group_cues = group_cues
+        self.context_cues = context_cues
+        self.hedge = hedge
+        self.progress = progress
+
+        self.tts_workers = max(1, tts_workers * max(1, len(parse_api_keys(tts_generator.api_key))))
+        self.whisper_workers = max(1, whisper_workers * max(1, len(parse_api_keys(whisper_api_key))))
+        self.correction_workers = max(1, correction_workers)
+        self.queue_size = max(1, queue_size)
+
+        # 所有字幕組（包括其他檔案的管線）共用同一個速率限制，避免並行的字幕組超過每分鐘請求數
+        self.correction_limiter = get_correction_limiter(corrector.api_key, requests_per_minute)
+
+        self._abort = threading.Event()
+        self._lock = threading.Lock()
+        self._error: Optional[str] = None
+        self._segments: List[Dict[str, Any]] = []
+        self._counts = {"tts": 0, "whisper": 0, "corrected": 0}
+        self._source_done = False
+
+    # ------------------------------------------------------------------
+    # 佇列與錯誤處理
+    # ------------------------------------------------------------------
+
+    def _fail(self, message: str) -> None:
+        """記錄第一個錯誤並通知所有階段停止"""
+        with self._lock:
+            if self._error is None:
+                self._error = message
+                print(f"管線中止: {message}")
+        self._abort.set()
+
+    def _put(self, q: queue.Queue, item: Any) -> bool:
+        """放入佇列，佇列已滿時阻塞等待；管線中止時返回 False"""
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue) -> Any:
+        """從佇列取出項目；管線中止時返回結束標記"""
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=0.2)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _report_progress(self) -> None:
+        """依各階段完成的段落數回報整體進度"""
+        if not self.progress:
+            return
+        with self._lock:
+            total = len(self._segments)
+            counts = dict(self._counts)
+            known = self._source_done
+        if not total:
+            return
+        fraction = (counts["tts"] + counts["whisper"]) / (2 * total)
+        if not known:
+            # 尚未知道總段落數時保守估計
+            fraction *= 0.5
+        desc = (f"預處理 {total} 段{'' if known else '（進行中）'}，語音 {counts['tts']}，"
+                f"轉錄 {counts['whisper']}，已校正 {counts['corrected']} 條字幕")
+        self.progress(min(0.95, 0.05 + 0.9 * fraction), desc)
+
+    def _start_stage(self, name: str, workers: int, inbox: queue.Queue, outbox: queue.Queue,
+                     handler: Callable[[Any], Any]) -> List[threading.Thread]:
+        """啟動一個工作池階段
+
+        每個工作執行緒從 inbox 取出項目交給 handler，結果放入 outbox；
+        收到結束標記時放回 inbox 讓其他執行緒也能看到，最後一個結束的執行緒把結束標記傳給 outbox。
+        """
+        remaining = [workers]
+
+        def work():
+            while True:
+                item = self._get(inbox)
+                if item is _DONE:
+                    self._put(inbox, _DONE)
+                    break
+                try:
+                    result = handler(item)
+                except Exception as e:
+                    self._fail(f"{name}失敗: {e}")
+                    break
+                if not self._put(outbox, result):
+                    break
+            with self._lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self._put(outbox, _DONE)
+
+        threads = [threading.Thread(target=work, name=f"{name}-{n}", daemon=True) for n in range(workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    # ------------------------------------------------------------------
+    # 各階段
+    # ------------------------------------------------------------------
+
+    def _produce(self, segments: Iterable[str], outbox: queue.Queue) -> None:
+        """來源階段：取得預處理分段並進行多音字替換"""
+        try:
+            for segment in segments:
+                if self._abort.is_set():
+                    break
+                replaced, report = segment, []
+                if self.replacer:
+                    replaced, report = self.replacer.replace_homophones(self.replacer.process_locally(segment))
+                with self._lock:
+                    number = len(self._segments)
+                    self._segments.append({"text": segment, "replaced": replaced, "report": report})
+                print(f"段落 {number + 1} 預處理完成，送交語音生成")
+                if not self._put(outbox, number):
+                    break
+                self._report_progress()
+        except Exception as e:
+            self._fail(f"文本預處理失敗: {e}")
+        finally:
+            with self._lock:
+                self._source_done = True
+            self._put(outbox, _DONE)
+
+    def _synthesize(self, number: int) -> int:
+        """語音生成階段"""
+        segment = self._segments[number]
+        mp3_file = self.tts_generator.synthesize_segment(number + 1, segment["replaced"], self.voice_settings,
+                                                         self.pronunciation_matcher, self.hedge)
+        segment["mp3"] = str(mp3_file)
+        with self._lock:
+            self._counts["tts"] += 1
+        self._report_progress()
+        return number
+
+    def _transcribe(self, number: int) -> int:
+        """轉錄階段"""
+        segment = self._segments[number]
+        segment["entries"], segment["duration"] = transcribe_segment(
+            self.srt_generator, segment["mp3"], self.whisper_api_key, self.language, self.hedge
+        )
+        if not segment["entries"]:
+            print(f"段落 {number + 1} 未轉錄出任何字幕")
+        with self._lock:
+            self._counts["whisper"] += 1
+        self._report_progress()
+        return number
+
+    def _assemble(self, inbox: queue.Queue, outbox: queue.Queue, grouper: "CueGrouper") -> None:
+        """組合階段：依段落順序平移時間軸、重新編號，並切成校正用的字幕組"""
+        arrived = set()
+        next_number = 0
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is _DONE:
+                    break
+                arrived.add(item)
+                # 依段落順序處理已轉錄完成的段落
+                while next_number in arrived:
+                    segment = self._segments[next_number]
+                    group = grouper.add(segment["text"], segment["entries"], segment["duration"])
+                    next_number += 1
+                    if group and not self._put(outbox, group):
+                        return
+            group = grouper.flush()
+            if group and not self._abort.is_set():
+                self._put(outbox, group)
+        except Exception as e:
+            self._fail(f"字幕組合失敗: {e}")
+        finally:
+            self._put(outbox, _DONE)
+
+    def _correct(self, group: Dict) -> Dict:
+        """校正階段：校正一組字幕，失敗時保留原始字幕"""
+        result = correct_group(self.corrector, group, self.batch_size, self.correction_limiter)
+        with self._lock:
+            self._counts["corrected"] += len(group["keys"])
+        self._report_progress()
+        return result
+
+    # ------------------------------------------------------------------
+
+    def run(self, segments: Iterable[str]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """執行管線
+
+        Args:
+            segments: 依序產生預處理分段的可迭代物件（可為串流產生器）
+
+        Returns:
+            (錯誤信息, 結果字典)；結果字典包含 segments（每段的原文、替換後文本、音檔與字幕）、
+            initial_cues 與 corrected_cues（parse_srt 格式的字幕數據）、reports（校正報告）
+            以及 elapsed（秒）
+        """
+        started = time.time()
+        tts_queue = queue.Queue(self.queue_size)
+        whisper_queue = queue.Queue(self.queue_size)
+        assemble_queue = queue.Queue(self.queue_size)
+        correction_queue = queue.Queue(self.queue_size)
+        done_queue = queue.Queue(self.queue_size)
+        grouper = CueGrouper(self.srt_generator, self.group_cues, self.context_cues)
+        initial_cues = grouper.initial_cues
+
+        threads = [
+            threading.Thread(target=self._produce, args=(segments, tts_queue), name="pipeline-source", daemon=True),
+            threading.Thread(target=self._assemble, args=(assemble_queue, correction_queue, grouper),
+                             name="pipeline-assemble", daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+        threads += self._start_stage("語音生成", self.tts_workers, tts_queue, whisper_queue, self._synthesize)
+        threads += self._start_stage("字幕轉錄", self.whisper_workers, whisper_queue, assemble_queue, self._transcribe)
+        threads += self._start_stage("字幕校正", self.correction_workers, correction_queue, done_queue, self._correct)
+
+        corrected_cues: Dict[int, Dict] = {}
+        reports: List[str] = []
+        results = []
+        while True:
+            item = self._get(done_queue)
+            if item is _DONE:
+                break
+            results.append(item)
+        for thread in threads:
+            thread.join(timeout=5)
+
+        if self._error:
+            return self._error, None
+        if not self._segments:
+            return "預處理後沒有任何分段", None
+        if not initial_cues:
+            return "字幕生成失敗：未能從音頻中提取文字", None
+
+        # 字幕組可能不依順序完成，依編號合併
+        for item in sorted(results, key=lambda item: min(item["cues"])):
+            corrected_cues.update(item["cues"])
+            reports.extend(item["reports"])
+
+        elapsed = time.time() - started
+        print(f"管線處理完成：{len(self._segments)} 段、{len(initial_cues)} 條字幕，耗時 {elapsed:.1f} 秒")
+        return None, {
+            "segments": self._segments,
+            "initial_cues": initial_cues,
+            "corrected_cues": corrected_cues,
+            "reports": reports,
+            "elapsed": elapsed,
+        }
@@ -0,0 +1,163 @@
+# modules/rule_segmenter.py
+"""
+規則斷句模組 - 依文本預處理提示詞的分段規則，以動態規劃在本地切分中文段落
+"""
+
+import re
+from typing import List, Optional, Tuple
+
+# 斷點類型與成本：句末標點最優先，其次為分號冒號、逗號頓號，最後為轉折與因果連接詞之前
+SENTENCE_END = "。！？!?…"
+SEMICOLON_COLON = "；;：:"
+COMMA = "，、,"
+CLOSING_PUNCTUATION = "」』）)》】\"'”’"
+BREAK_COSTS = {
+    "sentence": 0.0,
+    "semicolon": 2.0,
+    "comma": 4.0,
+    "connector": 8.0,
+}
+
+# 可在其前方斷開的連接詞（轉折、因果、並列）
+CONNECTORS = (
+    "但是", "然而", "不過", "可是", "只是", "所以", "因此", "於是", "因而",
+    "而且", "並且", "另外", "此外", "同時", "接著", "然後",
+)
+# 不可與其前後內容分開的結構助詞
+PARTICLES = "的地得"
+
+
+class RuleSegmenter:
+    """
+    規則式分段器
+
+    候選斷點只取標點之後與連接詞之前，自然避開主謂、動賓、量詞與名詞之間等禁止分段的位置。
+    每段的成本由斷點類型與長度偏離決定，以動態規劃取總成本最小的切法；
+    任何切法都無法讓每段不超過 hard_limit 字時，視為無法以規則處理。
+    """
+
+    def __init__(self, min_chars: int = 26, max_chars: int = 60, hard_limit: int = 70,
+                 short_sentence_chars: int = 18):
+        """初始化分段器
+
+        Args:
+            min_chars: 每段建議的最少字數
+            max_chars: 每段建議的最多字數
+            hard_limit: 每段絕對不可超過的字數
+            short_sentence_chars: 完整短句可單獨成段的字數上限
+        """
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.hard_limit = hard_limit
+        self.short_sentence_chars = short_sentence_chars
+
+    @staticmethod
+    def _length(text: str) -> int:
+        """計算分段字數（不含空白）"""
+        return len(re.sub(r'\s', '', text))
+
+    def candidate_breaks(self, paragraph: str) -> List[Tuple[int, str]]:
+        """找出段落中所有可斷開的位置
+
+        Args:
+            paragraph: 段落文本
+
+        Returns:
+            (斷點位置, 斷點類型) 列表，位置為斷開後下一段的起始索引
+        """
+        breaks = {}
+        length = len(paragraph)
+
+        for i, char in enumerate(paragraph):
+            if char in SENTENCE_END:
+                kind = "sentence"
+            elif char in SEMICOLON_COLON:
+                kind = "semicolon"
+            elif char in COMMA:
+                kind = "comma"
+            else:
+                continue
+            # 連續標點與右引號、右括號保留在同一段末尾
+            end = i + 1
+            while end < length and (paragraph[end] in SENTENCE_END + CLOSING_PUNCTUATION):
+                end += 1
+            if end < length and (end not in breaks or BREAK_COSTS[kind] < BREAK_COSTS[breaks[end]]):
+                breaks[end] = kind
+
+        for connector in CONNECTORS:
+            for match in re.finditer(connector, paragraph):
+                position = match.start()
+                # 不在段首、不緊接「的、地、得」，也不與已有的標點斷點重複
+                if position > 0 and position not in breaks and paragraph[position - 1] not in PARTICLES:
+                    breaks[position] = "connector"
+
+        return sorted(breaks.items())
+
+    def _segment_cost(self, segment: str, ends_sentence: bool) -> float:
+        """計算單一分段的長度成本"""
+        length = self._length(segment)
+        if length > self.max_chars:
+            return (length - self.max_chars) * 1.0
+        if length < self.min_chars:
+            # 完整的短句可以單獨成段
+            if ends_sentence and length <= self.short_sentence_chars:
+                return 1.0
+            return (self.min_chars - length) * 0.5
+        return 0.0
+
+    def segment_paragraph(self, paragraph: str) -> Optional[List[str]]:
+        """以動態規劃切分單一段落
+
+        Args:
+            paragraph: 段落文本
+
+        Returns:
+            分段列表；無法讓每段不超過 hard_limit 字時返回 None
+        """
+        paragraph = paragraph.strip()
+        if not paragraph:
+            return []
+        if self._length(paragraph) <= self.max_chars:
+            return [paragraph]
+
+        breaks = self.candidate_breaks(paragraph)
+        positions = [0] + [position for position, _ in breaks] + [len(paragraph)]
+        kinds = [None] + [kind for _, kind in breaks] + ["end"]
+
+        # best[j] = (切到 positions[j] 為止的最小成本, 前一個斷點索引)
+        best = [(0.0, -1)] + [(float("inf"), -1)] * (len(positions) - 1)
+        for j in range(1, len(positions)):
+            break_cost = BREAK_COSTS.get(kinds[j], 0.0)
+            for i in range(j - 1, -1, -1):
+                segment = paragraph[positions[i]:positions[j]]
+                if self._length(segment) > self.hard_limit:
+                    break
+                if best[i][0] == float("inf"):
+                    continue
+                ends_sentence = kinds[j] in ("sentence", "end") and segment.rstrip()[-1:] in SENTENCE_END + CLOSING_PUNCTUATION
+                cost = best[i][0] + self._segment_cost(segment, ends_sentence) + break_cost
+                if cost < best[j][0]:
+                    best[j] = (cost, i)
+
+        if best[-1][0] == float("inf"):
+            return None
+
+        segments = []
+        j = len(positions) - 1
+        while j > 0:
+            i = best[j][1]
+            segments.append(paragraph[positions[i]:positions[j]].strip())
+            j = i
+        return [segment for segment in reversed(segments) if segment]
+
+    def segment(self, text: str) -> Tuple[List[Optional[List[str]]], List[str]]:
+        """逐段落切分文本
+
+        Args:
+            text: 原始文本，每行視為一個段落
+
+        Returns:
+            (每個段落的分段列表或 None, 段落文本列表)
+        """
+        paragraphs = [line.strip() for line in text.split('\n') if line.strip()]
+        return [self.segment_paragraph(paragraph) for paragraph in paragraphs], paragraphs
@@ -5,6 +5,8 @@ import tempfile
 from typing import List, Tuple, Optional, Dict
 from pydub import AudioSegment
 from modules.openai_utils import get_openai_client  # 使用統一的客戶端獲取函數
+from utils.api_handler import call_hedged
+from modules.cue_builder import CueBuilder
 
 class SRTGenerator:
     """
@@ -36,33 +38,32 @@ class SRTGenerator:
             print(f"獲取音頻長度失敗: {str(e)}")
             return 0.0
     
-    def transcribe(self, file_path: str, api_key: str, language: str = "zh", **kwargs) -> str:
+    def transcribe(self, file_path: str, api_key: str, language: str = "zh", hedge: bool = False, **kwargs) -> str:
         """
         使用Whisper API轉錄單個音頻文件
         
         Args:
             file_path: 音頻檔案路徑
-            api_key: OpenAI API金鑰
+            api_key: OpenAI API金鑰（多把金鑰以逗號分隔）
             language: 語言代碼 (zh/en/ja等)
+            hedge: 延遲超過近期 p95 時是否在預算內送出備援請求
             
         Returns:
             SRT格式的轉錄結果
         """
         try:
-            # 導入新版 OpenAI 客戶端
-            import openai
+            def send(key):
+                # 同一金鑰共用長連線客戶端；每次重試都重新打開音頻文件
+                with open(file_path, "rb") as audio_file:
+                    return get_openai_client(key).audio.transcriptions.create(
+                        model="whisper-1",
+                        file=audio_file,
+                        response_format="srt",
+                        language=language
+                    )
             
-            # 非常簡單直接的初始化方式，只傳遞 api_key
-            client = openai.OpenAI(api_key=api_key)
-            
-            # 打開音頻文件並調用API
-            with open(file_path, "rb") as audio_file:
-                response = client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    response_format="srt",
-                    language=language
-                )
+            response = call_hedged("openai", send, label=f"Whisper 轉錄 {os.path.basename(file_path)}",
+                                   hedge="whisper_transcribe" if hedge else None, api_keys=api_key)
             
             # 返回結果
             return str(response)
@@ -72,6 +73,105 @@ class SRTGenerator:
             print(error_msg)
             return ""
     
+    def transcribe_words(self, file_path: str, api_key: str, language: str = "zh", hedge: bool = False) -> Optional[Dict]:
+        """
+        使用Whisper API轉錄單個音頻文件，取得字詞與段落時間戳
+        
+        Args:
+            file_path: 音頻檔案路徑
+            api_key: OpenAI API金鑰（多把金鑰以逗號分隔）
+            language: 語言代碼 (zh/en/ja等)
+            hedge: 延遲超過近期 p95 時是否在預算內送出備援請求
+            
+        Returns:
+            包含 duration、words、segments 的字典，失敗時返回 None
+        """
+        try:
+            def send(key):
+                with open(file_path, "rb") as audio_file:
+                    return get_openai_client(key).audio.transcriptions.create(
+                        model="whisper-1",
+                        file=audio_file,
+                        response_format="verbose_json",
+                        timestamp_granularities=["word", "segment"],
+                        language=language
+                    )
+            
+            response = call_hedged("openai", send, label=f"Whisper 字詞轉錄 {os.path.basename(file_path)}",
+                                   hedge="whisper_transcribe_words" if hedge else None, api_keys=api_key)
+            
+            data = response.model_dump() if hasattr(response, "model_dump") else dict(response)
+            
+            # 只保留斷句所需的欄位，方便存檔後重複使用
+            return {
+                "duration": float(data.get("duration") or 0.0),
+                "words": [
+                    {"word": w["word"], "start": float(w["start"]), "end": float(w["end"])}
+                    for w in (data.get("words") or [])
+                ],
+                "segments": [
+                    {"text": seg["text"], "start": float(seg["start"]), "end": float(seg["end"])}
+                    for seg in (data.get("segments") or [])
+                ]
+            }
+        
+        except Exception as e:
+            print(f"字詞時間戳轉錄失敗: {str(e)}")
+            return None
+    
+    def words_to_entries(self, words_list: List[Dict], layout: Optional[Dict] = None) -> List[Dict]:
+        """
+        將多個音頻文件的字詞時間戳在本地斷句，合併為連續的字幕條目
+        
+        不需要呼叫API，可用不同的版面參數重複執行
+        
+        Args:
+            words_list: 依播放順序排列的 transcribe_words 結果列表
+            layout: 版面參數 (max_chars、min_chars、min_duration、max_duration、max_gap)
+            
+        Returns:
+            列表，每個元素包含序號、時間戳、文本 (與 parse_srt 格式相同)
+        """
+        builder = CueBuilder.from_layout(layout)
+        entries = []
+        offset = 0.0
+        
+        for words_data in words_list:
+            if not words_data:
+                continue
+            
+            cues = builder.build_from_words(words_data)
+            for cue in cues:
+                entries.append({
+                    'index': len(entries) + 1,
+                    'start_time': self.ms_to_time(int(round((cue['start'] + offset) * 1000))),
+                    'end_time': self.ms_to_time(int(round((cue['end'] + offset) * 1000))),
+                    'text': cue['text']
+                })
+            
+            # 以音頻長度作為下一個文件的時間偏移
+            duration = words_data.get("duration") or (cues[-1]['end'] if cues else 0.0)
+            offset += duration
+        
+        return entries
+    
+    def format_srt(self, entries: List[Dict]) -> str:
+        """
+        將字幕條目轉換為SRT格式文本
+        
+        Args:
+            entries: 字幕條目列表
+            
+        Returns:
+            SRT格式的字幕內容
+        """
+        content = ""
+        for entry in entries:
+            content += f"{entry['index']}\n"
+            content += f"{entry['start_time']} --> {entry['end_time']}\n"
+            content += f"{entry['text']}\n\n"
+        return content
+    
     def correct_timestamps_proportionally(self, srt_content: str, audio_duration: float) -> str:
         """
         按比例校正SRT的時間戳
@@ -170,14 +270,19 @@ class SRTGenerator:
         
         return parsed
     
-    def generate_srt_from_audio_files(self, audio_files: List[str], output_file: str, api_key: str, language: str = "zh") -> Tuple[bool, Optional[str]]:
+    def generate_srt_from_audio_files(self, audio_files: List[str], output_file: str, api_key: str, language: str = "zh",
+                                      word_timestamps: bool = False, layout: Optional[Dict] = None,
+                                      hedge: bool = False) -> Tuple[bool, Optional[str]]:
         """從多個音頻文件生成合併的SRT
         
         Args:
             audio_files: 音頻文件路徑列表
             output_file: 輸出SRT文件路徑
-            api_key: OpenAI API金鑰
+            api_key: OpenAI API金鑰（多把金鑰以逗號分隔）
             language: 語言代碼
+            word_timestamps: 是否使用字詞時間戳在本地斷句
+            layout: 本地斷句的版面參數
+            hedge: 延遲異常的檔案是否送出備援請求
             
         Returns:
             (成功狀態, SRT檔案路徑或錯誤訊息)
@@ -189,6 +294,9 @@ class SRTGenerator:
             # 排序文件 (假設文件名格式為數字開頭，如 "01.mp3", "02.mp3")
             sorted_files = sorted(audio_files, key=lambda x: int(re.search(r'^\d+', os.path.basename(x)).group()) if re.search(r'^\d+', os.path.basename(x)) else float('inf'))
             
+            if word_timestamps:
+                return self._generate_srt_from_words(sorted_files, output_file, api_key, language, layout, hedge)
+            
             # 為每個文件生成SRT
             temp_dir = tempfile.mkdtemp()
             srt_files = {}
@@ -203,7 +311,7 @@ class SRTGenerator:
                 audio_duration = self.get_audio_duration(file_path)
                 
                 # 使用Whisper API轉錄
-                srt_content = self.transcribe(file_path, api_key, language)
+                srt_content = self.transcribe(file_path, api_key, language, hedge=hedge)
                 
                 if srt_content:
                     # 校正時間戳
@@ -237,6 +345,39 @@ class SRTGenerator:
         except Exception as e:
             return False, f"處理音頻文件失敗: {str(e)}"
     
+    def _generate_srt_from_words(self, sorted_files: List[str], output_file: str, api_key: str, language: str,
+                                 layout: Optional[Dict], hedge: bool) -> Tuple[bool, Optional[str]]:
+        """以字詞時間戳在本地斷句，生成合併的SRT
+        
+        與逐步操作的字詞模式相同，以每個音頻的長度累計時間偏移（見 words_to_entries）；
+        轉錄失敗的文件以空白的音頻長度佔位，讓後續文件的時間保持正確。
+        
+        Returns:
+            (成功狀態, SRT檔案路徑或錯誤訊息)
+        """
+        words_list = []
+        for i, file_path in enumerate(sorted_files):
+            filename = os.path.basename(file_path)
+            print(f"處理文件 {i+1}/{len(sorted_files)}: {filename}")
+            
+            words_data = self.transcribe_words(file_path, api_key, language, hedge=hedge)
+            if not words_data:
+                duration = self.get_audio_duration(file_path)
+                if not duration:
+                    return False, f"字詞轉錄失敗且無法取得音頻長度: {filename}"
+                print(f"無法轉錄: {filename}，以 {duration:.1f} 秒空白佔位")
+                words_data = {"duration": duration, "words": [], "segments": []}
+            words_list.append(words_data)
+        
+        entries = self.words_to_entries(words_list, layout)
+        if not entries:
+            return False, "無法生成任何SRT文件"
+        
+        with open(output_file, "w", encoding="utf-8") as f:
+            f.write(self.format_srt(entries))
+        
+        return True, output_file
+    
     def _merge_srt(self, srt_files: Dict, language: str = "zh") -> str:
         """
         合併多個SRT文件
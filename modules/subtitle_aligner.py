@@ -0,0 +1,357 @@
+# modules/subtitle_aligner.py
+"""
+字幕對齊模組 - 在本地將 Whisper 字幕文字對齊到原始逐字稿，取代大部分的 AI 校正
+"""
+
+import re
+import bisect
+import unicodedata
+from difflib import SequenceMatcher
+from typing import List, Dict, Tuple, Optional
+
+# 句末與子句標點（判斷字幕結尾是否帶標點）
+PUNCTUATION = set("，。！？、；：,.!?;:…「」『』（）()《》〈〉\"'“”‘’")
+# 中日韓文字與全形標點之間的空白需移除
+CJK_SPACE_PATTERN = re.compile(r'(?<=[⺀-鿿　-〿＀-￯])\s+|\s+(?=[⺀-鿿　-〿＀-￯])')
+
+
+class SubtitleAligner:
+    """
+    字幕對齊器，以分段的 difflib 編輯距離對齊將逐字稿文字投影回每條字幕
+
+    只比對「內容字元」（文字與數字，忽略標點與空白），
+    每條字幕的信心值為其內容字元中與逐字稿完全吻合的比例。
+    """
+
+    def __init__(self, confidence_threshold: float = 0.8, chunk_size: int = 300, band: int = 200,
+                 max_length_change: float = 0.3):
+        """初始化字幕對齊器
+
+        Args:
+            confidence_threshold: 信心值門檻，低於此值的字幕需交由 AI 校正
+            chunk_size: 每次對齊的字幕內容字元數
+            band: 逐字稿搜尋視窗在預估位置之外額外保留的字元數
+            max_length_change: 允許的文字長度變化比例（與 validate_srt 一致）
+        """
+        self.confidence_threshold = confidence_threshold
+        self.chunk_size = chunk_size
+        self.band = band
+        self.max_length_change = max_length_change
+        self._index_cache = None
+
+    @staticmethod
+    def normalize_char(char: str) -> str:
+        """將字元正規化為比對用的內容字元，標點與空白返回空字串"""
+        char = unicodedata.normalize('NFKC', char).lower()
+        return char if char.isalnum() else ""
+
+    def content_index(self, text: str) -> Tuple[str, List[int]]:
+        """抽取文本的內容字元
+
+        Args:
+            text: 原始文本
+
+        Returns:
+            (內容字元字串, 每個內容字元在原始文本中的位置)
+        """
+        chars = []
+        positions = []
+        for pos, char in enumerate(text):
+            normalized = self.normalize_char(char)
+            # NFKC 可能把一個字元展開成多個，只取第一個以維持一對一的位置對應
+            if normalized:
+                chars.append(normalized[0])
+                positions.append(pos)
+        return "".join(chars), positions
+
+    def transcript_index(self, transcript: str) -> Tuple[str, List[int]]:
+        """抽取逐字稿的內容字元，同一份逐字稿只計算一次"""
+        if self._index_cache is None or self._index_cache[0] is not transcript:
+            self._index_cache = (transcript, *self.content_index(transcript))
+        return self._index_cache[1], self._index_cache[2]
+
+    def locate_window(self, cue_texts: List[str], transcript: str, cursor: int = 0,
+                      margin: int = 200) -> Tuple[int, int]:
+        """找出一批字幕在逐字稿中對應的區段
+
+        先在游標附近的視窗內比對；若找不到足夠的吻合，
+        改以字幕中的錨點字串在全文中搜尋，取錨點位置的中位數作為區段中心。
+
+        Args:
+            cue_texts: 本批次（含上下文）的字幕文字
+            transcript: 逐字稿全文
+            cursor: 預估起點（逐字稿原始位置），通常為上一批次區段的結尾
+            margin: 區段前後額外保留的字元數
+
+        Returns:
+            (區段起點, 區段終點)，為逐字稿中的原始位置
+        """
+        transcript_content, positions = self.transcript_index(transcript)
+        batch_content = "".join(self.content_index(text)[0] for text in cue_texts)
+        if not transcript_content or not batch_content:
+            return 0, len(transcript)
+
+        c = bisect.bisect_left(positions, cursor)
+        window_start = max(0, c - self.band)
+        window_end = min(len(transcript_content), c + int(len(batch_content) * 1.5) + 2 * self.band)
+        blocks = SequenceMatcher(None, batch_content, transcript_content[window_start:window_end],
+                                 autojunk=False).get_matching_blocks()
+        blocks = [block for block in blocks if block.size >= 3]
+        matched = sum(block.size for block in blocks)
+
+        if matched >= len(batch_content) * 0.5:
+            start = window_start + blocks[0].b
+            end = window_start + blocks[-1].b + blocks[-1].size
+        else:
+            # 游標失準：以錨點在全文中定位
+            hits = []
+            for i in range(0, max(1, len(batch_content) - 6), 8):
+                anchor = batch_content[i:i + 6]
+                pos = transcript_content.find(anchor)
+                if pos != -1 and transcript_content.find(anchor, pos + 1) == -1:
+                    hits.append(pos - i)
+            if hits:
+                hits.sort()
+                start = max(0, hits[len(hits) // 2])
+            else:
+                start = min(c, len(transcript_content) - 1)
+            end = min(len(transcript_content), start + len(batch_content))
+
+        start_pos = max(0, positions[min(start, len(positions) - 1)] - margin)
+        end_pos = min(len(transcript), positions[max(0, min(end, len(positions)) - 1)] + 1 + margin)
+        return start_pos, end_pos
+
+    @staticmethod
+    def clean_text(text: str) -> str:
+        """清理從逐字稿切出的片段：移除分段符號與中文字之間的空白"""
+        text = text.replace('---', ' ')
+        text = re.sub(r'\s+', ' ', text)
+        text = CJK_SPACE_PATTERN.sub('', text)
+        return text.strip()
+
+    def project(self, text: str, transcript: str, t_start: int, t_end: int) -> Tuple[str, int, int]:
+        """把內容字元區間投影回逐字稿原文
+
+        Args:
+            text: 原始字幕文字（用於決定是否保留結尾標點）
+            transcript: 逐字稿全文
+            t_start: 區間起點（內容字元位置）
+            t_end: 區間終點（內容字元位置，不含）
+
+        Returns:
+            (逐字稿中的對應文字, 原始起點, 原始終點)
+        """
+        _, positions = self.transcript_index(transcript)
+        start_pos = positions[t_start]
+        end_pos = positions[t_end] if t_end < len(positions) else len(transcript)
+        corrected = self.clean_text(transcript[start_pos:end_pos])
+
+        # 依照 Whisper 字幕的風格決定是否保留結尾標點
+        if text and text.strip()[-1:] not in PUNCTUATION:
+            corrected = corrected.rstrip("".join(PUNCTUATION)).rstrip()
+
+        return corrected, start_pos, end_pos
+
+    def match_exact(self, cue_texts: List[str], transcript: str, near_exact_ratio: float = 0.9) -> List[Optional[Dict]]:
+        """快速預先比對：找出忽略標點與空白後已與逐字稿相符的字幕
+
+        以游標在逐字稿中依序搜尋每條字幕的內容字元；
+        找不到完全相符時，以前半或後半段為錨點比對等長片段，
+        相似度達 near_exact_ratio 即視為幾乎相符。
+        投影回原文後長度變化超過 max_length_change 的字幕不視為相符。
+
+        Args:
+            cue_texts: 依順序排列的字幕文字
+            transcript: 逐字稿全文
+            near_exact_ratio: 幾乎相符的相似度門檻
+
+        Returns:
+            與字幕一一對應的列表，相符者為包含 text、start、end、exact 的字典，否則為 None
+        """
+        transcript_content, _ = self.transcript_index(transcript)
+        results = []
+        cursor = 0
+
+        for text in cue_texts:
+            content = self.content_index(text)[0]
+            if len(content) < 2:
+                results.append(None)
+                continue
+
+            low = max(0, cursor - self.band // 4)
+            high = cursor + len(content) + self.band
+            pos = transcript_content.find(content, low, high)
+            exact = pos != -1
+
+            if not exact and len(content) >= 8:
+                half = len(content) // 2
+                for anchor, shift in ((content[:half], 0), (content[half:], half)):
+                    anchor_pos = transcript_content.find(anchor, low, high)
+                    if anchor_pos - shift < 0:
+                        continue
+                    candidate = transcript_content[anchor_pos - shift:anchor_pos - shift + len(content)]
+                    if SequenceMatcher(None, content, candidate, autojunk=False).ratio() >= near_exact_ratio:
+                        pos = anchor_pos - shift
+                        break
+
+            if pos == -1:
+                # 未找到時依字幕長度推估游標，讓後續字幕仍能在附近搜尋
+                results.append(None)
+                cursor += len(content)
+                continue
+
+            corrected, start_pos, end_pos = self.project(text, transcript, pos, pos + len(content))
+            cursor = pos + len(content)
+            if abs(len(corrected) - len(text)) / max(1, len(text)) > self.max_length_change:
+                # 投影後多出標點或空白導致長度變化過大，交由 AI 處理以免整批校正被驗證拒絕
+                results.append(None)
+                continue
+            results.append({"text": corrected, "start": start_pos, "end": end_pos, "exact": exact})
+
+        return results
+
+    def _align_chunk(self, chunk: str, window: str) -> Tuple[List[int], List[bool], Tuple[int, int]]:
+        """對齊一段字幕內容與逐字稿視窗
+
+        Args:
+            chunk: 字幕內容字元
+            window: 逐字稿內容字元視窗
+
+        Returns:
+            (每個字幕字元對應的視窗位置, 每個字幕字元是否完全吻合,
+             最後一個可靠吻合區塊的結尾 (字幕位置, 視窗位置))
+        """
+        mapping = [0] * len(chunk)
+        matched = [False] * len(chunk)
+        matcher = SequenceMatcher(None, chunk, window, autojunk=False)
+        opcodes = matcher.get_opcodes()
+
+        # 單一字元的吻合可能是巧合，游標只依據三字元以上的吻合區塊推進
+        reliable = [block for block in matcher.get_matching_blocks() if block.size >= 3]
+        last_reliable = (reliable[-1].a + reliable[-1].size, reliable[-1].b + reliable[-1].size) if reliable else (0, 0)
+
+        for n, (tag, i1, i2, j1, j2) in enumerate(opcodes):
+            if i1 == i2:
+                continue
+            if tag == 'equal':
+                for k in range(i1, i2):
+                    mapping[k] = j1 + (k - i1)
+                    matched[k] = True
+            elif n == 0 and j1 == 0 and j2 > 0:
+                # 開頭未吻合：視窗前端可能多出上下文，靠右一對一對應
+                for k in range(i1, i2):
+                    mapping[k] = max(j1, j2 - (i2 - k))
+            elif n == len(opcodes) - 1:
+                # 結尾未吻合：視窗後端多出的內容不屬於這段字幕，靠左一對一對應
+                for k in range(i1, i2):
+                    mapping[k] = min(j2, j1 + (k - i1))
+            elif tag == 'replace':
+                for k in range(i1, i2):
+                    mapping[k] = j1 + (k - i1) * (j2 - j1) // (i2 - i1)
+            else:  # delete：字幕多出的字元
+                for k in range(i1, i2):
+                    mapping[k] = j1
+
+        return mapping, matched, last_reliable
+
+    def align(self, cue_texts: List[str], transcript: str) -> List[Dict]:
+        """將字幕對齊到逐字稿
+
+        Args:
+            cue_texts: 依順序排列的字幕文字
+            transcript: 逐字稿全文
+
+        Returns:
+            與字幕一一對應的列表，每個元素包含：
+            text（校正後文字）、confidence（信心值）、start/end（逐字稿中的原始位置）
+        """
+        transcript_content, transcript_positions = self.transcript_index(transcript)
+
+        cue_contents = [self.content_index(text)[0] for text in cue_texts]
+        whisper_content = "".join(cue_contents)
+
+        bounds = []
+        offset = 0
+        for content in cue_contents:
+            bounds.append(offset)
+            offset += len(content)
+
+        # 分段對齊：每段只在游標附近的視窗內比對，避免全文 O(n*m) 的比對成本
+        mapping = [0] * len(whisper_content)
+        matched = [False] * len(whisper_content)
+        cursor = 0
+        chunk_start = 0
+        cue_idx = 0
+        while chunk_start < len(whisper_content):
+            # 在字幕邊界切段
+            while cue_idx < len(bounds) and bounds[cue_idx] - chunk_start < self.chunk_size:
+                cue_idx += 1
+            chunk_end = bounds[cue_idx] if cue_idx < len(bounds) else len(whisper_content)
+            if chunk_end <= chunk_start:
+                chunk_end = len(whisper_content)
+
+            chunk = whisper_content[chunk_start:chunk_end]
+            window_start = max(0, cursor - self.band // 4)
+            window_end = min(len(transcript_content), cursor + int(len(chunk) * 1.3) + self.band)
+            window = transcript_content[window_start:window_end]
+
+            chunk_mapping, chunk_matched, (chunk_pos, window_pos) = self._align_chunk(chunk, window)
+            for k, (pos, ok) in enumerate(zip(chunk_mapping, chunk_matched)):
+                mapping[chunk_start + k] = window_start + pos
+                matched[chunk_start + k] = ok
+
+            # 游標移到最後一個可靠吻合區塊之後，再加上其後未吻合的字幕長度
+            if chunk_pos:
+                cursor = window_start + window_pos + (len(chunk) - chunk_pos)
+            else:
+                cursor += len(chunk)
+            cursor = min(cursor, len(transcript_content))
+            chunk_start = chunk_end
+
+        # 字幕邊界上漏聽的字元：若上一條字幕在逐字稿中以標點結尾，漏字歸入下一條字幕
+        starts = [mapping[bounds[n]] if content else None for n, content in enumerate(cue_contents)]
+        for n in range(1, len(cue_contents)):
+            if not cue_contents[n] or not bounds[n] or starts[n] is None:
+                continue
+            prev_last = mapping[bounds[n] - 1]
+            if prev_last + 1 < starts[n] and matched[bounds[n] - 1] and prev_last + 1 < len(transcript_positions):
+                gap = transcript[transcript_positions[prev_last] + 1:transcript_positions[prev_last + 1]]
+                if any(char in PUNCTUATION or char == '-' for char in gap):
+                    starts[n] = prev_last + 1
+
+        # 把字幕邊界投影回逐字稿
+        results = []
+        for n, (text, content) in enumerate(zip(cue_texts, cue_contents)):
+            if not content:
+                results.append({"text": text, "confidence": 1.0, "start": None, "end": None})
+                continue
+
+            first = bounds[n]
+            last = first + len(content) - 1
+            t_start = starts[n]
+            next_start = next((starts[m] for m in range(n + 1, len(cue_contents)) if starts[m] is not None), None)
+            if next_start is not None:
+                t_end = next_start
+            else:
+                t_end = mapping[last] + 1
+            t_end = max(t_end, t_start + 1) if t_start < len(transcript_content) else t_start
+
+            if t_start >= len(transcript_content):
+                results.append({"text": text, "confidence": 0.0, "start": None, "end": None})
+                continue
+
+            corrected, start_pos, end_pos = self.project(text, transcript, t_start, t_end)
+
+            confidence = sum(matched[first:last + 1]) / len(content)
+            if abs(len(corrected) - len(text)) / max(1, len(text)) > self.max_length_change:
+                # 長度變化過大代表邊界投影不可靠，交由 AI 處理
+                confidence = 0.0
+
+            results.append({
+                "text": corrected or text,
+                "confidence": round(confidence, 3),
+                "start": start_pos,
+                "end": end_pos,
+            })
+
+        return results
@@ -1,25 +1,105 @@
 # modules/subtitle_corrector.py
-import google.generativeai as genai
 import pysrt
 import re
 import os
-import time
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict, List, Tuple, Optional
-from prompts.zh_prompt import SUBTITLE_CORRECTION_PROMPT
+from prompts.zh_prompt import SUBTITLE_CORRECTION_PROMPT, SUBTITLE_CORRECTION_JSON_PROMPT
+from modules.subtitle_aligner import SubtitleAligner
+from utils.token_counter import estimate_tokens
+from utils.rate_limiter import TokenBucket
+from utils.api_handler import RetryPolicy, call_with_retry, generate_content
+from utils.key_pool import parse_api_keys
 
 class SubtitleCorrector:
-    def __init__(self, api_key: str):
+    MODEL_NAME = 'gemini-2.0-flash-exp'
+    
+    # 結構化輸出模式的回應格式
+    RESPONSE_SCHEMA = {
+        "type": "OBJECT",
+        "properties": {
+            "subtitles": {
+                "type": "ARRAY",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "index": {"type": "INTEGER"},
+                        "text": {"type": "STRING"},
+                    },
+                    "required": ["index", "text"],
+                },
+            },
+            "changes": {
+                "type": "ARRAY",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "index": {"type": "INTEGER"},
+                        "original": {"type": "STRING"},
+                        "corrected": {"type": "STRING"},
+                    },
+                    "required": ["index", "original", "corrected"],
+                },
+            },
+        },
+        "required": ["subtitles", "changes"],
+    }
+    # 單條字幕允許的文字長度變化比例（與 validate_srt 一致）
+    MAX_LENGTH_CHANGE = 0.3
+    
+    def __init__(self, api_key: str, cache_dir: Optional[str] = "temp/cache/subtitle_correction"):
         """初始化字幕校正器
         
         Args:
-            api_key: Google Gemini API金鑰
+            api_key: Google Gemini API金鑰（多把金鑰以逗號分隔）
+            cache_dir: 批次校正結果的快取目錄，None 表示不使用快取
         """
         self.api_key = api_key
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        if not api_key:
+            raise ValueError("API 金鑰錯誤，請檢查設定: 未提供 Gemini API 金鑰")
+    
+    def _cache_path(self, prompt: str) -> Optional[str]:
+        """取得批次快取檔案路徑
+        
+        提示詞已包含本批次的字幕文字、上下文與逐字稿視窗，
+        因此以模型名稱加上完整提示詞的雜湊作為快取鍵。
+        """
+        if not self.cache_dir:
+            return None
+        digest = hashlib.sha256(f"{self.MODEL_NAME}\n{prompt}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json")
+    
+    def _load_cached_batch(self, prompt: str) -> Optional[Tuple[Dict[int, str], List[str]]]:
+        """讀取批次快取，沒有快取或讀取失敗時返回 None"""
+        cache_path = self._cache_path(prompt)
+        if not cache_path or not os.path.exists(cache_path):
+            return None
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            corrections = {int(index): text for index, text in cached['corrections'].items()}
+            return corrections, cached.get('report', [])
+        except Exception as e:
+            print(f"讀取校正快取失敗，將重新校正: {e}")
+            return None
+    
+    def _store_cached_batch(self, prompt: str, corrections: Dict[int, str], report_lines: List[str]) -> None:
+        """寫入批次快取（先寫入暫存檔再替換，避免並行寫入產生不完整的檔案）"""
+        cache_path = self._cache_path(prompt)
+        if not cache_path:
+            return
         try:
-            genai.configure(api_key=api_key)
-            self.model = genai.GenerativeModel('gemini-2.0-flash-exp')
+            temp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({"corrections": corrections, "report": report_lines}, f, ensure_ascii=False)
+            os.replace(temp_path, cache_path)
         except Exception as e:
-            raise ValueError(f"API 金鑰錯誤，請檢查設定: {e}")
+            print(f"寫入校正快取失敗: {e}")
     
     @staticmethod
     def parse_srt(srt_path: str) -> Optional[Dict]:
@@ -101,12 +181,488 @@ class SubtitleCorrector:
         
         return True, "驗證通過"
     
-    def correct_subtitles(self, transcript_file: str, srt_file: str, batch_size: int = 20) -> Tuple[Optional[str], Optional[pysrt.SubRipFile], Optional[List[str]]]:
+    def skip_matching_cues(self, aligner: SubtitleAligner, srt_data: Dict, transcript_content: str,
+                           keys: List[int]) -> Tuple[Dict[int, str], List[str], Dict[int, int]]:
+        """預先比對：忽略標點寬度與空白後已與逐字稿相符的字幕直接視為完成
+        
+        Args:
+            aligner: 字幕對齊器
+            srt_data: 字幕數據字典
+            transcript_content: 預處理後的逐字稿
+            keys: 依順序排列的字幕編號
+            
+        Returns:
+            (已完成的字幕文字, 修改報告列表, 已完成字幕在逐字稿中的起點)
+        """
+        matches = aligner.match_exact([srt_data[key]['text'] for key in keys], transcript_content)
+        
+        done = {}
+        reports = []
+        anchors = {}
+        skipped_tokens = 0
+        for key, match in zip(keys, matches):
+            if not match:
+                continue
+            done[key] = match['text']
+            anchors[key] = match['start']
+            # 估算若送交 AI 需要的輸入與輸出 token
+            skipped_tokens += 2 * estimate_tokens(f"處理→ 編號{key}:{srt_data[key]['text']}\n")
+            if match['text'] != srt_data[key]['text']:
+                reports.append(f"編號{key}: {srt_data[key]['text']}: {match['text']}")
+        
+        summary = f"預先比對：{len(done)}/{len(keys)} 條字幕已與逐字稿相符，略過約 {skipped_tokens} 個 token"
+        print(summary)
+        reports.append(summary)
+        return done, reports, anchors
+    
+    def align_locally(self, aligner: SubtitleAligner, srt_data: Dict, transcript_content: str,
+                      keys: List[int], pending_keys: Optional[List[int]] = None) -> Tuple[Dict[int, str], List[int], List[str], Dict[int, int]]:
+        """以本地編輯距離對齊校正字幕，只把低信心的字幕留給 AI
+        
+        Args:
+            aligner: 字幕對齊器
+            srt_data: 字幕數據字典
+            transcript_content: 預處理後的逐字稿
+            keys: 依順序排列的字幕編號（全部字幕都參與對齊，以保持上下文連續）
+            pending_keys: 需要校正的編號，預設為全部
+            
+        Returns:
+            (已校正的字幕文字, 仍需 AI 校正的編號列表, 修改報告列表, 已校正字幕在逐字稿中的起點)
+        """
+        results = aligner.align([srt_data[key]['text'] for key in keys], transcript_content)
+        pending = set(keys if pending_keys is None else pending_keys)
+        
+        corrected = {}
+        llm_keys = []
+        reports = []
+        anchors = {}
+        for key, result in zip(keys, results):
+            if key not in pending:
+                continue
+            if result['confidence'] < aligner.confidence_threshold:
+                llm_keys.append(key)
+                continue
+            corrected[key] = result['text']
+            if result['start'] is not None:
+                anchors[key] = result['start']
+            if result['text'] != srt_data[key]['text']:
+                reports.append(f"編號{key}: {srt_data[key]['text']}: {result['text']}")
+        
+        print(f"本地對齊完成：{len(corrected)} 條字幕已校正，{len(llm_keys)} 條需要 AI 校正")
+        return corrected, llm_keys, reports, anchors
+    
+    def _transcript_window(self, aligner: SubtitleAligner, batch_keys: List[int], srt_data: Dict, transcript_content: str,
+                           positions: Dict[int, int], cursors: List[int], margin: int) -> Tuple[str, List[Tuple[int, int]]]:
+        """找出一批字幕在逐字稿中對應的區段
+        
+        批次中相鄰的字幕歸為同一群，每群各自定位一個視窗，
+        重疊的視窗會合併，不相連的視窗以省略號分隔。
+        
+        Args:
+            aligner: 字幕對齊器
+            batch_keys: 本批次（含上下文）的字幕編號
+            srt_data: 字幕數據字典
+            transcript_content: 預處理後的逐字稿
+            positions: 字幕編號在全部字幕中的位置
+            cursors: 每個位置之前最近的已知逐字稿位置
+            margin: 視窗前後額外保留的字元數
+            
+        Returns:
+            (逐字稿視窗文字, 視窗區間列表)
+        """
+        clusters = []
+        for key in sorted(batch_keys, key=lambda k: positions[k]):
+            if clusters and positions[key] - positions[clusters[-1][-1]] <= 1:
+                clusters[-1].append(key)
+            else:
+                clusters.append([key])
+        
+        ranges = []
+        for cluster in clusters:
+            start, end = aligner.locate_window(
+                [srt_data[key]['text'] for key in cluster],
+                transcript_content,
+                cursor=cursors[positions[cluster[0]]],
+                margin=margin
+            )
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+            else:
+                ranges.append((start, end))
+        
+        window = "\n……\n".join(transcript_content[start:end] for start, end in ranges)
+        return window, ranges
+    
+    def _build_batch_prompt(self, batch_keys: List[int], batch_context: Dict) -> Tuple[str, List[Tuple[int, int]]]:
+        """組合單一批次的提示詞
+        
+        Args:
+            batch_keys: 本批次需要處理的字幕編號
+            batch_context: 所有批次共用的資料（字幕、逐字稿、位置與游標等）
+            
+        Returns:
+            (完整提示詞, 逐字稿視窗區間列表)
+        """
+        keys = batch_context["keys"]
+        positions = batch_context["positions"]
+        srt_data = batch_context["srt_data"]
+        overlap = batch_context["overlap"]
+        
+        # 上下文取自完整字幕中緊接在各字幕之前的字幕
+        batch_with_context = []
+        for key in batch_keys:
+            position = positions[key]
+            for context_key in keys[max(0, position - overlap):position] + [key]:
+                if context_key not in batch_with_context:
+                    batch_with_context.append(context_key)
+        
+        # 在提示中標記哪些是實際需要處理的部分(非上下文)
+        subtitle_lines = []
+        for key in batch_with_context:
+            prefix = "處理→ " if key in batch_keys else "上下文: "
+            subtitle_lines.append(f"{prefix}編號{key}:{srt_data[key]['text']}")
+        
+        subtitle_content = "\n".join(subtitle_lines)
+        
+        # 只送出本批次對應的逐字稿區段，讓每批次的輸入量不隨文件長度增加
+        transcript_window, ranges = self._transcript_window(
+            batch_context["aligner"], batch_with_context, srt_data, batch_context["transcript"],
+            positions, batch_context["cursors"], batch_context["margin"]
+        )
+        
+        # 使用來自prompts/zh_prompt.py的提示詞模板
+        template = SUBTITLE_CORRECTION_JSON_PROMPT if batch_context["structured"] else SUBTITLE_CORRECTION_PROMPT
+        prompt = template.format(
+            subtitle_content=subtitle_content,
+            transcript_content=transcript_window
+        )
+        return prompt, ranges
+    
+    def plan_batches(self, llm_keys: List[int], batch_context: Dict, max_cues: Optional[int] = None,
+                     input_token_budget: int = 8000, output_token_budget: int = 4000,
+                     anchor_cues: int = 60) -> List[List[int]]:
+        """依預估的輸入與輸出 token 數量分配批次
+        
+        逐條加入字幕並累計預估量，任一方超過預算（或達到 max_cues）時開始新批次，
+        以最少的請求數完成校正，同時避免回應被截斷。
+        批次不會跨越每 anchor_cues 條字幕一個的固定錨點，修改一條字幕只會改變同一錨點區段內的批次，
+        其他區段的提示詞不變，仍可使用批次快取。
+        
+        Args:
+            llm_keys: 需要 AI 處理的字幕編號
+            batch_context: 所有批次共用的資料
+            max_cues: 每批次最多字幕數，None 表示只依預算決定
+            input_token_budget: 每批次輸入的 token 預算
+            output_token_budget: 每批次預期輸出的 token 預算
+            anchor_cues: 錨點間隔（以全部字幕中的位置計算），不小於 max_cues
+            
+        Returns:
+            批次列表，每個元素為該批次的字幕編號
+        """
+        keys = batch_context["keys"]
+        positions = batch_context["positions"]
+        srt_data = batch_context["srt_data"]
+        overlap = batch_context["overlap"]
+        structured = batch_context["structured"]
+        # 提示詞模板本身的固定成本
+        template = SUBTITLE_CORRECTION_JSON_PROMPT if structured else SUBTITLE_CORRECTION_PROMPT
+        template_tokens = estimate_tokens(template.format(subtitle_content="", transcript_content=""))
+        
+        anchor_cues = max(anchor_cues, max_cues or 0)
+        
+        batches = []
+        current = []
+        input_tokens, output_tokens = template_tokens, 0
+        
+        for key in llm_keys:
+            text = srt_data[key]['text']
+            line_tokens = estimate_tokens(f"處理→ 編號{key}:{text}\n")
+            text_tokens = estimate_tokens(text)
+            
+            # 輸入：字幕行加上對應的逐字稿片段（逐字稿通常比辨識結果略長）
+            base_in = line_tokens + int(text_tokens * 1.3) + 1
+            # 不相連的字幕會另開一段視窗，並帶入前面的上下文字幕
+            position = positions[key]
+            window_in = 2 * batch_context["margin"] + sum(
+                estimate_tokens(f"上下文: 編號{context_key}:{srt_data[context_key]['text']}\n")
+                for context_key in keys[max(0, position - overlap):position]
+            )
+            contiguous = current and position - positions[current[-1]] <= 1
+            cost_in = base_in if contiguous else base_in + window_in
+            # 輸出：校正後的字幕行加上報告中的修改說明（JSON 另有欄位名稱的開銷）
+            cost_out = line_tokens + 2 * text_tokens + (16 if structured else 8)
+            
+            if current and (position // anchor_cues != positions[current[0]] // anchor_cues
+                            or input_tokens + cost_in > input_token_budget
+                            or output_tokens + cost_out > output_token_budget
+                            or (max_cues and len(current) >= max_cues)):
+                batches.append(current)
+                current = []
+                input_tokens, output_tokens = template_tokens, 0
+                cost_in = base_in + window_in
+            
+            current.append(key)
+            input_tokens += cost_in
+            output_tokens += cost_out
+        
+        if current:
+            batches.append(current)
+        return batches
+    
+    def _request_batch(self, label: str, prompt: str, batch_keys: List[int], limiter: TokenBucket,
+                       max_retries: int = 3, structured: bool = False) -> Tuple[Dict[int, str], List[str], Optional[str]]:
+        """送出單一批次並解析回應，失敗時只重試本批次
+        
+        Args:
+            label: 批次標籤（僅用於日誌）
+            prompt: 完整提示詞
+            batch_keys: 本批次需要處理的字幕編號
+            limiter: 共用的限流器
+            max_retries: 最大重試次數
+            structured: 是否要求模型以 JSON 格式回應
+            
+        Returns:
+            (校正後的字幕文字, 修改報告列表, 錯誤信息或None)
+        """
+        # 輸入未改變的批次直接使用快取結果
+        cached = self._load_cached_batch(prompt)
+        if cached:
+            print(f"第 {label} 批次使用快取結果")
+            return cached[0], cached[1], None
+        
+        # 結構化模式要求模型依 RESPONSE_SCHEMA 回傳 JSON
+        generation_config = {
+            "responseMimeType": "application/json",
+            "responseSchema": self.RESPONSE_SCHEMA,
+        } if structured else None
+        
+        try:
+            # 429、5xx 與網路錯誤依統一的重試策略重試
+            response = call_with_retry(
+                "google_ai",
+                lambda key: generate_content(prompt, key, self.MODEL_NAME, generation_config),
+                label=f"第 {label} 批次",
+                policy=RetryPolicy(max_retries=max_retries),
+                limiter=limiter,
+                api_keys=self.api_key
+            )
+            corrected_subtitle = response.text
+        except Exception as retry_error:
+            return {}, [], str(retry_error)
+        
+        print(f"第 {label} 批次 Gemini 模型的回應：")
+        print(corrected_subtitle)
+        
+        if structured:
+            corrections, report_lines, complete = self._parse_json_response(corrected_subtitle, batch_keys)
+        else:
+            corrections, report_lines, complete = self._parse_text_response(corrected_subtitle, batch_keys)
+        
+        # 回應因輸出上限被截斷時，缺漏的編號交由拆分重試處理
+        truncated = self._is_truncated(response) or not complete
+        if truncated:
+            print(f"第 {label} 批次回應不完整")
+        
+        # 只快取完整的結果，缺漏編號的批次下次仍會重新校正
+        if not truncated and all(index in corrections for index in batch_keys):
+            self._store_cached_batch(prompt, corrections, report_lines)
+        
+        return corrections, report_lines, None
+    
+    @staticmethod
+    def _parse_text_response(response_text: str, batch_keys: List[int]) -> Tuple[Dict[int, str], List[str], bool]:
+        """解析以「處理→ 編號N:」逐行輸出的回應
+        
+        Args:
+            response_text: 模型回應文字
+            batch_keys: 本批次需要處理的字幕編號
+            
+        Returns:
+            (校正後的字幕文字, 修改報告列表, 回應是否完整)
+        """
+        # 使用 re.split 分割字幕和報告
+        parts = re.split(r'<<<分隔符號>>>', response_text, maxsplit=1) # 只分割一次
+        
+        corrections = {}
+        last_index = None
+        for line in parts[0].strip().split('\n'):
+            # 嚴格匹配「處理→」標記的編號字幕行
+            match = re.match(r'處理→ 編號(\d+)[:：](.*)', line.strip())
+            if match:
+                index = int(match.group(1))
+                
+                # 確保此編號在當前批次中且需要處理
+                if index in batch_keys:
+                    corrections[index] = match.group(2).strip()
+                    last_index = index
+        
+        # 沒有分隔符號表示回應可能被截斷，最後一行可能不完整
+        complete = len(parts) > 1
+        if not complete and last_index is not None:
+            del corrections[last_index]
+        
+        # 處理報告部分
+        report_lines = parts[1].strip().split('\n') if len(parts) > 1 else []
+        return corrections, report_lines, complete
+    
+    @staticmethod
+    def _parse_json_response(response_text: str, batch_keys: List[int]) -> Tuple[Dict[int, str], List[str], bool]:
+        """解析結構化輸出模式的 JSON 回應
+        
+        Args:
+            response_text: 模型回應文字
+            batch_keys: 本批次需要處理的字幕編號
+            
+        Returns:
+            (校正後的字幕文字, 修改報告列表, 回應是否完整)
+        """
+        try:
+            data = json.loads(response_text)
+            subtitles = data.get("subtitles") or []
+            changes = data.get("changes") or []
+        except (ValueError, AttributeError):
+            # JSON 不完整通常是輸出被截斷，整批交由拆分重試處理
+            return {}, [], False
+        
+        corrections = {}
+        for item in subtitles:
+            try:
+                index = int(item.get("index"))
+            except (TypeError, ValueError, AttributeError):
+                continue
+            text = item.get("text")
+            if index in batch_keys and isinstance(text, str):
+                corrections[index] = text.strip()
+        
+        report_lines = []
+        for change in changes:
+            if isinstance(change, dict) and change.get("index") is not None:
+                report_lines.append(f"編號{change.get('index')}: {change.get('original', '')}: {change.get('corrected', '')}")
+        
+        return corrections, report_lines, True
+    
+    def _check_corrections(self, label: str, corrections: Dict[int, str], srt_data: Dict) -> Dict[int, str]:
+        """逐條檢查校正結果，剔除空白或長度變化過大的字幕
+        
+        被剔除的字幕視同缺漏，會在子批次中單獨重送，
+        避免單條字幕讓 validate_srt 判定整份字幕失敗。
+        
+        Args:
+            label: 批次標籤（僅用於日誌）
+            corrections: 校正後的字幕文字
+            srt_data: 字幕數據字典
+            
+        Returns:
+            通過檢查的校正結果
+        """
+        valid = {}
+        for index, text in corrections.items():
+            orig_len = len(srt_data[index]['text'])
+            if not text and orig_len:
+                print(f"第 {label} 批次編號 {index} 回傳空白字幕，將重新校正")
+                continue
+            if abs(orig_len - len(text)) / max(1, orig_len) > self.MAX_LENGTH_CHANGE:
+                print(f"第 {label} 批次編號 {index} 的文字長度變化過大 (原 {orig_len}, 現 {len(text)})，將重新校正")
+                continue
+            valid[index] = text
+        return valid
+    
+    @staticmethod
+    def _accepted_report_lines(report_lines: List[str], corrections: Dict[int, str]) -> List[str]:
+        """只保留通過檢查的字幕的修改報告
+        
+        被剔除的字幕保留 Whisper 原文（或在子批次重新校正），其修改不應出現在報告中；
+        沒有標示編號的報告行照常保留。
+        
+        Args:
+            report_lines: 模型回傳的修改報告
+            corrections: 通過 _check_corrections 的校正結果
+            
+        Returns:
+            過濾後的修改報告
+        """
+        accepted = []
+        for line in report_lines:
+            match = re.match(r'\s*編號\s*(\d+)', line)
+            if match and int(match.group(1)) not in corrections:
+                continue
+            accepted.append(line)
+        return accepted
+    
+    @staticmethod
+    def _is_truncated(response) -> bool:
+        """判斷回應是否因達到輸出 token 上限而中斷"""
+        return getattr(response, 'finish_reason', None) == "MAX_TOKENS"
+    
+    def _correct_batch(self, label: str, batch_keys: List[int], batch_context: Dict,
+                       limiter: TokenBucket) -> Tuple[Dict[int, str], List[str], Optional[str]]:
+        """校正單一批次，回應缺少編號或被截斷時自動拆分重試
+        
+        部分編號缺漏時只重送缺漏的字幕；整批都沒有結果時對半拆分。
+        單條字幕仍缺漏則放棄，保留原始字幕內容。
+        
+        Args:
+            label: 批次標籤（子批次以「3-1」的形式標示）
+            batch_keys: 本批次需要處理的字幕編號
+            batch_context: 所有批次共用的資料
+            limiter: 共用的限流器
+            
+        Returns:
+            (校正後的字幕文字, 修改報告列表, 錯誤信息或None)
+        """
+        prompt, ranges = self._build_batch_prompt(batch_keys, batch_context)
+        print(f"第 {label} 批次 ({len(batch_keys)} 條字幕) 送出約 {estimate_tokens(prompt)} 個 token"
+              f"（逐字稿視窗 {', '.join(f'{start}-{end}' for start, end in ranges)}）")
+        
+        corrections, report_lines, error = self._request_batch(
+            label, prompt, batch_keys, limiter, structured=batch_context["structured"]
+        )
+        if error:
+            return corrections, report_lines, error
+        corrections = self._check_corrections(label, corrections, batch_context["srt_data"])
+        report_lines = self._accepted_report_lines(report_lines, corrections)
+        
+        missing = [key for key in batch_keys if key not in corrections]
+        if not missing or len(batch_keys) == 1:
+            return corrections, report_lines, None
+        
+        if len(missing) < len(batch_keys):
+            sub_batches = [missing]
+        else:
+            half = len(missing) // 2
+            sub_batches = [missing[:half], missing[half:]]
+        print(f"第 {label} 批次缺少編號 {', '.join(str(key) for key in missing)}，拆分為 {len(sub_batches)} 個子批次重試")
+        
+        for n, sub_keys in enumerate(sub_batches, 1):
+            sub_label = f"{label}-{n}"
+            sub_corrections, sub_reports, sub_error = self._correct_batch(sub_label, sub_keys, batch_context, limiter)
+            if sub_error:
+                report_lines.append(f"警告：第 {sub_label} 批次校正失敗，保留原始字幕 (編號 {sub_keys[0]}-{sub_keys[-1]})：{sub_error}")
+            corrections.update(sub_corrections)
+            report_lines.extend(sub_reports)
+        
+        return corrections, report_lines, None
+    
+    def correct_subtitles(self, transcript_file: str, srt_file: str, batch_size: Optional[int] = None,
+                          local_alignment: bool = True, confidence_threshold: float = 0.8,
+                          context_margin: int = 200, max_concurrency: int = 16,
+                          requests_per_minute: int = 60, skip_matching: bool = True,
+                          input_token_budget: int = 8000, output_token_budget: int = 4000,
+                          structured_output: bool = True) -> Tuple[Optional[str], Optional[pysrt.SubRipFile], Optional[List[str]]]:
         """進行字幕校正處理
         
         Args:
             transcript_file: 逐字稿文件路徑
-            batch_size: 批次大小
+            batch_size: 每批次最多字幕數，None 表示依 token 預算自動決定
+            local_alignment: 是否先以本地對齊校正，只將低信心字幕送交 AI
+            confidence_threshold: 本地對齊的信心值門檻
+            context_margin: 每批次逐字稿視窗前後額外保留的字元數
+            max_concurrency: 每把金鑰同時送出的批次數量上限（實際並行數由服務的 AIMD 控制器調整）
+            requests_per_minute: 每把金鑰每分鐘請求數上限
+            skip_matching: 是否先略過已與逐字稿相符的字幕
+            input_token_budget: 每批次輸入的 token 預算
+            output_token_budget: 每批次預期輸出的 token 預算
+            structured_output: 是否要求模型以 JSON 格式回應，逐條驗證後只重送有問題的字幕
             
         Returns:
             (錯誤信息, 更新後的SRT對象, 修改報告列表)
@@ -124,7 +680,6 @@ class SubtitleCorrector:
                     return f"錯誤: 找不到逐字稿檔案: {transcript_file}", None, None
                 with open(transcript_file, 'r', encoding='utf-8') as f:
                     transcript_content = f.read()
-            transcript_content = self.preprocess_transcript(transcript_content)
         except Exception as e:
             return f"讀取逐字稿檔案時出錯: {str(e)}", None, None
 
@@ -148,112 +703,145 @@ class SubtitleCorrector:
         except Exception as e:
             return f"處理 SRT 檔案時出錯: {str(e)}", None, None
         
-        # 創建工作副本
-        srt_data = original_srt_data.copy()
-        processed_srt_data = original_srt_data.copy()  # 新增一個存儲最終結果的字典
+        error, processed_srt_data, all_reports = self.correct_cues(
+            transcript_content, original_srt_data, batch_size,
+            local_alignment=local_alignment, confidence_threshold=confidence_threshold,
+            context_margin=context_margin, max_concurrency=max_concurrency,
+            requests_per_minute=requests_per_minute, skip_matching=skip_matching,
+            input_token_budget=input_token_budget, output_token_budget=output_token_budget,
+            structured_output=structured_output
+        )
+        if error:
+            return error, None, None
+        
+        error, new_srt = self.to_srt_file(processed_srt_data)
+        if error:
+            return error, None, None
+        return None, new_srt, all_reports
+    
+    def correct_cues(self, transcript_content: str, original_srt_data: Dict, batch_size: Optional[int] = None,
+                     local_alignment: bool = True, confidence_threshold: float = 0.8,
+                     context_margin: int = 200, max_concurrency: int = 16,
+                     requests_per_minute: int = 60, skip_matching: bool = True,
+                     input_token_budget: int = 8000, output_token_budget: int = 4000,
+                     structured_output: bool = True, context_keys: Optional[List[int]] = None,
+                     limiter: Optional[TokenBucket] = None) -> Tuple[Optional[str], Optional[Dict], Optional[List[str]]]:
+        """校正已解析的字幕數據
+        
+        context_keys 中的字幕只作為上下文（例如串流處理時前一組已送出校正的字幕），
+        參與逐字稿定位與批次的前文，但不會被校正或列入報告。
+        
+        Args:
+            transcript_content: 逐字稿內容
+            original_srt_data: 字幕數據字典（parse_srt 的格式）
+            batch_size: 每批次最多字幕數，None 表示依 token 預算自動決定
+            context_keys: 只作為上下文的字幕編號
+            limiter: 共用的請求速率限制器，None 表示依 requests_per_minute 建立
+            其餘參數同 correct_subtitles
+            
+        Returns:
+            (錯誤信息, 校正後的字幕數據字典, 修改報告列表)
+        """
+        transcript_content = self.preprocess_transcript(transcript_content)
+        context = set(context_keys or [])
+        
+        # 創建工作副本 (逐條複製，避免修改結果時連帶改動原始數據)
+        srt_data = {key: dict(value) for key, value in original_srt_data.items()}
+        processed_srt_data = {key: dict(value) for key, value in original_srt_data.items()}  # 新增一個存儲最終結果的字典
         
         # 儲存所有報告
         all_reports = []
         keys = list(srt_data.keys()) # 取得編號
+        processed_indices = set()
 
-        # 使用固定數量的重疊
-        overlap = 2  # 固定重疊2條字幕
+        aligner = SubtitleAligner(confidence_threshold=confidence_threshold)
+        anchors = {}
         
-        print(f"共有 {len(keys)} 條字幕需要處理")
+        # 預先比對，已與逐字稿相符的字幕不需要再處理（上下文字幕不校正）
+        pending_keys = [key for key in keys if key not in context]
+        if skip_matching:
+            done, match_reports, anchors = self.skip_matching_cues(aligner, srt_data, transcript_content, pending_keys)
+            for key, text in done.items():
+                processed_srt_data[key]['text'] = text
+                processed_indices.add(key)
+            all_reports.extend(match_reports)
+            pending_keys = [key for key in pending_keys if key not in done]
         
-        # 處理每個批次，使用固定重疊數量
-        for i in range(0, len(keys), batch_size - overlap):
-            end_idx = min(i + batch_size, len(keys))
-            batch_keys = keys[i:end_idx]
-            
-            # 確保前一批次的最後部分有重疊
-            context_start = max(0, i - overlap)
-            context_keys = keys[context_start:i] if i > 0 else []
-            
-            # 準備本批次處理的數據
-            batch_with_context = context_keys + batch_keys
-            context_batch_data = {key: srt_data[key] for key in batch_with_context}
-            
-            # 在提示中標記哪些是實際需要處理的部分(非上下文)
-            subtitle_lines = []
-            for key in batch_with_context:
-                prefix = "處理→ " if key in batch_keys else "上下文: "
-                subtitle_lines.append(f"{prefix}編號{key}:{context_batch_data[key]['text']}")
+        # 先以本地對齊校正，只有低信心的字幕需要送交 AI
+        if local_alignment and pending_keys:
+            corrected, llm_keys, local_reports, local_anchors = self.align_locally(
+                aligner, srt_data, transcript_content, keys, pending_keys
+            )
+            for key, text in corrected.items():
+                processed_srt_data[key]['text'] = text
+                processed_indices.add(key)
+            all_reports.extend(local_reports)
+            anchors.update(local_anchors)
+        else:
+            llm_keys = pending_keys
+
+        # 每條字幕附帶的前文上下文數量
+        overlap = 2
+        
+        print(f"共有 {len(keys) - len(context)} 條字幕，其中 {len(llm_keys)} 條需要 AI 處理")
+        
+        # 記錄每條字幕之前最近的已知逐字稿位置，作為定位視窗的游標
+        positions = {key: n for n, key in enumerate(keys)}
+        cursors = []
+        last_anchor = 0
+        for key in keys:
+            cursors.append(last_anchor)
+            last_anchor = anchors.get(key, last_anchor)
+        
+        batch_context = {
+            "keys": keys,
+            "positions": positions,
+            "cursors": cursors,
+            "srt_data": srt_data,
+            "transcript": transcript_content,
+            "aligner": aligner,
+            "overlap": overlap,
+            "margin": context_margin,
+            "structured": structured_output,
+        }
+        
+        # 依 token 預算分配批次，批次之間不再重複處理同一條字幕
+        batches = self.plan_batches(llm_keys, batch_context, batch_size, input_token_budget, output_token_budget)
+        if batches:
+            print(f"依 token 預算分為 {len(batches)} 個批次，每批 {', '.join(str(len(batch)) for batch in batches)} 條字幕")
+        
+        # 並行送出所有批次；並行數與每分鐘請求數以每把金鑰計算，多把金鑰時依比例放大
+        key_count = max(1, len(parse_api_keys(self.api_key)))
+        if limiter is None:
+            limiter = TokenBucket(rate=requests_per_minute * key_count / 60, capacity=max_concurrency * key_count)
+        batch_results = {}
+        if batches:
+            with ThreadPoolExecutor(max_workers=max_concurrency * key_count) as executor:
+                futures = {
+                    executor.submit(self._correct_batch, str(number), batch_keys, batch_context, limiter): number
+                    for number, batch_keys in enumerate(batches, 1)
+                }
+                for future in as_completed(futures):
+                    batch_results[futures[future]] = future.result()
+        
+        # 依批次順序合併結果
+        for number, batch_keys in enumerate(batches, 1):
+            corrections, report_lines, error = batch_results[number]
+            if error:
+                print(f"第 {number} 批次修正過程失敗：{error}")
+                all_reports.append(f"警告：第 {number} 批次校正失敗，保留原始字幕 (編號 {batch_keys[0]}-{batch_keys[-1]})：{error}")
+                continue
             
-            subtitle_content = "\n".join(subtitle_lines)
+            for index, corrected_text in corrections.items():
+                processed_srt_data[index]['text'] = corrected_text  # 將校正後的內容存入最終結果字典
+                processed_indices.add(index)
             
-            # 使用來自prompts/zh_prompt.py的提示詞模板
-            prompt = SUBTITLE_CORRECTION_PROMPT.format(
-                subtitle_content=subtitle_content,
-                transcript_content=transcript_content
-            )
+            # 檢查是否所有批次中的編號都被處理了
+            for index in batch_keys:
+                if index not in corrections:
+                    print(f"警告：編號 {index} 在AI處理後丟失，保持原始字幕內容")
             
-            try:
-                # 添加重試機制與間隔時間
-                max_retries = 3
-                retry_count = 0
-                retry_delay = 5  # 初始等待秒數
-                
-                while retry_count < max_retries:
-                    try:
-                        # 添加間隔時間以避免觸發限流
-                        if i > 0:
-                            print(f"等待 {retry_delay} 秒以避免達到API限制...")
-                            time.sleep(retry_delay)
-                        
-                        response = self.model.generate_content(prompt)
-                        corrected_subtitle = response.text
-                        print(f"第 {i // (batch_size - overlap) + 1} 批次 Gemini 模型的回應：")
-                        print(corrected_subtitle)
-                        break  # 成功獲取回應，跳出重試循環
-                        
-                    except Exception as retry_error:
-                        retry_count += 1
-                        if "429" in str(retry_error):
-                            print(f"遇到配額限制 (429)，重試 {retry_count}/{max_retries}...")
-                            retry_delay *= 2  # 指數退避策略
-                        else:
-                            # 其他錯誤，直接拋出
-                            raise retry_error
-                        
-                        if retry_count >= max_retries:
-                            raise retry_error
-                
-                # 使用 re.split 分割字幕和報告
-                parts = re.split(r'<<<分隔符號>>>', corrected_subtitle, maxsplit=1) # 只分割一次
-                
-                # 改進的字幕解析方法
-                corrected_lines = parts[0].strip().split('\n')
-                
-                # 建立一個映射表來追踪已處理的編號
-                processed_indices = set()
-                
-                for line in corrected_lines:
-                    # 嚴格匹配「處理→」標記的編號字幕行
-                    match = re.match(r'處理→ 編號(\d+)[:：](.*)', line.strip())
-                    if match:
-                        index = int(match.group(1))
-                        corrected_text = match.group(2).strip()
-                        
-                        # 確保此編號在當前批次中且需要處理
-                        if index in batch_keys:
-                            processed_srt_data[index]['text'] = corrected_text  # 將校正後的內容存入最終結果字典
-                            processed_indices.add(index)
-                            print(f"已處理編號 {index} 的字幕")
-                
-                # 檢查是否所有批次中的編號都被處理了
-                for index in batch_keys:
-                    if index not in processed_indices:
-                        print(f"警告：編號 {index} 在AI處理後丟失，保持原始字幕內容")
-                
-                # 處理報告部分
-                if len(parts) > 1:
-                    report = parts[1] # 取得修改清單文字
-                    report_lines = report.strip().split('\n')
-                    all_reports.extend(report_lines)
-
-            except Exception as e:
-                return f"第 {i // (batch_size - overlap) + 1} 批次修正過程失敗：{e}", None, None
+            all_reports.extend(report_lines)
         
         # 驗證修改後的SRT結構
         is_valid, error_msg = self.validate_srt(original_srt_data, processed_srt_data)
@@ -262,7 +850,25 @@ class SubtitleCorrector:
         
         print(f"完成所有字幕的處理，共處理了 {len(processed_indices)} 條字幕")
         
-        # 寫回 SRT 檔案
+        # 報告中列出仍需要 AI 校正的字幕
+        if local_alignment or skip_matching:
+            if llm_keys:
+                all_reports.append(f"需要 AI 校正的字幕編號: {', '.join(str(key) for key in llm_keys)}")
+            else:
+                all_reports.append("所有字幕皆已由本地對齊校正，未呼叫 AI")
+        
+        return None, processed_srt_data, all_reports
+    
+    @staticmethod
+    def to_srt_file(processed_srt_data: Dict) -> Tuple[Optional[str], Optional[pysrt.SubRipFile]]:
+        """將字幕數據字典轉換為 SRT 物件
+        
+        Args:
+            processed_srt_data: 字幕數據字典
+            
+        Returns:
+            (錯誤信息, SRT對象)
+        """
         new_subs = []
         for index, data in sorted(processed_srt_data.items()):  # 確保按編號順序排序
             try:
@@ -288,11 +894,10 @@ class SubtitleCorrector:
         
         # 檢查是否有成功創建字幕
         if not new_subs:
-            return "無法創建有效的字幕項目", None, None
+            return "無法創建有效的字幕項目", None
         
         # 將 new_subs 轉換為 SubRipFile 物件
         try:
-            new_srt = pysrt.SubRipFile(items=new_subs)
-            return None, new_srt, all_reports
+            return None, pysrt.SubRipFile(items=new_subs)
         except Exception as e:
-            return f"創建字幕文件失敗：{e}", None, None
\ No newline at end of file
+            return f"創建字幕文件失敗：{e}", None
\ No newline at end of file
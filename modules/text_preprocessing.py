@@ -1,6 +1,19 @@
 import re
+from concurrent.futures import ThreadPoolExecutor
 from prompts import TEXT_PREPROCESSING_PROMPTS
-from utils.api_handler import process_with_ai, APIError
+from utils.api_handler import process_with_ai, process_with_ai_stream, APIError
+from utils.key_pool import parse_api_keys
+from utils.token_counter import estimate_tokens
+from modules.rule_segmenter import RuleSegmenter
+
+# 句末標點：段落過長需要強制切開時的斷點，也用於判斷分塊邊界的句子是否完整
+SENTENCE_END_PUNCTUATION = "。！？!?；;…"
+# 子句標點：句子本身仍超過預算時的次要斷點
+CLAUSE_PUNCTUATION = "，、,：:"
+# 每個分段的字數上限（與提示詞的規則一致）
+MAX_SEGMENT_CHARS = 70
+# 分段切割符（單獨一行的 ---）
+SEGMENT_SEPARATOR_PATTERN = re.compile(r'^\s*---\s*$', re.MULTILINE)
 
 class PreprocessingError(Exception):
     """文本預處理錯誤"""
@@ -28,7 +41,7 @@ def validate_api_key(api_key):
     """驗證 API 金鑰是否有效
     
     Args:
-        api_key (str): API 金鑰
+        api_key (str): API 金鑰，多把金鑰以逗號分隔
         
     Returns:
         bool: 是否有效
@@ -36,11 +49,12 @@ def validate_api_key(api_key):
     Raises:
         PreprocessingError: API 金鑰無效
     """
-    if not api_key or not api_key.strip():
+    keys = parse_api_keys(api_key)
+    if not keys:
         raise PreprocessingError("API 金鑰不能為空")
     
-    # 簡單的格式檢查，實際使用中可能需要更嚴格的驗證
-    if not re.match(r'^[A-Za-z0-9_\-]+$', api_key.strip()):
+    # 簡單的格式檢查，實際使用中可能需要更嚴格的驗證；多把金鑰以逗號分隔，逐一檢查
+    if not all(re.match(r'^[A-Za-z0-9_\-]+$', key) for key in keys):
         raise PreprocessingError("API 金鑰格式不正確")
     
     return True
@@ -75,13 +89,161 @@ def format_processed_text(processed_text):
     # 合併並返回結果
     return '\n'.join(result_lines)
 
-def preprocess_text(text, language, api_key):
+def split_into_chunks(text, max_tokens=3000):
+    """依段落邊界將文本切成不超過 token 預算的區塊
+    
+    Args:
+        text (str): 原始文本
+        max_tokens (int): 每個區塊的 token 預算
+        
+    Returns:
+        list: 區塊文本列表
+    """
+    paragraphs = []
+    for paragraph in text.split('\n'):
+        if not paragraph.strip():
+            continue
+        if estimate_tokens(paragraph) <= max_tokens:
+            paragraphs.append(paragraph)
+            continue
+        # 單一段落超過預算時，依序嘗試在句末標點、子句標點處切開，最後才依字數硬切
+        for punctuation in (SENTENCE_END_PUNCTUATION, SENTENCE_END_PUNCTUATION + CLAUSE_PUNCTUATION):
+            pieces = re.findall(rf'[^{punctuation}]*[{punctuation}]+|[^{punctuation}]+$', paragraph)
+            if all(estimate_tokens(piece) <= max_tokens for piece in pieces):
+                break
+        else:
+            pieces = [paragraph[i:i + max_tokens] for i in range(0, len(paragraph), max_tokens)]
+        
+        current = ""
+        for piece in pieces:
+            if current and estimate_tokens(current + piece) > max_tokens:
+                paragraphs.append(current)
+                current = ""
+            current += piece
+        if current:
+            paragraphs.append(current)
+    
+    chunks = []
+    current = []
+    current_tokens = 0
+    for paragraph in paragraphs:
+        tokens = estimate_tokens(paragraph)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append('\n'.join(current))
+            current = []
+            current_tokens = 0
+        current.append(paragraph)
+        current_tokens += tokens
+    if current:
+        chunks.append('\n'.join(current))
+    
+    return chunks
+
+def split_segments(processed_text):
+    """將以 --- 分隔的處理結果切成分段列表（忽略空白分段）"""
+    return [segment.strip() for segment in SEGMENT_SEPARATOR_PATTERN.split(processed_text) if segment.strip()]
+
+def iter_new_segments(snapshots):
+    """從逐步更新的完整處理結果中取出新完成的分段
+
+    preprocess_text_stream 每次返回目前為止的完整結果，最後一段可能仍在生成，
+    或在區塊交界處與下一個區塊的第一段合併，因此只在後面出現新分段時才視為完成；
+    串流結束時返回剩餘的分段。
+
+    Args:
+        snapshots (Iterable[str]): 依序更新的完整處理結果
+
+    Yields:
+        str: 已完成的分段文字
+    """
+    emitted = 0
+    segments = []
+    for snapshot in snapshots:
+        segments = split_segments(snapshot)
+        while emitted < len(segments) - 1:
+            yield segments[emitted]
+            emitted += 1
+
+    for segment in segments[emitted:]:
+        yield segment
+
+def stitch_chunks(results):
+    """依順序合併各區塊的處理結果，並修補區塊交界處的分段
+    
+    前一個區塊的最後一段若沒有以句末標點結束（句子在分塊時被切開），
+    且與下一個區塊的第一段合併後不超過字數上限，就將兩段合併。
+    
+    Args:
+        results (list): 各區塊格式化後的處理結果
+        
+    Returns:
+        str: 以 --- 分隔的完整結果
+    """
+    merged = []
+    for result in results:
+        segments = split_segments(result)
+        if merged and segments:
+            last = merged[-1]
+            combined_length = len(re.sub(r'\s', '', last + segments[0]))
+            if last[-1] not in SENTENCE_END_PUNCTUATION and combined_length <= MAX_SEGMENT_CHARS:
+                merged[-1] = last + '\n' + segments[0]
+                segments = segments[1:]
+        merged.extend(segments)
+    
+    return '\n---\n'.join(merged)
+
+def _key_count(api_key):
+    """金鑰數量；並行數以每把金鑰計算，多把金鑰時依比例放大"""
+    return max(1, len(parse_api_keys(api_key)))
+
+def _preprocess_with_ai(text, prompt, api_key, chunk_tokens, max_concurrency, use_cache=False):
+    """以 AI 預處理文本，長文本切塊並行處理後合併
+    
+    Args:
+        text (str): 原始文本
+        prompt (str): 提示詞模板
+        api_key (str): Google AI API 金鑰
+        chunk_tokens (int): 每個區塊的 token 預算
+        max_concurrency (int): 每把金鑰同時處理的區塊數量上限（實際並行數由服務的 AIMD 控制器調整）
+        use_cache (bool): 是否使用 AI 回應快取
+        
+    Returns:
+        str: 處理後的文本
+    """
+    # 依段落切塊，短文本只有一個區塊
+    chunks = split_into_chunks(text, chunk_tokens)
+    if len(chunks) <= 1:
+        # 調用 API 處理文本
+        processed_text = process_with_ai("google_ai", prompt, text, api_key, cache=use_cache)
+        
+        # 格式化處理結果
+        return format_processed_text(processed_text)
+    
+    print(f"文本切分為 {len(chunks)} 個區塊並行處理")
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency * _key_count(api_key))) as executor:
+        # executor.map 依輸入順序回傳結果
+        results = list(executor.map(
+            lambda chunk: format_processed_text(process_with_ai("google_ai", prompt, chunk, api_key, cache=use_cache)),
+            chunks
+        ))
+    
+    # 依原順序合併並修補區塊交界
+    return stitch_chunks(results)
+
+def preprocess_text(text, language, api_key, chunk_tokens=3000, max_concurrency=16, use_rules=True, use_cache=False):
     """預處理文本
     
+    中文文本預設先以規則分段器在本地切分，只有規則無法處理的段落才交給 AI；
+    長文本依段落切成多個區塊並行處理，再依原順序合併，避免單次請求超過輸出上限而被截斷。
+    
     Args:
         text (str): 原始文本
         language (str): 語言代碼 ("zh" 或 "en")
-        api_key (str): Google AI API 金鑰
+        api_key (str): Google AI API 金鑰（全部段落都能以規則處理時可為空）
+        chunk_tokens (int): 每個區塊的 token 預算
+        max_concurrency (int): 每把金鑰同時處理的區塊數量上限（實際並行數由服務的 AIMD 控制器調整）
+        use_rules (bool): 是否先以規則分段（僅支援中文）
+        use_cache (bool): 是否使用 AI 回應快取（相同文本重新處理時不再呼叫 API）
         
     Returns:
         str: 處理後的文本
@@ -92,22 +254,98 @@ def preprocess_text(text, language, api_key):
     try:
         # 驗證輸入
         validate_text(text)
-        validate_api_key(api_key)
         
         # 獲取對應語言的提示詞
         prompt = TEXT_PREPROCESSING_PROMPTS.get(language)
         if not prompt:
             raise PreprocessingError(f"不支持的語言: {language}")
         
-        # 調用 API 處理文本
-        processed_text = process_with_ai("google_ai", prompt, text, api_key)
+        if use_rules and language == "zh":
+            results, paragraphs = RuleSegmenter().segment(text)
+            failed = [paragraph for paragraph, result in zip(paragraphs, results) if result is None]
+            
+            if failed:
+                # 規則無法處理的段落交給 AI，各段落並行處理
+                if not api_key or not api_key.strip():
+                    raise PreprocessingError(f"有 {len(failed)} 個段落無法以規則分段，請提供 API 金鑰以 AI 處理")
+                validate_api_key(api_key)
+                print(f"{len(failed)} 個段落無法以規則分段，改由 AI 處理")
+                with ThreadPoolExecutor(max_workers=max(1, max_concurrency * _key_count(api_key))) as executor:
+                    ai_results = iter(list(executor.map(
+                        lambda paragraph: split_segments(_preprocess_with_ai(paragraph, prompt, api_key, chunk_tokens, 1, use_cache)),
+                        failed
+                    )))
+                results = [result if result is not None else next(ai_results) for result in results]
+            
+            return '\n---\n'.join(segment for result in results for segment in result)
         
-        # 格式化處理結果
-        formatted_text = format_processed_text(processed_text)
+        validate_api_key(api_key)
+        return _preprocess_with_ai(text, prompt, api_key, chunk_tokens, max_concurrency, use_cache)
+        
+    except PreprocessingError:
+        raise
+    except APIError as e:
+        raise PreprocessingError(f"API 錯誤: {str(e)}")
+    except Exception as e:
+        raise PreprocessingError(f"預處理錯誤: {str(e)}")
+
+def preprocess_text_stream(text, language, api_key, chunk_tokens=3000, max_concurrency=16, use_rules=True, use_cache=False):
+    """串流版本的文本預處理，每收到新結果就返回目前為止的完整處理結果
+    
+    單一區塊時使用串流 API，文字一到達就更新；多個區塊時並行處理，
+    依原順序返回已完成的部分。規則分段幾乎是即時的，直接返回最終結果。
+    
+    Args:
+        text (str): 原始文本
+        language (str): 語言代碼 ("zh" 或 "en")
+        api_key (str): Google AI API 金鑰
+        chunk_tokens (int): 每個區塊的 token 預算
+        max_concurrency (int): 每把金鑰同時處理的區塊數量上限（實際並行數由服務的 AIMD 控制器調整）
+        use_rules (bool): 是否先以規則分段（僅支援中文）
+        use_cache (bool): 是否使用 AI 回應快取（相同文本重新處理時不再呼叫 API）
+        
+    Yields:
+        str: 目前為止的處理結果
+        
+    Raises:
+        PreprocessingError: 處理過程中的錯誤
+    """
+    try:
+        validate_text(text)
+        
+        prompt = TEXT_PREPROCESSING_PROMPTS.get(language)
+        if not prompt:
+            raise PreprocessingError(f"不支持的語言: {language}")
+        
+        if use_rules and language == "zh":
+            yield preprocess_text(text, language, api_key, chunk_tokens, max_concurrency, use_rules, use_cache)
+            return
+        
+        validate_api_key(api_key)
+        chunks = split_into_chunks(text, chunk_tokens)
+        
+        if len(chunks) <= 1:
+            received = ""
+            for piece in process_with_ai_stream("google_ai", prompt, text, api_key, cache=use_cache):
+                received += piece
+                yield format_processed_text(received)
+            return
+        
+        def process_chunk(chunk):
+            return format_processed_text(process_with_ai("google_ai", prompt, chunk, api_key, cache=use_cache))
         
-        return formatted_text
+        print(f"文本切分為 {len(chunks)} 個區塊並行處理")
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency * _key_count(api_key))) as executor:
+            futures = [executor.submit(process_chunk, chunk) for chunk in chunks]
+            results = []
+            # 依原順序等待，每完成一個區塊就返回合併後的結果
+            for future in futures:
+                results.append(future.result())
+                yield stitch_chunks(results)
         
+    except PreprocessingError:
+        raise
     except APIError as e:
         raise PreprocessingError(f"API 錯誤: {str(e)}")
     except Exception as e:
-        raise PreprocessingError(f"預處理錯誤: {str(e)}")
\ No newline at end of file
+        raise PreprocessingError(f"預處理錯誤: {str(e)}")
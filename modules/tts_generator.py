@@ -12,6 +12,9 @@ import logging
 
 # 導入全局配置
 from modules import HAILUO_GROUP_ID, TTS_VOICES, TTS_EMOTIONS, DEFAULT_PRONUNCIATION_DICT, AUDIO_SETTINGS
+from modules.pattern_matcher import PatternMatcher
+from utils.api_handler import APIError, call_hedged, get_session
+from utils.key_pool import parse_api_keys
 logging.basicConfig(
     filename='tts_debug.log',
     level=logging.DEBUG,
@@ -46,15 +49,20 @@ class TTSGenerator:
     # 使用全局情緒列表
     EMOTIONS = TTS_EMOTIONS
     
+    # base_resp 中代表限流的狀態碼（RPM / TPM 超限）
+    RATE_LIMIT_STATUS_CODES = (1002, 1039)
+    
     def __init__(self, api_key, group_id=HAILUO_GROUP_ID, output_dir=None):
         """初始化TTS生成器
         
         Args:
-            api_key: Hailuo API 密鑰
+            api_key: Hailuo API 密鑰（同一 GroupId 的多把金鑰以逗號分隔）
             group_id: Hailuo Group ID，默認為全局配置的 HAILUO_GROUP_ID
             output_dir: 音頻文件輸出目錄，如果為None則使用臨時目錄
         """
         self.api_key = api_key
+        # 可提供以逗號分隔的多把金鑰，單次請求的方法使用第一把
+        self.api_keys = parse_api_keys(api_key)
         self.group_id = group_id
         
         # 設置輸出目錄
@@ -78,40 +86,87 @@ class TTSGenerator:
         """
         pronunciation_dict = self.DEFAULT_PRONUNCIATION_DICT.copy()
         
-        if custom_entries and isinstance(custom_entries, str) and custom_entries.strip():
-            # 將用戶輸入分割成單獨的條目
-            entries = [entry.strip() for entry in custom_entries.split(',')]
-            entries = [entry for entry in entries if entry]  # 過濾空條目
-            
-            # 合併到默認字典
-            if entries:
-                pronunciation_dict["tone"] = pronunciation_dict["tone"] + entries
+        entries = self._parse_custom_entries(custom_entries)
+        
+        # 合併到默認字典
+        if entries:
+            pronunciation_dict["tone"] = pronunciation_dict["tone"] + entries
         
         return pronunciation_dict
+    
+    @staticmethod
+    def _parse_custom_entries(custom_entries):
+        """將用戶輸入的發音詞條字串分割成詞條列表"""
+        if not custom_entries or not isinstance(custom_entries, str) or not custom_entries.strip():
+            return []
+        # 將用戶輸入分割成單獨的條目，並過濾空條目
+        entries = [entry.strip() for entry in custom_entries.split(',')]
+        return [entry for entry in entries if entry]
+    
+    def compile_pronunciation_dict(self, custom_entries=None, homophone_dictionary=None):
+        """將發音詞條編譯成多模式比對器，用於找出每個段落實際用到的詞條
+        
+        詞條的鍵為「/」之前的文字。同一個鍵以用戶自定義詞條優先，其次為預設字典，
+        最後為多音字字典（以「使用詞/替換後的詞」的形式加入）。
+        
+        Args:
+            custom_entries: 用戶自定義的發音詞條，格式為 "字詞/(拼音),..."
+            homophone_dictionary: 多音字字典條目列表（HomophoneReplacer.dictionary）
+            
+        Returns:
+            PatternMatcher: 鍵為詞條文字、值為完整詞條的比對器
+        """
+        matcher = PatternMatcher()
+        
+        for entry in self._parse_custom_entries(custom_entries) + list(self.DEFAULT_PRONUNCIATION_DICT["tone"]):
+            key = entry.split('/', 1)[0].strip()
+            if key and '/' in entry:
+                matcher.add(key, entry)
+        
+        for item in homophone_dictionary or []:
+            if 'usecase' in item and 'original' in item and 'modified' in item:
+                for word in item['usecase']:
+                    replaced = word.replace(item['original'], item['modified'])
+                    if replaced != word:
+                        matcher.add(word, f"{word}/{replaced}")
+        
+        return matcher.build()
+    
+    @staticmethod
+    def segment_pronunciation_dict(matcher, segment):
+        """產生只包含段落中實際出現詞條的發音字典
+        
+        Args:
+            matcher: compile_pronunciation_dict 建立的比對器
+            segment: 段落文本
+            
+        Returns:
+            dict: {"tone": [...]}，段落中沒有任何詞條時返回空字典
+        """
+        entries = []
+        seen = set()
+        for _, _, key in matcher.find_all(segment):
+            if key not in seen:
+                seen.add(key)
+                entries.append(matcher.get(key))
+        return {"tone": entries} if entries else {}
 
     def generate_speech(self, text, voice_name="訓練長", emotion="neutral", 
-                       speed=1.0, custom_pronunciation=None, progress_callback=None, identifier=None):
-        """生成語音"""
+                       speed=1.0, custom_pronunciation=None, progress_callback=None, identifier=None,
+                       use_pronunciation_dict=False, homophone_dictionary=None, hedge=False):
+        """生成語音
+        
+        use_pronunciation_dict 為 True 時，每個段落只附上該段落實際用到的發音詞條，
+        多音字由 API 依發音字典處理，文本不需要事先替換。
+        hedge 為 True 時，延遲異常的段落會送出備援請求（見 call_tts_api）。
+        """
         # 首先測試 API 連接
         print("開始 API 連接測試...")
         if not self.test_api_connection():
             raise TTSGenerationError("無法連接到 Hailuo API，請檢查網絡和 API 密鑰")
         
-        # 檢查參數
-        if voice_name not in self.VOICE_ID_MAP:
-            raise TTSGenerationError(f"無效的語音名稱: {voice_name}")
-        
-        if emotion not in self.EMOTIONS:
-            raise TTSGenerationError(f"無效的情緒設定: {emotion}")
-        
-        if not 0.5 <= speed <= 2.0:
-            raise TTSGenerationError(f"語速必須在 0.5 到 2.0 之間")
-        
         # 應用語音設定
-        voice_settings = self.DEFAULT_VOICE_SETTINGS.copy()
-        voice_settings["voice_id"] = self.VOICE_ID_MAP[voice_name]
-        voice_settings["speed"] = speed
-        voice_settings["emotion"] = emotion
+        voice_settings = self.build_voice_settings(voice_name, emotion, speed)
         
         # 清理輸出目錄中的舊文件
         for file in self.output_dir.glob("*.mp3"):
@@ -130,6 +185,12 @@ class TTSGenerator:
         if not identifier:
             raise TTSGenerationError("無效的處理識別碼")
             
+        # 編譯發音字典，每個段落只送出實際出現的詞條
+        pronunciation_matcher = None
+        if use_pronunciation_dict:
+            pronunciation_matcher = self.compile_pronunciation_dict(custom_pronunciation, homophone_dictionary)
+            print(f"發音字典共 {len(pronunciation_matcher)} 個詞條")
+        
         # 生成每個段落的語音
         mp3_files = []
         # 使用 identifier 作為時間戳命名 zip 檔案
@@ -145,42 +206,9 @@ class TTSGenerator:
                     
                     print(f"\n開始處理段落 {i+1}/{len(segments)}")
                     
-                    # 生成MP3文件名
-                    mp3_filename = self.output_dir / f"{str(i+1).zfill(2)}.mp3"
-                    
-                    # 調用API生成語音
-                    print(f"呼叫 API 生成語音...")
-                    success = self.call_tts_api(
-                        segment, 
-                        voice_settings, 
-                        self.DEFAULT_AUDIO_SETTINGS, 
-                        {}, # 空字典，已停用發音字典功能
-                        mp3_filename
-                    )
-                    
-                    if success:
-                        print(f"段落 {i+1} 語音生成成功")
-                        mp3_files.append(mp3_filename)
-                        zipf.write(mp3_filename, mp3_filename.name)
-                    else:
-                        # 嘗試使用更簡短的文本
-                        if len(segment) > 100:
-                            short_segment = segment[:100] + "..."
-                            print(f"嘗試使用縮短的段落文本...")
-                            success = self.call_tts_api(
-                                short_segment,
-                                voice_settings,
-                                self.DEFAULT_AUDIO_SETTINGS,
-                                {},
-                                mp3_filename
-                            )
-                            if success:
-                                print(f"使用縮短文本成功生成語音")
-                                mp3_files.append(mp3_filename)
-                                zipf.write(mp3_filename, mp3_filename.name)
-                                continue
-                        
-                        raise TTSGenerationError(f"無法生成語音: 段落 {i+1}")
+                    mp3_filename = self.synthesize_segment(i + 1, segment, voice_settings, pronunciation_matcher, hedge)
+                    mp3_files.append(mp3_filename)
+                    zipf.write(mp3_filename, mp3_filename.name)
                 
                 # 完成
                 if progress_callback:
@@ -196,15 +224,85 @@ class TTSGenerator:
                 os.remove(zip_path)
             raise TTSGenerationError(f"語音生成失敗: {str(e)}")
     
-    def call_tts_api(self, text, voice_settings, audio_settings, pronunciation_dict, output_filename):
-        """調用 Hailuo API 進行文本到語音的轉換"""
+    def build_voice_settings(self, voice_name="訓練長", emotion="neutral", speed=1.0):
+        """檢查並組合語音設定
+        
+        Returns:
+            dict: voice_setting 請求參數
+            
+        Raises:
+            TTSGenerationError: 語音名稱、情緒或語速無效
+        """
+        if voice_name not in self.VOICE_ID_MAP:
+            raise TTSGenerationError(f"無效的語音名稱: {voice_name}")
+        
+        if emotion not in self.EMOTIONS:
+            raise TTSGenerationError(f"無效的情緒設定: {emotion}")
+        
+        if not 0.5 <= speed <= 2.0:
+            raise TTSGenerationError(f"語速必須在 0.5 到 2.0 之間")
+        
+        voice_settings = self.DEFAULT_VOICE_SETTINGS.copy()
+        voice_settings["voice_id"] = self.VOICE_ID_MAP[voice_name]
+        voice_settings["speed"] = speed
+        voice_settings["emotion"] = emotion
+        return voice_settings
+    
+    def synthesize_segment(self, number, segment, voice_settings, pronunciation_matcher=None, hedge=False):
+        """生成單一段落的語音，寫入 output_dir 下的 {編號}.mp3
+        
+        失敗且段落超過 100 字時改以縮短的文本再試一次。
+        
+        Args:
+            number: 段落編號（從 1 開始）
+            segment: 段落文本
+            voice_settings: build_voice_settings 返回的語音設定
+            pronunciation_matcher: compile_pronunciation_dict 編譯的發音詞條，None 表示不使用
+            hedge: 延遲異常時是否送出備援請求
+            
+        Returns:
+            Path: MP3 檔案路徑
+            
+        Raises:
+            TTSGenerationError: 無法生成語音
+        """
+        mp3_filename = self.output_dir / f"{str(number).zfill(2)}.mp3"
+        
+        # 只包含本段落用到的發音詞條，未啟用時為空字典
+        pronunciation_dict = {}
+        if pronunciation_matcher:
+            pronunciation_dict = self.segment_pronunciation_dict(pronunciation_matcher, segment)
+            print(f"段落 {number} 使用 {len(pronunciation_dict.get('tone', []))} 個發音詞條")
+        
+        # 調用API生成語音
+        print(f"呼叫 API 生成語音...")
+        if self.call_tts_api(segment, voice_settings, self.DEFAULT_AUDIO_SETTINGS, pronunciation_dict,
+                             mp3_filename, hedge=hedge):
+            print(f"段落 {number} 語音生成成功")
+            return mp3_filename
+        
+        # 嘗試使用更簡短的文本
+        if len(segment) > 100:
+            print(f"嘗試使用縮短的段落文本...")
+            if self.call_tts_api(segment[:100] + "...", voice_settings, self.DEFAULT_AUDIO_SETTINGS,
+                                 pronunciation_dict, mp3_filename, hedge=hedge):
+                print(f"使用縮短文本成功生成語音")
+                return mp3_filename
+        
+        raise TTSGenerationError(f"無法生成語音: 段落 {number}")
+    
+    def call_tts_api(self, text, voice_settings, audio_settings, pronunciation_dict, output_filename, hedge=False):
+        """調用 Hailuo API 進行文本到語音的轉換
+        
+        hedge 為 True 時，請求超過近期延遲的 p95 仍未返回會在預算內送出備援請求，先完成者勝出；
+        請求只返回音訊內容，由勝出的結果寫入檔案一次。
+        """
         url = f"https://api.minimaxi.chat/v1/t2a_v2?GroupId={self.group_id}"
         headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {self.api_key}"
+        "Content-Type": "application/json"
         }
     
-        # 準備請求數據（已停用發音字典）
+        # 準備請求數據
         data = {
         "model": "speech-01-hd",
         "text": text,
@@ -212,15 +310,20 @@ class TTSGenerator:
         "voice_setting": voice_settings,
         "audio_setting": audio_settings
         }
+        
+        # 只有在發音字典有詞條時才加入請求
+        if pronunciation_dict and pronunciation_dict.get("tone"):
+            data["pronunciation_dict"] = pronunciation_dict
     
         # 輸出詳細請求資訊以供調試
         print(f"請求 URL: {url}")
         print(f"請求標頭: {headers}")
         print(f"請求資料: {json.dumps(data, ensure_ascii=False, indent=2)}")
     
-        try:
-            # 發送請求
-            response = requests.post(url, headers=headers, json=data)
+        def send(key):
+            # 發送請求（api_key 可為同一 GroupId 下的多把金鑰，每次嘗試由金鑰池挑選）
+            response = get_session("hailuo", key).post(url, headers=dict(headers, Authorization=f"Bearer {key}"),
+                                                       json=data, timeout=120)
             
             # 詳細記錄響應
             print(f"狀態碼: {response.status_code}")
@@ -232,25 +335,33 @@ class TTSGenerator:
                 print(f"響應資料: {json.dumps(response_data, ensure_ascii=False, indent=2)}")
             except json.JSONDecodeError:
                 print(f"無法解析 JSON 響應: {response.text}")
+                response_data = {}
             
-            # 檢查狀態碼
+            # 檢查狀態碼（429 / 5xx 由 call_with_retry 重試）
             response.raise_for_status()
             
-            # 確認存在適當的響應結構
-            if "data" in response_data and "audio" in response_data["data"]:
-                hex_audio = response_data["data"]["audio"]
-                audio_data = bytes.fromhex(hex_audio)
-                
-                with open(output_filename, 'wb') as f:
-                    f.write(audio_data)
-                return True
-            else:
-                print(f"API 回應缺少音訊資料: {response_data}")
-                return False
+            # Hailuo 的限流以 HTTP 200 搭配 base_resp 狀態碼回傳
+            base_status = (response_data.get("base_resp") or {}).get("status_code")
+            if base_status in self.RATE_LIMIT_STATUS_CODES:
+                raise APIError(f"Hailuo 配額限制: {response_data['base_resp'].get('status_msg')}",
+                               status_code=429, response=response)
+            
+            # 確認存在適當的響應結構；缺少音訊時視為失敗，讓備援請求有機會勝出
+            if "data" in response_data and "audio" in (response_data["data"] or {}):
+                return bytes.fromhex(response_data["data"]["audio"])
+            raise APIError(f"API 回應缺少音訊資料: {response_data}")
+        
+        try:
+            audio_data = call_hedged("hailuo", send, label=f"Hailuo TTS {Path(output_filename).name}",
+                                     hedge="hailuo_tts" if hedge else None, api_keys=self.api_key)
+            
+            with open(output_filename, 'wb') as f:
+                f.write(audio_data)
+            return True
         
         except requests.exceptions.RequestException as e:
             print(f"請求錯誤: {e}")
-            if hasattr(e, 'response') and e.response:
+            if hasattr(e, 'response') and e.response is not None:
                 print(f"錯誤響應: {e.response.text}")
             return False
         except Exception as e:
@@ -264,7 +375,7 @@ class TTSGenerator:
         url = f"https://api.minimaxi.chat/v1/t2a_v2?GroupId={self.group_id}"
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
+            "Authorization": f"Bearer {self.api_keys[0] if self.api_keys else ''}"
         }
         
         # 最簡單的測試請求
@@ -277,7 +388,7 @@ class TTSGenerator:
         }
         
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = get_session("hailuo", self.api_keys[0] if self.api_keys else "").post(url, headers=headers, json=data, timeout=30)
             print(f"測試連接狀態碼: {response.status_code}")
             print(f"測試連接響應: {response.text}")
             
@@ -291,7 +402,7 @@ class TTSGenerator:
         url = f"https://api.minimaxi.chat/v1/t2a_v2?GroupId={self.group_id}"
         headers = {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
+            "Authorization": f"Bearer {self.api_keys[0] if self.api_keys else ''}"
         }
         
         # 創建一個不含發音字典的請求版本進行測試
@@ -328,7 +439,7 @@ class TTSGenerator:
             
             # 使用確認有效的數據發送請求
             final_json = json.dumps(data_to_use, ensure_ascii=False)
-            response = requests.post(url, headers=headers, data=final_json, stream=True)
+            response = get_session("hailuo", self.api_keys[0] if self.api_keys else "").post(url, headers=headers, data=final_json.encode('utf-8'), timeout=120)
             response.raise_for_status()
             
             response_data = response.json()
@@ -0,0 +1,137 @@
+# modules/word_segmenter.py
+"""
+中文斷詞模組 - 以詞典建立有向無環圖 (DAG)，再以動態規劃找出機率最大的切分路徑
+"""
+
+import math
+import os
+import re
+from typing import Dict, Iterable, List, Optional
+
+# 預設詞典檔（jieba 格式：每行「詞 詞頻 [詞性]」）
+DEFAULT_LEXICON_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "segmentation_dict.txt")
+
+# 需要斷詞的中文字元範圍，其他字元（英文、數字、標點、換行）原樣保留
+CJK_RUN_PATTERN = re.compile(r'[㐀-䶿一-鿿豈-﫿]+')
+
+
+class WordSegmenter:
+    """
+    本地中文斷詞器
+
+    對每段連續的中文字建立 DAG：每個位置連到所有從該位置開始、存在於詞典中的詞，
+    再由後往前以動態規劃取得對數機率總和最大的路徑。詞典以外的單字視為詞頻 1。
+    """
+
+    def __init__(self, lexicon_file: Optional[str] = DEFAULT_LEXICON_PATH, default_freq: int = 3000):
+        """初始化斷詞器
+
+        Args:
+            lexicon_file: 詞典檔路徑，None 表示使用空詞典
+            default_freq: 以 add_word 加入且未指定詞頻的詞所使用的詞頻
+        """
+        self.freq: Dict[str, int] = {}
+        self.total = 0
+        self.max_word_len = 1
+        self.default_freq = default_freq
+
+        if lexicon_file and os.path.exists(lexicon_file):
+            self.load_lexicon(lexicon_file)
+
+    def load_lexicon(self, lexicon_file: str) -> None:
+        """讀取 jieba 格式的詞典檔
+
+        Args:
+            lexicon_file: 詞典檔路徑
+        """
+        with open(lexicon_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.strip().split()
+                if not parts or parts[0].startswith('#'):
+                    continue
+                freq = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+                self.add_word(parts[0], freq)
+
+    def add_word(self, word: str, freq: Optional[int] = None) -> None:
+        """加入詞彙，已存在的詞只會提高詞頻
+
+        Args:
+            word: 詞彙
+            freq: 詞頻，None 表示使用 default_freq
+        """
+        word = word.strip()
+        if not word:
+            return
+        freq = self.default_freq if freq is None else freq
+        old_freq = self.freq.get(word, 0)
+        if freq > old_freq:
+            self.freq[word] = freq
+            self.total += freq - old_freq
+            self.max_word_len = max(self.max_word_len, len(word))
+
+    def add_words(self, words: Iterable[str], freq: Optional[int] = None) -> None:
+        """批次加入詞彙"""
+        for word in words:
+            self.add_word(word, freq)
+
+    def cut(self, sentence: str) -> List[str]:
+        """切分一段連續的中文字
+
+        Args:
+            sentence: 只包含中文字的字串
+
+        Returns:
+            切分後的詞列表
+        """
+        length = len(sentence)
+        if length <= 1:
+            return [sentence] if sentence else []
+
+        freq = self.freq
+        log_total = math.log(max(self.total, 1))
+
+        # route[i] = (從位置 i 到句尾的最大對數機率, 該位置所取詞的結束索引)
+        route = [(0.0, 0)] * (length + 1)
+        for i in range(length - 1, -1, -1):
+            best = None
+            for j in range(i, min(length, i + self.max_word_len)):
+                word = sentence[i:j + 1]
+                if j > i and word not in freq:
+                    continue
+                score = math.log(freq.get(word) or 1) - log_total + route[j + 1][0]
+                # 機率相同時取較長的詞
+                if best is None or score >= best[0]:
+                    best = (score, j)
+            route[i] = best
+
+        words = []
+        i = 0
+        while i < length:
+            j = route[i][1] + 1
+            words.append(sentence[i:j])
+            i = j
+        return words
+
+    def segment(self, text: str, delimiter: str = "^") -> str:
+        """斷詞並以分隔符號標記詞的邊界
+
+        中文以外的內容（英文、數字、標點、換行與 --- 切割符）原樣保留為獨立片段，
+        移除分隔符號後即還原為原文。
+
+        Args:
+            text: 要斷詞的文本
+            delimiter: 詞邊界的分隔符號
+
+        Returns:
+            以分隔符號分隔的文本
+        """
+        pieces = []
+        position = 0
+        for match in CJK_RUN_PATTERN.finditer(text):
+            if match.start() > position:
+                pieces.append(text[position:match.start()])
+            pieces.extend(self.cut(match.group()))
+            position = match.end()
+        if position < len(text):
+            pieces.append(text[position:])
+        return delimiter.join(pieces)
@@ -142,6 +142,28 @@ SUBTITLE_CORRECTION_PROMPT = """
 {transcript_content}
 """
 
+# 字幕校正提示詞（JSON 結構化輸出）
+SUBTITLE_CORRECTION_JSON_PROMPT = """
+請扮演一位專業的文字編輯，比對以下字幕檔和逐字稿，並以逐字稿的內容為準，修正字幕檔中因語音轉文字造成的錯別字、漏字、多字、詞語誤用等問題，請勿修改語氣和修辭。
+
+【重要規則】：
+1. 只修正標記有「處理→」的字幕行，標記為「上下文:」的行僅供參考，不要輸出
+2. 必須嚴格保持原始字幕的斷句結構，每個編號對應一條字幕
+3. 不允許合併或拆分任何字幕行，也不要新增或移除任何字幕段落
+4. 即使字幕不需要修改，也必須原樣輸出
+5. 即使對於很長的字幕行，也必須完整處理，不能忽略任何部分
+
+請以 JSON 格式輸出：
+- subtitles：每條「處理→」字幕的 index（編號）與 text（修正後的文字）
+- changes：當前批次所有修改的內容，包含 index、original（原文）與 corrected（修正後）
+
+字幕檔內容：
+{subtitle_content}
+
+逐字稿內容：
+{transcript_content}
+"""
+
 # 模擬語音識別SRT生成提示詞(暫時沒使用)
 SRT_GENERATION_PROMPT = """
 請扮演一個語音識別系統，將以下逐字稿轉換為相應的字幕文件。
@@ -3,6 +3,16 @@
 import requests
 import json
 import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Any, Callable, Dict, Generator, Iterable, Iterator, Optional, Tuple, Union
+from requests.adapters import HTTPAdapter
+from utils.rate_limiter import AdaptiveConcurrency, TokenBucket, is_rate_limit_error, is_server_error, get_retry_after
+from utils.response_cache import ResponseCache, get_default_cache
+from utils.key_pool import KeyPool, mask_key, parse_api_keys
 # from dotenv import load_dotenv # <-- REMOVE THIS
 
 # 加載環境變量
@@ -10,10 +20,510 @@ import os
 
 class APIError(Exception):
     """API 調用錯誤"""
-    pass
+
+    def __init__(self, message: str, status_code: Optional[int] = None, response: Any = None):
+        super().__init__(message)
+        # 保留 HTTP 狀態碼與響應，供重試策略判斷 429 / 5xx 與讀取 Retry-After
+        self.status_code = status_code
+        self.code = status_code
+        self.response = response
+
+# --- 服務提供者層：長連線客戶端、統一重試策略與並行上限 ---
+
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta/models"
+
+# call_google_ai 使用的生成參數（同時作為回應快取鍵的一部分）
+GOOGLE_AI_GENERATION_CONFIG = {
+    "temperature": 0.2,  # Lower temp for more deterministic output
+    "topP": 0.8,
+    "topK": 40,
+    "maxOutputTokens": 8192, # Set a reasonable max token limit if needed
+}
+
+# 各服務每把金鑰同時進行中請求數的初始值與上限（所有呼叫端共用），
+# 實際並行數由 AdaptiveConcurrency 依延遲與 429 / 5xx 在兩者之間調整
+PROVIDER_CONCURRENCY = {
+    "google_ai": 8,
+    "openai": 4,
+    "hailuo": 4,
+}
+PROVIDER_MAX_CONCURRENCY = {
+    "google_ai": 32,
+    "openai": 16,
+    "hailuo": 16,
+}
+
+# 各服務每把金鑰每分鐘的請求上限，None 表示未知（依最近用量平均分配）
+KEY_REQUESTS_PER_MINUTE: Dict[str, Optional[int]] = {
+    "google_ai": None,
+    "openai": None,
+    "hailuo": None,
+}
+
+_sessions: Dict[Tuple[str, str], requests.Session] = {}
+_openai_clients: Dict[str, Any] = {}
+_controllers: Dict[Tuple[str, str], AdaptiveConcurrency] = {}
+_key_pools: Dict[Tuple[str, Tuple[str, ...]], KeyPool] = {}
+_provider_lock = threading.Lock()
+
+
+def get_session(provider: str, api_key: str = "") -> requests.Session:
+    """取得 (服務, 金鑰) 對應的長連線 Session，連線池大小與該服務的並行上限一致.
+
+    Args:
+        provider (str): 服務名稱 ("google_ai" / "hailuo" ...).
+        api_key (str): API 金鑰，不同金鑰使用各自的 Session.
+
+    Returns:
+        requests.Session: 可在多執行緒間共用的 Session.
+    """
+    key = (provider, api_key)
+    with _provider_lock:
+        session = _sessions.get(key)
+        if session is None:
+            pool_size = PROVIDER_MAX_CONCURRENCY.get(provider, 16)
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[key] = session
+        return session
+
+
+def get_openai_client(api_key: str):
+    """取得金鑰對應的 OpenAI 客戶端，同一金鑰只建立一次.
+
+    客戶端內建的重試已關閉 (max_retries=0)，統一由 call_with_retry 處理。
+    """
+    with _provider_lock:
+        client = _openai_clients.get(api_key)
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=api_key, max_retries=0)
+            _openai_clients[api_key] = client
+        return client
+
+
+def get_concurrency_controller(provider: str, api_key: str = "") -> AdaptiveConcurrency:
+    """取得 (服務, 金鑰) 的 AIMD 並行控制器，多把金鑰時總並行數隨之增加"""
+    key = (provider, api_key)
+    with _provider_lock:
+        controller = _controllers.get(key)
+        if controller is None:
+            name = f"{provider} {mask_key(api_key)}" if api_key else provider
+            controller = AdaptiveConcurrency(name, initial=PROVIDER_CONCURRENCY.get(provider, 4),
+                                             max_limit=PROVIDER_MAX_CONCURRENCY.get(provider, 16))
+            _controllers[key] = controller
+        return controller
+
+
+def concurrency_report() -> str:
+    """所有服務目前的並行上限與觀測到的延遲，供日誌與介面顯示"""
+    with _provider_lock:
+        controllers = list(_controllers.values())
+    lines = []
+    for controller in controllers:
+        stats = controller.stats()
+        latency = (f"延遲 p50 {stats['p50']:.2f} 秒 / p95 {stats['p95']:.2f} 秒"
+                   if stats['p50'] is not None else "尚無延遲資料")
+        lines.append(f"{controller.name}: 並行上限 {stats['limit']}（進行中 {stats['in_flight']}），{latency}，"
+                     f"成功 {stats['successes']}，限流 {stats['throttled']}，錯誤 {stats['errors']}")
+    return "\n".join(lines)
+
+
+def get_key_pool(provider: str, api_keys: Union[str, Iterable[str], KeyPool]) -> KeyPool:
+    """取得服務與金鑰組合對應的共用金鑰池，同一組金鑰在所有呼叫端共用配額與統計.
+
+    Args:
+        provider (str): 服務名稱.
+        api_keys: 以逗號分隔的金鑰字串、金鑰列表或既有的 KeyPool.
+
+    Returns:
+        KeyPool: 金鑰池.
+    """
+    if isinstance(api_keys, KeyPool):
+        return api_keys
+    keys = tuple(parse_api_keys(api_keys))
+    with _provider_lock:
+        pool = _key_pools.get((provider, keys))
+        if pool is None:
+            pool = KeyPool(keys, requests_per_minute=KEY_REQUESTS_PER_MINUTE.get(provider))
+            _key_pools[(provider, keys)] = pool
+        return pool
+
+
+def key_pool_report() -> str:
+    """所有金鑰池的每把金鑰使用統計，供日誌與介面顯示"""
+    with _provider_lock:
+        pools = list(_key_pools.items())
+    return "\n".join(f"[{provider}]\n{pool.summary()}" for (provider, _), pool in pools)
+
+
+class RetryPolicy:
+    """統一的重試策略：只重試限流、5xx 與網路錯誤，等待時間為帶抖動的指數退避.
+
+    伺服器回傳 Retry-After (或 Gemini 的 retry_delay) 時以其為準，只加上少量抖動，
+    避免多個執行緒在同一時間一起重試。
+    """
+
+    # 網路層可重試的例外名稱 (requests / openai)
+    RETRYABLE_ERROR_NAMES = ("ConnectionError", "Timeout", "ConnectTimeout", "ReadTimeout",
+                             "APIConnectionError", "APITimeoutError")
+
+    def __init__(self, max_retries: int = 3, base_delay: float = 2.0, max_delay: float = 60.0,
+                 jitter: float = 0.5):
+        """初始化重試策略
+
+        Args:
+            max_retries: 最大重試次數
+            base_delay: 第一次重試的基準等待秒數，之後每次加倍
+            max_delay: 單次等待秒數上限
+            jitter: 抖動比例，實際等待為基準值的 (1 - jitter) 到 1 倍
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def is_retryable(self, error: Exception) -> bool:
+        """判斷錯誤是否值得重試"""
+        return (is_rate_limit_error(error) or is_server_error(error)
+                or type(error).__name__ in self.RETRYABLE_ERROR_NAMES)
+
+    def backoff(self, attempt: int, error: Optional[Exception] = None) -> float:
+        """計算第 attempt 次重試 (從 0 起算) 前的等待秒數"""
+        retry_after = get_retry_after(error) if error is not None else None
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.jitter)
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return delay * (1 - self.jitter * random.random())
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def call_with_retry(provider: str, func: Callable[..., Any], label: str = "",
+                    policy: Optional[RetryPolicy] = None, limiter: Optional[TokenBucket] = None,
+                    api_keys: Union[str, Iterable[str], KeyPool, None] = None, hold: bool = False,
+                    on_start: Optional[Callable[[], None]] = None) -> Any:
+    """在服務的並行上限內執行 func，依重試策略處理暫時性錯誤.
+
+    並行名額由 (服務, 金鑰) 的 AIMD 控制器分配，等待重試期間不佔用名額。提供 api_keys 時每次嘗試都從金鑰池挑選金鑰並以 func(key) 呼叫，
+    429 只會暫停該金鑰，下一次嘗試改用其他金鑰；未提供時以 func() 呼叫，
+    429 會暫停共用同一個 limiter 的所有請求。
+
+    Args:
+        provider (str): 服務名稱，決定並行上限.
+        func (Callable): 實際送出請求的函數，每次重試都會重新呼叫.
+        label (str): 日誌中顯示的請求名稱.
+        policy (RetryPolicy): 重試策略，None 表示使用預設策略.
+        limiter (TokenBucket): 呼叫端的限流器.
+        api_keys: 以逗號分隔的金鑰字串、金鑰列表或 KeyPool.
+        hold (bool): 成功後繼續佔用並行名額與金鑰，直到呼叫端呼叫返回的 release
+            (用於串流回應，延遲以 release 時為準).
+        on_start (Callable): 每次嘗試取得金鑰與並行名額、即將送出請求時呼叫 (供呼叫端排除排隊時間).
+
+    Returns:
+        func 的返回值；hold 為 True 時為 (返回值, release)，release(error=None) 只有第一次呼叫有效.
+
+    Raises:
+        最後一次嘗試的例外，或不可重試的例外.
+    """
+    policy = policy or DEFAULT_RETRY_POLICY
+    label = label or provider
+    pool = get_key_pool(provider, api_keys) if api_keys else None
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        key = pool.acquire() if pool is not None else ""
+        try:
+            controller = get_concurrency_controller(provider, key)
+            saturated = controller.acquire()
+            started = time.monotonic()
+            if on_start is not None:
+                on_start()
+            try:
+                result = func(key) if pool is not None else func()
+            except Exception as e:
+                controller.release(time.monotonic() - started, e, saturated)
+                raise
+            if not hold:
+                controller.release(time.monotonic() - started, None, saturated)
+        except Exception as e:
+            if pool is not None:
+                pool.release(key, e)
+            if attempt >= policy.max_retries or not policy.is_retryable(e):
+                raise
+            attempt += 1
+            if is_rate_limit_error(e):
+                if pool is not None:
+                    # 被限流的金鑰已暫停，立即改用其他金鑰（全部暫停時由金鑰池等待）
+                    print(f"{label} 遇到配額限制 (429)，改用其他金鑰重試 {attempt}/{policy.max_retries}...")
+                    continue
+                wait = policy.backoff(attempt - 1, e)
+                print(f"{label} 遇到配額限制 (429)，{wait:.1f} 秒後重試 {attempt}/{policy.max_retries}...")
+                if limiter is not None:
+                    limiter.pause(wait)
+                    continue
+            else:
+                wait = policy.backoff(attempt - 1, e)
+                print(f"{label} 發生錯誤：{e}，{wait:.1f} 秒後重試 {attempt}/{policy.max_retries}...")
+            time.sleep(wait)
+        else:
+            if hold:
+                return result, _make_release(controller, started, saturated, pool, key)
+            if pool is not None:
+                pool.release(key)
+            return result
+
+
+def _make_release(controller: AdaptiveConcurrency, started: float, saturated: bool,
+                  pool: Optional[KeyPool], key: str) -> Callable[[Optional[Exception]], None]:
+    """建立歸還 call_with_retry(hold=True) 所佔用名額與金鑰的函數，重複呼叫時只歸還一次"""
+    lock = threading.Lock()
+    released = [False]
+
+    def release(error: Optional[Exception] = None) -> None:
+        with lock:
+            if released[0]:
+                return
+            released[0] = True
+        controller.release(time.monotonic() - started, error, saturated)
+        if pool is not None:
+            pool.release(key, error)
+
+    return release
+
+
+class HedgePolicy:
+    """備援請求 (hedged request) 策略.
+
+    請求超過最近成功延遲的指定百分位數仍未返回時，再送出一個相同的請求，先成功者勝出。
+    備援請求數不得超過總請求數的 budget 比例，避免成本失控；樣本不足時不送備援。
+    """
+
+    def __init__(self, percentile: float = 95, budget: float = 0.1, min_samples: int = 20,
+                 min_delay: float = 1.0, window: int = 200):
+        """初始化備援策略
+
+        Args:
+            percentile: 觸發備援的延遲百分位數
+            budget: 備援請求數佔總請求數的比例上限
+            min_samples: 開始送出備援前至少需要的延遲樣本數
+            min_delay: 觸發備援前至少等待的秒數
+            window: 保留的最近延遲樣本數
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def start(self) -> Optional[float]:
+        """登記一個新請求，返回觸發備援前的等待秒數，樣本不足時返回 None"""
+        with self._lock:
+            self.requests += 1
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+            index = min(len(ordered) - 1, int(round(self.percentile / 100 * (len(ordered) - 1))))
+            return max(self.min_delay, ordered[index])
+
+    def try_hedge(self) -> bool:
+        """在預算內時佔用一個備援名額"""
+        with self._lock:
+            if self.hedged + 1 > self.budget * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    def record(self, latency: float, hedge_won: bool) -> None:
+        """記錄成功請求的延遲與是否由備援請求勝出"""
+        with self._lock:
+            self._latencies.append(latency)
+            if hedge_won:
+                self.hedge_wins += 1
+
+    def stats(self) -> Dict[str, int]:
+        """請求數、備援請求數與備援勝出次數"""
+        with self._lock:
+            return {"requests": self.requests, "hedged": self.hedged, "hedge_wins": self.hedge_wins}
+
+
+_hedge_policies: Dict[str, HedgePolicy] = {}
+
+
+def get_hedge_policy(name: str) -> HedgePolicy:
+    """取得指定操作 (例如 "hailuo_tts") 共用的備援策略，延遲樣本與預算依操作分開計算"""
+    with _provider_lock:
+        policy = _hedge_policies.get(name)
+        if policy is None:
+            policy = HedgePolicy()
+            _hedge_policies[name] = policy
+        return policy
+
+
+def hedge_report() -> str:
+    """各操作的備援請求統計，供日誌與介面顯示"""
+    with _provider_lock:
+        policies = list(_hedge_policies.items())
+    return "\n".join(
+        f"{name}: 請求 {stats['requests']} 次，備援 {stats['hedged']} 次，備援勝出 {stats['hedge_wins']} 次"
+        for name, stats in ((name, policy.stats()) for name, policy in policies)
+    )
+
+
+def _run_in_thread(func: Callable[[], Any]) -> Future:
+    """在獨立的執行緒執行 func，不與呼叫端的執行緒池搶名額，避免排隊時間被誤判為延遲"""
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def call_hedged(provider: str, func: Callable[..., Any], label: str = "",
+                hedge: Union[HedgePolicy, str, None] = None, **retry_kwargs) -> Any:
+    """以 call_with_retry 送出請求，超過延遲百分位數仍未返回時在預算內送出備援請求.
+
+    等待時間與記錄的延遲都從請求取得金鑰與並行名額後起算，主要請求仍在排隊時不送備援。
+    兩個請求各自經過金鑰池與並行控制，先成功者的結果被採用；另一個請求無法中止，
+    會在背景完成後被丟棄，因此 func 不應有副作用（例如寫檔），應返回結果由呼叫端處理。
+
+    Args:
+        provider (str): 服務名稱.
+        func (Callable): 送出請求的函數，參數規則與 call_with_retry 相同.
+        label (str): 日誌中顯示的請求名稱.
+        hedge: HedgePolicy、共用策略名稱，None 表示不送備援請求.
+        **retry_kwargs: 傳給 call_with_retry 的參數 (policy / limiter / api_keys).
+
+    Returns:
+        先成功的請求結果.
+    """
+    if hedge is None:
+        return call_with_retry(provider, func, label, **retry_kwargs)
+    if isinstance(hedge, str):
+        hedge = get_hedge_policy(hedge)
+
+    # 延遲從取得金鑰與並行名額、實際送出請求時起算，排隊等待的時間不觸發備援也不計入延遲樣本
+    starts: Dict[str, float] = {}
+    primary_started = threading.Event()
+
+    def submit(name: str, request_label: str) -> Future:
+        def on_start() -> None:
+            starts[name] = time.monotonic()
+            if name == "primary":
+                primary_started.set()
+        return _run_in_thread(lambda: call_with_retry(provider, func, request_label, on_start=on_start, **retry_kwargs))
+
+    delay = hedge.start()
+    primary = submit("primary", label)
+    pending = {primary}
+
+    if delay is not None:
+        # 主要請求仍在等待名額時不送備援，否則備援只會排進同一個佇列
+        while not primary_started.wait(timeout=0.05) and not primary.done():
+            pass
+        if not primary.done():
+            done, _ = wait(pending, timeout=max(0.0, delay - (time.monotonic() - starts["primary"])))
+            if not done and hedge.try_hedge():
+                print(f"{label or provider} 超過 p{hedge.percentile:g} 延遲 ({delay:.1f} 秒)，送出備援請求")
+                pending.add(submit("hedge", f"{label or provider} (備援)"))
+
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                name = "primary" if future is primary else "hedge"
+                hedge.record(time.monotonic() - starts[name], name == "hedge")
+                if name == "hedge":
+                    print(f"{label or provider} 由備援請求先完成")
+                return future.result()
+            error = error or future.exception()
+    raise error
+
+
+def _format_prompt(prompt: str, text: str) -> str:
+    """代入文本產生完整提示詞，模板沒有 {text} 佔位符時直接使用模板"""
+    try:
+        return prompt.format(text=text)
+    except KeyError:
+        return prompt
+
+
+def _error_details(response: requests.Response) -> str:
+    """從錯誤響應中取出錯誤信息"""
+    try:
+        return response.json().get('error', {}).get('message', response.text)
+    except (json.JSONDecodeError, ValueError, AttributeError):
+        return response.text
+
+
+class GeminiResponse:
+    """Gemini REST 響應，提供與 SDK 相同的 text 存取方式"""
+
+    def __init__(self, result: Dict[str, Any]):
+        self.result = result
+        candidates = result.get("candidates") or []
+        self.candidate = candidates[0] if candidates else {}
+        self.finish_reason = self.candidate.get("finishReason", "UNKNOWN")
+
+    @property
+    def text(self) -> str:
+        """第一個候選的完整文字"""
+        if not self.candidate:
+            block_reason = self.result.get("promptFeedback", {}).get("blockReason")
+            if block_reason:
+                raise APIError(f"API 請求被阻止，原因: {block_reason}")
+            return ""
+        return "".join(part.get("text", "") for part in self.candidate.get("content", {}).get("parts", []))
+
+
+def generate_content(prompt: str, api_key: str, model: str = "gemini-1.5-flash",
+                     generation_config: Optional[Dict[str, Any]] = None, timeout: float = 90) -> GeminiResponse:
+    """以長連線 Session 呼叫一次 Gemini generateContent (不含重試).
+
+    Args:
+        prompt (str): 完整提示詞.
+        api_key (str): Google AI API 金鑰.
+        model (str): 模型名稱.
+        generation_config (dict): 生成參數，例如 response_mime_type / response_schema.
+        timeout (float): 請求逾時秒數.
+
+    Returns:
+        GeminiResponse: 響應.
+
+    Raises:
+        APIError: HTTP 狀態碼非 200 (含狀態碼與響應，供重試判斷).
+        requests.exceptions.RequestException: 網路錯誤.
+    """
+    data = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+    if generation_config:
+        data["generationConfig"] = generation_config
+
+    response = get_session("google_ai", api_key).post(
+        f"{GEMINI_API_BASE}/{model}:generateContent",
+        params={"key": api_key}, json=data, timeout=timeout
+    )
+    if response.status_code != 200:
+        raise APIError(f"API 請求失敗 (HTTP {response.status_code}): {_error_details(response)}",
+                       status_code=response.status_code, response=response)
+    return GeminiResponse(response.json())
 
 # --- Improved call_google_ai ---
-def call_google_ai(prompt: str, text: str, api_key: str, model: str = "gemini-1.5-flash") -> str: # Changed default model, added type hints
+def call_google_ai(prompt: str, text: str, api_key: str, model: str = "gemini-1.5-flash",
+                   return_finish_reason: bool = False) -> Union[str, Tuple[str, str]]: # Changed default model, added type hints
     """調用 Google AI API (Generative Language API) 進行文本處理.
 
     Args:
@@ -21,9 +531,10 @@ def call_google_ai(prompt: str, text: str, api_key: str, model: str = "gemini-1.
         text (str): 待處理文本.
         api_key (str): Google AI API 金鑰.
         model (str): 模型名稱，例如 "gemini-1.5-flash", "gemini-1.5-pro".
+        return_finish_reason (bool): 是否同時返回完成原因 (finishReason).
 
     Returns:
-        str: 模型生成的文本.
+        str: 模型生成的文本；return_finish_reason 為 True 時為 (文本, 完成原因).
 
     Raises:
         APIError: API 調用或響應處理失敗.
@@ -77,13 +588,7 @@ def call_google_ai(prompt: str, text: str, api_key: str, model: str = "gemini-1.
                 ]
             }
         ],
-        "generationConfig": {
-            "temperature": 0.2,  # Lower temp for more deterministic output
-            "topP": 0.8,
-            "topK": 40,
-            "maxOutputTokens": 8192, # Set a reasonable max token limit if needed
-            # "stopSequences": ["..."] # Optional stop sequences
-        },
+        "generationConfig": dict(GOOGLE_AI_GENERATION_CONFIG),
         # Optional Safety Settings:
         # "safetySettings": [
         #    { "category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE" },
@@ -95,19 +600,17 @@ def call_google_ai(prompt: str, text: str, api_key: str, model: str = "gemini-1.
 
     try:
         print(f"調用 Google AI API: model={model}, url={url}") # Log call
-        # Add timeout to the request
-        response = requests.post(url, headers=headers, params=params, json=data, timeout=90) # 90 seconds timeout
-
-        # Check for non-200 status codes explicitly
-        if response.status_code != 200:
-             # Try to get error details from the response body if possible
-             error_details = ""
-             try:
-                  error_json = response.json()
-                  error_details = error_json.get('error', {}).get('message', response.text)
-             except json.JSONDecodeError:
-                  error_details = response.text # Use raw text if not JSON
-             raise APIError(f"API 請求失敗 (HTTP {response.status_code}): {error_details}")
+        def send(key: str) -> requests.Response:
+            # Add timeout to the request (api_key 可為多把金鑰，每次嘗試由金鑰池挑選)
+            response = get_session("google_ai", key).post(url, headers=headers, params=dict(params, key=key),
+                                                          json=data, timeout=90) # 90 seconds timeout
+            # Check for non-200 status codes explicitly (429 / 5xx are retried by call_with_retry)
+            if response.status_code != 200:
+                 raise APIError(f"API 請求失敗 (HTTP {response.status_code}): {_error_details(response)}",
+                                status_code=response.status_code, response=response)
+            return response
+
+        response = call_with_retry("google_ai", send, label=f"Google AI ({model})", api_keys=api_key)
 
         # --- Process successful response (status code 200) ---
         result = response.json()
@@ -123,7 +626,7 @@ def call_google_ai(prompt: str, text: str, api_key: str, model: str = "gemini-1.
                  print("警告: API 返回了空的 'candidates' 列表。")
                  # Decide what to return: empty string or raise error?
                  # Returning empty string might be safer for downstream processing.
-                 return "" # Return empty string for no valid candidate
+                 return ("", "UNKNOWN") if return_finish_reason else "" # Return empty string for no valid candidate
 
         # Extract generated text from the first candidate
         try:
@@ -137,6 +640,8 @@ def call_google_ai(prompt: str, text: str, api_key: str, model: str = "gemini-1.
 
             generated_text = first_candidate["content"]["parts"][0]["text"]
             print(f"成功從 Google AI API 獲取響應 (完成原因: {finish_reason})。")
+            if return_finish_reason:
+                return generated_text.strip(), finish_reason
             return generated_text.strip() # Return stripped text
 
         except (KeyError, IndexError, TypeError) as e:
@@ -153,6 +658,114 @@ def call_google_ai(prompt: str, text: str, api_key: str, model: str = "gemini-1.
     # Removed redundant JSONDecodeError catch, handled by status code check or RequestException
     # Removed redundant broad Exception catch, specific errors handled above
 
+def call_google_ai_stream(prompt: str, text: str, api_key: str, model: str = "gemini-1.5-flash") -> Generator[str, None, str]:
+    """以串流方式調用 Google AI API，模型產生的文字一到達就逐段返回.
+
+    使用 streamGenerateContent 端點的 SSE 模式 (alt=sse)，每個事件包含一段新產生的文字。
+
+    Args:
+        prompt (str): 提示詞模板 (應該包含一個 {text} 佔位符).
+        text (str): 待處理文本.
+        api_key (str): Google AI API 金鑰.
+        model (str): 模型名稱.
+
+    Yields:
+        str: 依序到達的文字片段（未經 strip）.
+
+    Returns:
+        str: 完成原因 (finishReason)，為產生器結束時 StopIteration 的值.
+
+    Raises:
+        APIError: API 調用或響應處理失敗.
+        ValueError: 如果 API Key 未提供.
+    """
+    if not api_key:
+         raise ValueError("Google AI API 金鑰未提供。")
+    if not prompt:
+         raise ValueError("提示詞模板 (prompt) 為空。")
+
+    try:
+        full_prompt = prompt.format(text=text)
+    except KeyError:
+         print(f"警告: 提供的提示詞模板未包含 '{{text}}' 佔位符。將直接使用模板。")
+         full_prompt = prompt
+
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent"
+    params = {
+        "key": api_key,
+        "alt": "sse"  # 以 Server-Sent Events 格式回傳
+    }
+    data = {
+        "contents": [
+            {
+                "role": "user",
+                "parts": [
+                    {
+                        "text": full_prompt
+                    }
+                ]
+            }
+        ],
+        "generationConfig": dict(GOOGLE_AI_GENERATION_CONFIG),
+    }
+
+    try:
+        print(f"串流調用 Google AI API: model={model}, url={url}")
+        def open_stream(key: str) -> requests.Response:
+            # timeout 為連線與兩個事件之間的等待上限，而非整個回應的時間
+            response = get_session("google_ai", key).post(url, headers={"Content-Type": "application/json"},
+                                                          params=dict(params, key=key),
+                                                          json=data, stream=True, timeout=(10, 90))
+            if response.status_code != 200:
+                 error_details = _error_details(response)
+                 response.close()
+                 raise APIError(f"API 請求失敗 (HTTP {response.status_code}): {error_details}",
+                                status_code=response.status_code, response=response)
+            return response
+
+        # 只重試建立串流的請求；開始接收文字後中斷則直接拋出，避免重複輸出。
+        # 讀取完整個回應（或產生器被關閉）前持續佔用並行名額與金鑰
+        response, release = call_with_retry("google_ai", open_stream, label=f"Google AI 串流 ({model})",
+                                            api_keys=api_key, hold=True)
+        stream_error = None
+        try:
+            with response:
+
+                # SSE 回應不一定帶有 charset，明確以 UTF-8 解碼避免中文亂碼
+                response.encoding = "utf-8"
+                finish_reason = "UNKNOWN"
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    try:
+                        event = json.loads(line[len("data:"):].strip())
+                    except json.JSONDecodeError:
+                        print(f"警告: 無法解析串流事件: {line[:200]}")
+                        continue
+
+                    block_reason = event.get("promptFeedback", {}).get("blockReason")
+                    if block_reason:
+                         raise APIError(f"API 請求被阻止，原因: {block_reason}")
+
+                    for candidate in event.get("candidates", [])[:1]:
+                        finish_reason = candidate.get("finishReason", finish_reason)
+                        for part in candidate.get("content", {}).get("parts", []):
+                            if part.get("text"):
+                                yield part["text"]
+
+                print(f"串流響應結束 (完成原因: {finish_reason})。")
+                return finish_reason
+        except Exception as e:
+            stream_error = e
+            raise
+        finally:
+            release(stream_error)
+
+    except requests.exceptions.Timeout:
+         raise APIError(f"API 串流請求超時 (超過 90 秒未收到新資料)。")
+    except requests.exceptions.RequestException as e:
+         raise APIError(f"API 網絡請求錯誤: {str(e)}")
+
 # --- process_with_ai function seems fine, acts as a dispatcher ---
 def process_with_ai(service: str, prompt: str, text: str, api_key: str, **kwargs) -> str: # Added type hints
     """統一的 AI 模型調用介面.
@@ -163,6 +776,8 @@ def process_with_ai(service: str, prompt: str, text: str, api_key: str, **kwargs
         text (str): 待處理文本.
         api_key (str): 對應服務的 API 金鑰.
         **kwargs: 特定服務的額外參數 (例如 'model' for google_ai).
+            cache: 選用的回應快取，ResponseCache 實例或 True (使用預設快取)；
+                以服務、模型、完整提示詞與生成參數作為快取鍵.
 
     Returns:
         str: AI 模型處理後的文本.
@@ -177,9 +792,20 @@ def process_with_ai(service: str, prompt: str, text: str, api_key: str, **kwargs
         if not api_key:
              # Propagate the ValueError from the underlying function if key is missing
              raise ValueError("調用 Google AI 需要提供 api_key。")
+        cache, cache_key = _resolve_cache(kwargs.get("cache"), service, model, prompt, text)
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                print(f"使用快取的 AI 回應: model={model}")
+                return cached
         try:
             # Pass only relevant args
-            return call_google_ai(prompt=prompt, text=text, api_key=api_key, model=model)
+            result, finish_reason = call_google_ai(prompt=prompt, text=text, api_key=api_key, model=model,
+                                                   return_finish_reason=True)
+            # 只快取正常結束的回應；空白、被截斷 (MAX_TOKENS) 或被中止的回應下次仍會重新請求
+            if cache is not None and result and finish_reason == "STOP":
+                cache.set(cache_key, result)
+            return result
         except ValueError as ve: # Catch potential ValueErrors from call_google_ai
              raise ve
         except APIError as ae: # Propagate APIError
@@ -189,4 +815,54 @@ def process_with_ai(service: str, prompt: str, text: str, api_key: str, **kwargs
              print(f"調用 process_with_ai (google_ai) 時發生未知錯誤: {traceback.format_exc()}")
              raise APIError(f"調用 google_ai 時發生未知錯誤: {e}") from e
     else:
-        raise ValueError(f"不支持的服務類型: {service}")
\ No newline at end of file
+        raise ValueError(f"不支持的服務類型: {service}")
+
+def process_with_ai_stream(service: str, prompt: str, text: str, api_key: str, **kwargs) -> Iterator[str]:
+    """統一的 AI 模型串流調用介面，與 process_with_ai 參數相同，逐段返回產生的文字.
+
+    Raises:
+        ValueError: 如果服務不支持或缺少必要參數 (如 api_key).
+        APIError: 如果底層 API 調用失敗.
+    """
+    if service == "google_ai":
+        model = kwargs.get("model", "gemini-1.5-flash")
+        if not api_key:
+             raise ValueError("調用 Google AI 需要提供 api_key。")
+        cache, cache_key = _resolve_cache(kwargs.get("cache"), service, model, prompt, text)
+        if cache is None:
+            return call_google_ai_stream(prompt=prompt, text=text, api_key=api_key, model=model)
+        return _cached_stream(cache, cache_key, call_google_ai_stream(prompt=prompt, text=text, api_key=api_key, model=model))
+    else:
+        raise ValueError(f"不支持的服務類型: {service}")
+
+def _resolve_cache(cache: Any, service: str, model: str, prompt: str, text: str) -> Tuple[Optional[ResponseCache], Optional[str]]:
+    """依 cache 參數取得快取實例與本次請求的快取鍵，未啟用快取時返回 (None, None)"""
+    if not cache:
+        return None, None
+    if cache is True:
+        cache = get_default_cache()
+    return cache, cache.make_key(service, model, _format_prompt(prompt, text), GOOGLE_AI_GENERATION_CONFIG)
+
+def _cached_stream(cache: ResponseCache, cache_key: str, stream: Generator[str, None, str]) -> Iterator[str]:
+    """快取命中時一次返回完整回應；未命中時邊轉發邊累積，以完成原因 STOP 結束後才寫入快取"""
+    cached = cache.get(cache_key)
+    if cached is not None:
+        stream.close()
+        print("使用快取的 AI 回應 (串流)")
+        yield cached
+        return
+    received = []
+    try:
+        while True:
+            try:
+                piece = next(stream)
+            except StopIteration as stop:
+                finish_reason = stop.value
+                break
+            received.append(piece)
+            yield piece
+    finally:
+        stream.close()
+    result = "".join(received).strip()
+    if result and finish_reason == "STOP":
+        cache.set(cache_key, result)
@@ -0,0 +1,246 @@
+# utils/job_store.py
+"""
+背景工作儲存 - 以 SQLite 保存工作、階段與逐段任務的狀態，程式重新啟動後可從最後完成的任務繼續
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+# 預設資料庫位置
+DEFAULT_JOB_DB_PATH = os.path.join("temp", "jobs", "jobs.sqlite3")
+
+# 工作狀態
+QUEUED = "queued"
+RUNNING = "running"
+PAUSED = "paused"
+DONE = "done"
+FAILED = "failed"
+# 任務狀態
+PENDING = "pending"
+
+
+class JobStore:
+    """
+    工作、階段與任務的持久化儲存
+
+    jobs 保存每個工作的參數與最終結果；stages 記錄工作中每個階段的狀態與結果；
+    tasks 為階段內的逐段任務（例如每個段落的語音生成），依 (工作, 階段, 編號) 唯一識別，
+    以相同內容重新建立時保留已有的狀態，因此恢復工作時只需重新執行尚未完成的任務。
+    參數與結果以 JSON 保存；API 金鑰不寫入資料庫。可在多個執行緒間共用。
+    """
+
+    def __init__(self, path: str = DEFAULT_JOB_DB_PATH):
+        """初始化儲存
+
+        Args:
+            path: SQLite 檔案路徑
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, params TEXT NOT NULL, "
+                "result TEXT, error TEXT, created REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS stages ("
+                "job_id TEXT NOT NULL, name TEXT NOT NULL, status TEXT NOT NULL, result TEXT, "
+                "updated REAL NOT NULL, PRIMARY KEY (job_id, name))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "job_id TEXT NOT NULL, stage TEXT NOT NULL, number INTEGER NOT NULL, status TEXT NOT NULL, "
+                "payload TEXT, result TEXT, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, "
+                "updated REAL NOT NULL, PRIMARY KEY (job_id, stage, number))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    @staticmethod
+    def _loads(value: Optional[str]) -> Any:
+        return json.loads(value) if value else None
+
+    def _job_row(self, row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        job["params"] = self._loads(job["params"]) or {}
+        job["result"] = self._loads(job["result"])
+        return job
+
+    # ------------------------------------------------------------------
+    # 工作
+    # ------------------------------------------------------------------
+
+    def create_job(self, kind: str, params: Dict[str, Any]) -> str:
+        """建立排隊中的工作
+
+        Args:
+            kind: 工作類型
+            params: 工作參數（需可序列化為 JSON，不可包含 API 金鑰）
+
+        Returns:
+            工作編號
+        """
+        job_id = uuid.uuid4().hex[:12]
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, status, params, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, kind, QUEUED, json.dumps(params, ensure_ascii=False), now, now)
+            )
+        return job_id
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """讀取工作，不存在時返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job_row(row) if row else None
+
+    def list_jobs(self, statuses: Optional[List[str]] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """依建立時間由新到舊列出工作
+
+        Args:
+            statuses: 只列出這些狀態的工作，None 表示全部
+            limit: 最多筆數
+        """
+        query = "SELECT * FROM jobs"
+        args: List[Any] = []
+        if statuses:
+            query += f" WHERE status IN ({', '.join('?' for _ in statuses)})"
+            args.extend(statuses)
+        query += " ORDER BY created DESC LIMIT ?"
+        args.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, args).fetchall()
+        return [self._job_row(row) for row in rows]
+
+    def set_job_status(self, job_id: str, status: str, result: Any = None, error: Optional[str] = None) -> None:
+        """更新工作狀態，result 為 None 時保留原有結果"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, result = COALESCE(?, result), error = ?, updated = ? WHERE id = ?",
+                (status, None if result is None else json.dumps(result, ensure_ascii=False), error, time.time(), job_id)
+            )
+
+    def recover_interrupted(self) -> List[str]:
+        """程式啟動時呼叫：將上次執行中斷的工作與任務恢復為可繼續的狀態
+
+        執行中的任務改回待處理；執行中或排隊中的工作因 API 金鑰不保存而改為暫停，
+        等待使用者提供金鑰後繼續。
+
+        Returns:
+            被暫停的工作編號列表
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE tasks SET status = ?, updated = ? WHERE status = ?", (PENDING, now, RUNNING))
+            self._conn.execute("UPDATE stages SET status = ?, updated = ? WHERE status = ?", (PENDING, now, RUNNING))
+            rows = self._conn.execute("SELECT id FROM jobs WHERE status IN (?, ?)", (RUNNING, QUEUED)).fetchall()
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE status IN (?, ?)",
+                (PAUSED, "程式重新啟動，請提供 API 金鑰以繼續", now, RUNNING, QUEUED)
+            )
+        return [row["id"] for row in rows]
+
+    # ------------------------------------------------------------------
+    # 階段
+    # ------------------------------------------------------------------
+
+    def get_stage(self, job_id: str, name: str) -> Optional[Dict[str, Any]]:
+        """讀取階段，不存在時返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM stages WHERE job_id = ? AND name = ?", (job_id, name)).fetchone()
+        if not row:
+            return None
+        stage = dict(row)
+        stage["result"] = self._loads(stage["result"])
+        return stage
+
+    def set_stage(self, job_id: str, name: str, status: str, result: Any = None) -> None:
+        """建立或更新階段狀態，result 為 None 時保留原有結果"""
+        encoded = None if result is None else json.dumps(result, ensure_ascii=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO stages (job_id, name, status, result, updated) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (job_id, name) DO UPDATE SET status = excluded.status, "
+                "result = COALESCE(excluded.result, stages.result), updated = excluded.updated",
+                (job_id, name, status, encoded, time.time())
+            )
+
+    # ------------------------------------------------------------------
+    # 任務
+    # ------------------------------------------------------------------
+
+    def sync_tasks(self, job_id: str, stage: str, payloads: List[Any]) -> None:
+        """建立或同步階段的任務，編號依列表順序
+
+        內容與原有任務相同者保留狀態與結果；內容不同者（例如重新生成的段落改變了字幕分組）
+        重設為待處理；超出列表長度的舊任務刪除。
+        """
+        encoded = [json.dumps(payload, ensure_ascii=False) for payload in payloads]
+        now = time.time()
+        with self._lock, self._conn:
+            existing = {
+                row["number"]: row["payload"]
+                for row in self._conn.execute("SELECT number, payload FROM tasks WHERE job_id = ? AND stage = ?",
+                                              (job_id, stage))
+            }
+            self._conn.execute("DELETE FROM tasks WHERE job_id = ? AND stage = ? AND number >= ?",
+                               (job_id, stage, len(payloads)))
+            for number, payload in enumerate(encoded):
+                if number not in existing:
+                    self._conn.execute(
+                        "INSERT INTO tasks (job_id, stage, number, status, payload, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                        (job_id, stage, number, PENDING, payload, now)
+                    )
+                elif existing[number] != payload:
+                    self._conn.execute(
+                        "UPDATE tasks SET status = ?, payload = ?, result = NULL, error = NULL, attempts = 0, "
+                        "updated = ? WHERE job_id = ? AND stage = ? AND number = ?",
+                        (PENDING, payload, now, job_id, stage, number)
+                    )
+
+    def get_tasks(self, job_id: str, stage: str) -> List[Dict[str, Any]]:
+        """依編號列出階段的任務"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM tasks WHERE job_id = ? AND stage = ? ORDER BY number", (job_id, stage)
+            ).fetchall()
+        tasks = []
+        for row in rows:
+            task = dict(row)
+            task["payload"] = self._loads(task["payload"])
+            task["result"] = self._loads(task["result"])
+            tasks.append(task)
+        return tasks
+
+    def update_task(self, job_id: str, stage: str, number: int, status: str,
+                    result: Any = None, error: Optional[str] = None) -> None:
+        """更新任務狀態；開始執行時累計嘗試次數"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE tasks SET status = ?, result = COALESCE(?, result), error = ?, "
+                "attempts = attempts + ?, updated = ? WHERE job_id = ? AND stage = ? AND number = ?",
+                (status, None if result is None else json.dumps(result, ensure_ascii=False), error,
+                 1 if status == RUNNING else 0, time.time(), job_id, stage, number)
+            )
+
+    def task_counts(self, job_id: str) -> Dict[str, Dict[str, int]]:
+        """各階段每種狀態的任務數"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stage, status, COUNT(*) AS count FROM tasks WHERE job_id = ? GROUP BY stage, status", (job_id,)
+            ).fetchall()
+        counts: Dict[str, Dict[str, int]] = {}
+        for row in rows:
+            counts.setdefault(row["stage"], {})[row["status"]] = row["count"]
+        return counts
@@ -0,0 +1,156 @@
+# utils/key_pool.py
+"""
+API 金鑰池 - 將請求分散到多把金鑰，依剩餘配額挑選金鑰，遇到限流的金鑰暫時停用
+"""
+
+import re
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Union
+
+from utils.rate_limiter import is_rate_limit_error, get_retry_after
+
+
+def parse_api_keys(value: Union[str, Iterable[str], None]) -> List[str]:
+    """解析金鑰設定，支援以逗號、分號或換行分隔的多把金鑰
+
+    Args:
+        value: 金鑰字串或金鑰列表
+
+    Returns:
+        去除空白與重複後的金鑰列表（保留原順序）
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = re.split(r'[,;\s]+', value)
+    keys = []
+    for key in value:
+        key = key.strip()
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def mask_key(key: str) -> str:
+    """遮蔽金鑰，只保留末四碼供日誌辨識"""
+    return f"...{key[-4:]}" if len(key) > 4 else "****"
+
+
+class KeyPool:
+    """
+    執行緒安全的金鑰池
+
+    每次請求挑選「剩餘配額」最多的金鑰：有設定每分鐘請求上限時為上限減去最近一分鐘的請求數，
+    否則以最近一分鐘請求數最少者優先，並列時取進行中請求較少的金鑰。
+    收到 429 的金鑰會暫停使用一段時間（優先採用 Retry-After，連續限流時加倍），
+    其他金鑰照常使用；所有金鑰都暫停時才阻塞等待。
+    """
+
+    def __init__(self, keys: Iterable[str], requests_per_minute: Optional[int] = None,
+                 bench_seconds: float = 30.0, max_bench_seconds: float = 300.0):
+        """初始化金鑰池
+
+        Args:
+            keys: 金鑰列表
+            requests_per_minute: 每把金鑰每分鐘的請求上限，None 表示未知
+            bench_seconds: 金鑰被限流且沒有 Retry-After 時的暫停秒數
+            max_bench_seconds: 連續限流時暫停秒數的上限
+        """
+        self.keys = parse_api_keys(keys)
+        if not self.keys:
+            raise ValueError("金鑰池至少需要一把 API 金鑰")
+        if requests_per_minute is not None and requests_per_minute < 1:
+            raise ValueError("每把金鑰每分鐘的請求上限至少為 1")
+        self.requests_per_minute = requests_per_minute
+        self.bench_seconds = bench_seconds
+        self.max_bench_seconds = max_bench_seconds
+
+        self._recent = {key: deque() for key in self.keys}
+        self._in_flight = {key: 0 for key in self.keys}
+        self._benched_until = {key: 0.0 for key in self.keys}
+        self._consecutive_limits = {key: 0 for key in self.keys}
+        self._usage = {key: {"requests": 0, "successes": 0, "rate_limited": 0, "errors": 0} for key in self.keys}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _remaining(self, key: str, now: float) -> float:
+        """計算金鑰在目前一分鐘視窗內的剩餘配額（需在持有鎖時呼叫）"""
+        recent = self._recent[key]
+        while recent and now - recent[0] >= 60:
+            recent.popleft()
+        if self.requests_per_minute is None:
+            return -len(recent)
+        return self.requests_per_minute - len(recent)
+
+    def acquire(self) -> str:
+        """取得一把可用的金鑰，所有金鑰都暫停或配額用盡時阻塞等待
+
+        Returns:
+            金鑰
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                available = [key for key in self.keys if self._benched_until[key] <= now]
+                if available:
+                    best = max(available, key=lambda key: (self._remaining(key, now), -self._in_flight[key]))
+                    if self.requests_per_minute is None or self._remaining(best, now) > 0:
+                        self._recent[best].append(now)
+                        self._in_flight[best] += 1
+                        self._usage[best]["requests"] += 1
+                        return best
+                    # 配額用盡：等到最早的請求離開一分鐘視窗
+                    wait = min((60 - (now - self._recent[key][0]) for key in available if self._recent[key]),
+                               default=0.01)
+                else:
+                    wait = min(self._benched_until.values()) - now
+            time.sleep(max(wait, 0.01))
+
+    def release(self, key: str, error: Optional[Exception] = None) -> None:
+        """回報請求結果，限流錯誤會暫停該金鑰
+
+        Args:
+            key: acquire 取得的金鑰
+            error: 請求失敗時的例外，成功時為 None
+        """
+        with self._lock:
+            self._in_flight[key] = max(0, self._in_flight[key] - 1)
+            usage = self._usage[key]
+            if error is None:
+                usage["successes"] += 1
+                self._consecutive_limits[key] = 0
+            elif is_rate_limit_error(error):
+                usage["rate_limited"] += 1
+                self._consecutive_limits[key] += 1
+                seconds = get_retry_after(error)
+                if seconds is None:
+                    seconds = min(self.max_bench_seconds,
+                                  self.bench_seconds * 2 ** (self._consecutive_limits[key] - 1))
+                self._benched_until[key] = max(self._benched_until[key], time.monotonic() + seconds)
+                print(f"金鑰 {mask_key(key)} 遇到配額限制，暫停使用 {seconds:.1f} 秒")
+            else:
+                usage["errors"] += 1
+
+    def stats(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        """返回每把金鑰（已遮蔽）的使用統計"""
+        with self._lock:
+            now = time.monotonic()
+            return {
+                mask_key(key): dict(self._usage[key],
+                                    in_flight=self._in_flight[key],
+                                    benched_seconds=max(0.0, round(self._benched_until[key] - now, 1)))
+                for key in self.keys
+            }
+
+    def summary(self) -> str:
+        """每把金鑰一行的使用摘要"""
+        return "\n".join(
+            f"{key}: 請求 {usage['requests']} 次，成功 {usage['successes']}，"
+            f"限流 {usage['rate_limited']}，錯誤 {usage['errors']}"
+            + (f"，暫停中 ({usage['benched_seconds']} 秒)" if usage['benched_seconds'] else "")
+            for key, usage in self.stats().items()
+        )
@@ -0,0 +1,236 @@
+# utils/rate_limiter.py
+"""
+限流工具 - 令牌桶限流器、AIMD 自適應並行控制與 429 / Retry-After 錯誤判讀
+"""
+
+import re
+import time
+import threading
+from collections import deque
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    """
+    執行緒安全的令牌桶限流器
+
+    平時依 rate 補充令牌，允許最多 capacity 個請求的突發；
+    只有在實際收到 429 時才透過 pause() 暫停所有請求。
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        """初始化令牌桶
+
+        Args:
+            rate: 每秒補充的令牌數
+            capacity: 令牌桶容量（允許的突發請求數）
+        """
+        self.rate = max(rate, 1e-6)
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        """依經過時間補充令牌（需在持有鎖時呼叫）"""
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> None:
+        """取得一個令牌，必要時阻塞等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """收到限流回應後暫停所有請求
+
+        Args:
+            seconds: 暫停秒數
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            # 恢復後從空桶開始，避免瞬間湧入
+            self._tokens = 0.0
+            self._updated = max(self._updated, self._paused_until)
+
+
+class AdaptiveConcurrency:
+    """
+    以 AIMD (加性增、乘性減) 調整同時進行中請求數的控制器
+
+    請求成功、延遲未明顯高於基準且並行數已用滿時，上限每輪增加 increase（每 limit 個成功請求加 1）；
+    遇到 429 或 5xx 時上限乘以 decrease。同一輪 (約一個平均延遲) 內的多個失敗只減一次，
+    避免同時送出的請求一起失敗時把上限壓到最低。
+    """
+
+    def __init__(self, name: str, initial: int = 4, min_limit: int = 1, max_limit: int = 16,
+                 increase: float = 1.0, decrease: float = 0.5, latency_tolerance: float = 2.0):
+        """初始化控制器
+
+        Args:
+            name: 名稱（僅用於日誌）
+            initial: 初始並行上限
+            min_limit: 並行上限的下限
+            max_limit: 並行上限的上限
+            increase: 每輪增加的並行數
+            decrease: 遇到限流或伺服器錯誤時的縮減比例
+            latency_tolerance: 延遲超過基準延遲幾倍時停止增加
+        """
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+
+        self.in_flight = 0
+        self.successes = 0
+        self.throttled = 0
+        self.errors = 0
+        self._latencies = deque(maxlen=200)
+        self._baseline: Optional[float] = None
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> bool:
+        """取得一個並行名額，必要時阻塞等待
+
+        Returns:
+            取得名額時並行數是否已用滿（只有用滿時的成功才會增加上限）
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return self.in_flight >= int(self.limit)
+
+    def release(self, latency: float, error: Optional[Exception] = None, saturated: bool = True) -> None:
+        """歸還名額並依結果調整上限
+
+        Args:
+            latency: 本次請求耗時（秒）
+            error: 請求失敗時的例外，成功時為 None
+            saturated: acquire 的返回值
+        """
+        with self._condition:
+            self.in_flight = max(0, self.in_flight - 1)
+            old_limit = int(self.limit)
+
+            if error is None:
+                self.successes += 1
+                self._latencies.append(latency)
+                # 基準延遲：以較慢的速度追蹤最近的低延遲
+                if self._baseline is None or latency < self._baseline:
+                    self._baseline = latency
+                else:
+                    self._baseline += (latency - self._baseline) * 0.05
+                if saturated and latency <= self._baseline * self.latency_tolerance:
+                    self.limit = min(self.max_limit, self.limit + self.increase / max(self.limit, 1.0))
+            elif is_rate_limit_error(error) or is_server_error(error):
+                if is_rate_limit_error(error):
+                    self.throttled += 1
+                else:
+                    self.errors += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= (self.latency_percentile(50) or 1.0):
+                    self._last_decrease = now
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+            else:
+                self.errors += 1
+
+            if int(self.limit) != old_limit:
+                p50 = self.latency_percentile(50)
+                print(f"[{self.name}] 並行上限 {old_limit} → {int(self.limit)}"
+                      + (f"（延遲中位數 {p50:.2f} 秒）" if p50 is not None else ""))
+            self._condition.notify_all()
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """最近成功請求延遲的百分位數（秒），沒有資料時返回 None"""
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        """目前的上限、進行中請求數、延遲與結果統計"""
+        with self._condition:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "p50": self.latency_percentile(50),
+                "p95": self.latency_percentile(95),
+                "successes": self.successes,
+                "throttled": self.throttled,
+                "errors": self.errors,
+            }
+
+
+# 錯誤訊息中的 HTTP 429 狀態（例如「HTTP 429」、「Error code: 429」、「429 Too Many Requests」），
+# 不比對單純包含 429 的數字（檔案大小、編號或時間戳）
+RATE_LIMIT_MESSAGE_PATTERN = re.compile(
+    r'(?:HTTP|status(?:[ _]code)?|error code)\s*[:=(]?\s*429\b|\b429\s+Too Many Requests', re.IGNORECASE
+)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """判斷例外是否為限流錯誤 (HTTP 429 / RESOURCE_EXHAUSTED)
+
+    優先依狀態碼判斷；沒有狀態碼時只接受 RESOURCE_EXHAUSTED 或 HTTP 狀態語境中的 429。
+    """
+    status = (getattr(getattr(error, 'response', None), 'status_code', None)
+              or getattr(error, 'status_code', None) or getattr(error, 'code', None))
+    if status == 429:
+        return True
+    message = str(error)
+    return ("RESOURCE_EXHAUSTED" in message or type(error).__name__ == "ResourceExhausted"
+            or bool(RATE_LIMIT_MESSAGE_PATTERN.search(message)))
+
+
+def is_server_error(error: Exception) -> bool:
+    """判斷例外是否為可重試的伺服器錯誤 (HTTP 5xx)"""
+    status = getattr(getattr(error, 'response', None), 'status_code', None) or getattr(error, 'code', None)
+    if isinstance(status, int) and 500 <= status < 600:
+        return True
+    return type(error).__name__ in ("InternalServerError", "ServiceUnavailable", "ServerError", "DeadlineExceeded")
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """從例外中取出伺服器建議的重試等待秒數
+
+    依序檢查 HTTP Retry-After 標頭與 Gemini 錯誤訊息中的 retry_delay。
+
+    Args:
+        error: API 呼叫拋出的例外
+
+    Returns:
+        等待秒數，無法取得時返回 None
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers:
+        value = headers.get('Retry-After') or headers.get('retry-after')
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                pass
+
+    match = re.search(r'retry_delay\s*\{\s*seconds:\s*(\d+)', str(error)) or \
+        re.search(r'retry (?:in|after) ([\d.]+)\s*s', str(error), re.IGNORECASE)
+    if match:
+        return float(match.group(1))
+    return None
@@ -0,0 +1,153 @@
+# utils/response_cache.py
+"""
+LLM 回應快取 - 以 SQLite 保存模型回應，依服務、模型、完整提示詞與生成參數判斷是否命中
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# 預設快取檔案位置
+DEFAULT_CACHE_PATH = os.path.join("temp", "cache", "llm_responses.sqlite3")
+
+
+class ResponseCache:
+    """
+    磁碟上的 LLM 回應快取
+
+    每筆資料記錄寫入時間與最後讀取時間：超過 ttl 秒的資料視為過期；
+    筆數或總大小超過上限時，先刪除過期資料，再依最後讀取時間刪除最久未使用的資料。
+    可在多個執行緒間共用。
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, ttl: float = 7 * 24 * 3600,
+                 max_entries: int = 5000, max_bytes: int = 200 * 1024 * 1024):
+        """初始化快取
+
+        Args:
+            path: SQLite 檔案路徑
+            ttl: 資料有效秒數，None 表示永不過期
+            max_entries: 最多保存的筆數
+            max_bytes: 回應文字的總大小上限（位元組）
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def make_key(service: str, model: str, prompt: str, config: Optional[Dict[str, Any]] = None) -> str:
+        """產生快取鍵
+
+        Args:
+            service: 服務名稱
+            model: 模型名稱
+            prompt: 完整提示詞（已代入文本）
+            config: 生成參數
+
+        Returns:
+            SHA-256 十六進位字串
+        """
+        payload = json.dumps(
+            {"service": service, "model": model, "config": config or {},
+             "prompt": hashlib.sha256(prompt.encode("utf-8")).hexdigest()},
+            sort_keys=True, ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """讀取快取，沒有資料或已過期時返回 None"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and self.ttl is not None and now - row[1] > self.ttl:
+                with self._conn:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        """寫入快取，必要時淘汰舊資料"""
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, len(value.encode("utf-8")), now, now)
+                )
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        """刪除過期資料，並淘汰最久未使用的資料直到符合上限（需在持有鎖時呼叫）"""
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+
+        removed = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            removed.append((key,))
+            count -= 1
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", removed)
+
+    def clear(self) -> None:
+        """清空快取與統計"""
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM responses")
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命中統計與目前的快取大小"""
+        with self._lock:
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": count,
+                "bytes": total,
+            }
+
+
+_default_cache: Optional[ResponseCache] = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache() -> ResponseCache:
+    """取得程式共用的預設快取（第一次使用時建立）"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache()
+        return _default_cache
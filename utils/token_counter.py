@@ -0,0 +1,25 @@
+# utils/token_counter.py
+"""
+Token 估算工具 - 在不呼叫 API 的情況下估計提示詞的 token 數
+"""
+
+import re
+
+# 中日韓文字約一字一個 token，其他文字約四個字元一個 token
+CJK_PATTERN = re.compile(r'[⺀-鿿豈-﫿　-〿＀-￯]')
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 數
+
+    Args:
+        text (str): 待估算文本
+
+    Returns:
+        int: 估計的 token 數
+    """
+    if not text:
+        return 0
+    cjk_count = len(CJK_PATTERN.findall(text))
+    other_count = len(text) - cjk_count
+    return cjk_count + (other_count + 3) // 4